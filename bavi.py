@@ -1,15 +1,58 @@
 #!/usr/bin/python3
 
+import time
+
+# Before anything else is imported, so the startup report includes imports
+STARTED = time.perf_counter()
+
 import argparse
 import configparser
 import logging
+import signal
 import sys
 
-from bavi.bot import Bot
+from bavi.metrics import MetricsServer
 from bavi.module_loader import load_modules
+from bavi.network import BotGroup
+from bavi.startup import StartupReport
 
 LOG_FMT = '%(asctime)-15s [%(levelname)s] %(name)s: %(message)s'
 
+def setup_profiler_signal(bot):
+    '''
+    Toggle the sampling profiler on SIGUSR1, e.g. `kill -USR1 <pid>`
+    '''
+
+    def toggle():
+        try:
+            path = bot.toggle_profiler()
+        except Exception as e:
+            logging.error('Failed to toggle profiler', exc_info=e)
+            return
+
+        if path is None:
+            logging.info('Profiler started by SIGUSR1')
+
+    def on_signal(signum, frame):
+        # The signal interrupts the main thread, which may be holding the
+        # profiler's lock (e.g. in .profile), so only schedule the toggle
+        bot.call_from_thread(toggle)
+
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, on_signal)
+
+def setup_term_signal():
+    '''
+    Exit cleanly on SIGTERM, so group.shutdown() commits pending database
+    writes before the process goes away
+    '''
+
+    def terminate(signum, frame):
+        logging.info('Received SIGTERM; shutting down')
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+
 def setup_logging(conf):
     if 'log' in conf:
         log_config = conf['log']
@@ -52,14 +95,38 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--config', required=True)
 
     args = parser.parse_args()
+    report = StartupReport(started=STARTED)
+    report.mark('import')
 
     conf = configparser.ConfigParser()
     conf.read(args.config)
 
     setup_logging(conf)
 
-    bot = Bot(conf)
-    bot.init_irc()
-    bot.init_db()
-    load_modules(bot)
-    bot.start()
+    if conf.get('bavi', 'Core', fallback='select') == 'asyncio':
+        from bavi.aio import AioBot
+        group = BotGroup(conf, bot_class=AioBot)
+    else:
+        group = BotGroup(conf)
+    group.init_irc()
+    report.mark('setup')
+    group.init_db()
+    report.mark('db')
+    report.add_modules(load_modules(group.primary))
+    report.mark('modules')
+    setup_profiler_signal(group.primary)
+    setup_term_signal()
+
+    if conf.has_option('metrics', 'Port'):
+        MetricsServer(
+                group.primary.metrics,
+                host=conf.get('metrics', 'Host', fallback='127.0.0.1'),
+                port=conf.getint('metrics', 'Port')
+        ).start()
+
+    report.wait_for_connect(group.bots)
+
+    try:
+        group.start()
+    finally:
+        group.shutdown()
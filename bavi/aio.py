@@ -0,0 +1,166 @@
+import asyncio
+import inspect
+import irc.bot
+import irc.client
+import irc.client_aio
+import irc.connection
+import irc.dict
+import logging
+
+from .bot import BaseBot, OUTBOUND_FLUSH_INTERVAL
+from .channels import ChannelStore
+
+log = logging.getLogger('bavi.aio')
+
+class AioBot(BaseBot, irc.client_aio.AioSimpleIRCClient):
+    '''
+    Bot core running on the asyncio event loop via irc.client_aio.
+
+    Handlers registered with add_command/add_matcher may be plain functions
+    or `async def` coroutine functions.  Coroutine handlers are scheduled as
+    tasks on the bot's loop, so many slow lookups can be in flight at once
+    without blocking message processing or needing worker threads.
+    '''
+
+    def init_irc(self):
+        irc_config = self.config[self._section]
+
+        irc.client_aio.AioSimpleIRCClient.__init__(self)
+        self.channels = irc.dict.IRCDict()
+
+        connect_factory = irc.connection.AioFactory()
+        if irc_config.getboolean('SSL'):
+            connect_factory = irc.connection.AioFactory(ssl=True)
+
+        self._host = irc_config.get('ServerHost')
+        self._port = int(irc_config.get('ServerPort'))
+        self._password = irc_config.get('ServerPassword')
+        self._nickname = irc_config.get('Nickname')
+        self._connect_factory = connect_factory
+
+        events = ['disconnect', 'join', 'kick', 'part']
+        if self._compact_channels:
+            self.channels = ChannelStore()
+            self.channels.attach(self.connection)
+            events = ['disconnect']
+
+        for event in events:
+            self.connection.add_global_handler(
+                    event,
+                    getattr(self, '_on_' + event),
+                    -20
+            )
+
+        if self._pool is not None:
+            loop = self.reactor.loop
+            self._pool.wakeup = lambda: loop.call_soon_threadsafe(
+                    self._pool.drain
+            )
+
+        self.reactor.loop.call_soon(self._flush_outbound)
+
+        log.info(
+                '[%s] Connecting to %s:%d using nick %s',
+                self._section,
+                self._host,
+                self._port,
+                self._nickname
+        )
+
+    async def _connect(self):
+        try:
+            await self.connection.connect(
+                    self._host,
+                    self._port,
+                    self._nickname,
+                    self._password,
+                    ircname=self._nickname,
+                    connect_factory=self._connect_factory
+            )
+        except (OSError, irc.client.ServerConnectionError):
+            log.exception('Failed to connect to %s:%d', self._host, self._port)
+            self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        # The backoff starts over in on_welcome
+        interval = self._backoff.next()
+
+        log.info('Reconnecting in %.1f seconds', interval)
+        self.reactor.loop.call_later(
+                interval,
+                lambda: asyncio.ensure_future(
+                    self._connect(),
+                    loop=self.reactor.loop
+                )
+        )
+
+    def _flush_outbound(self):
+        try:
+            self._outbound.flush()
+        finally:
+            self.reactor.loop.call_later(
+                    OUTBOUND_FLUSH_INTERVAL,
+                    self._flush_outbound
+            )
+
+    def start(self):
+        self.run_group([self])
+
+    @staticmethod
+    def run_group(bots):
+        # All AioReactors created on this thread share its event loop
+        loop = bots[0].reactor.loop
+        loop.run_until_complete(asyncio.gather(
+            *[bot._connect() for bot in bots]
+        ))
+        loop.run_forever()
+
+    def call_from_thread(self, fn):
+        BaseBot.call_from_thread(self, fn)
+        self.reactor.loop.call_soon_threadsafe(self._run_callbacks)
+
+    def _run_handler(self, event, handler, fn):
+        # Coroutine handlers only block the loop until their first await,
+        # so they always run on the loop rather than on the worker pool
+        if inspect.iscoroutinefunction(handler):
+            fn()
+        else:
+            BaseBot._run_handler(self, event, handler, fn)
+
+    def _await_result(self, result, on_error):
+        task = asyncio.ensure_future(result)
+
+        def done(task):
+            if task.cancelled():
+                return
+
+            e = task.exception()
+            if e is not None:
+                on_error(e)
+
+        task.add_done_callback(done)
+
+    def _on_disconnect(self, connection, event):
+        self.channels.clear()
+        self._schedule_reconnect()
+
+    def _on_join(self, connection, event):
+        if event.source.nick == connection.get_nickname():
+            self.channels[event.target] = irc.bot.Channel()
+        self.channels[event.target].add_user(event.source.nick)
+
+    def _on_kick(self, connection, event):
+        nick = event.arguments[0]
+
+        if nick == connection.get_nickname():
+            del self.channels[event.target]
+        elif event.target in self.channels:
+            self.channels[event.target].remove_user(nick)
+
+    def _on_part(self, connection, event):
+        nick = event.source.nick
+
+        if nick == connection.get_nickname():
+            del self.channels[event.target]
+        elif event.target in self.channels:
+            self.channels[event.target].remove_user(nick)
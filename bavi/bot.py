@@ -1,76 +1,365 @@
+import asyncio
+import collections
+import configparser
+import contextvars
+import fnmatch
+import inspect
 import irc.bot
+import irc.client
 import irc.connection
+import irc.strings
 import logging
-import re
-import sqlite3
+import select
 import ssl
-
-from .module_loader import load_modules
+import time
+
+from .channels import ChannelStore
+from .chatlog import ChatLog
+from .commands import AmbiguousCommand
+from .db import Database
+from .encoding import LineEncoder
+from .metrics import Metrics
+from .module_loader import ModuleStub
+from .outbound import OutboundQueue, PRIORITY_COMMAND, PRIORITY_MATCHER
+from .profiler import SamplingProfiler, enter_handler, leave_handler
+from .ratelimit import DispatchLimiter
+from .reconnect import Backoff, BackoffReconnect, join_batch
+from .registry import Registry
+from .watchdog import HandlerTimeout, Watchdog
+from .worker import HandlerPool
 
 log = logging.getLogger('bavi')
 log.setLevel(logging.INFO)
 
+# How often (in seconds) the reactor releases output from worker threads and
+# runs functions passed to call_from_thread()
+WORKER_DRAIN_INTERVAL = 0.1
+
+# How often (in seconds) the reactor sends lines held by the outbound queue
+OUTBOUND_FLUSH_INTERVAL = 0.25
+
+# Priority of lines sent by the handler currently running in this context
+_priority = contextvars.ContextVar('priority', default=PRIORITY_COMMAND)
+
+def _format_minutes(seconds):
+    minutes = max(1, int(round(seconds / 60)))
+    return '{} minute{}'.format(minutes, '' if minutes == 1 else 's')
+
 # TODO: look into whether setting lenient decoder is necessary
 # to avoid crashes on badly-encoded messages
 
-class Bot(irc.bot.SingleServerIRCBot):
-    def __init__(self, config):
-        self.config = config
+class BaseBot:
+    '''
+    Command/matcher registration and dispatch shared by the bot cores.
 
-        self._command_prefix = '.' # TODO: configurable
-        self._commands = {}
-        self._matchers = []
+    Subclasses provide the IRC transport: `connection`, `channels` and an
+    init_irc() method that sets them up.
 
-    def init_irc(self):
-        irc_config = self.config['irc']
-        spec = irc.bot.ServerSpec(
-                irc_config.get('ServerHost'),
-                int(irc_config.get('ServerPort')),
-                irc_config.get('ServerPassword')
-        )
+    `section` names the config section describing the IRC connection.  If
+    `shared` is given, the new bot uses the same command/matcher registry
+    and worker pool as that bot, so modules only have to be loaded once.
+    '''
 
-        additional_args = {}
+    def __init__(self, config, section='irc', shared=None):
+        if config is None:
+            config = configparser.ConfigParser()
+        self.config = config
+        self._section = section
+        # Name of the network in chat log paths: "irc:example" -> "example"
+        self._network = section.partition(':')[2] or section
+
+        # Longest first, so that e.g. "!!" wins over "!"
+        self._command_prefixes = tuple(sorted(
+            config.get('bavi', 'CommandPrefixes', fallback='.').split(),
+            key=len,
+            reverse=True
+        ))
+        self._address_nick = None
+        self._address_prefixes = ()
+        self._ratelimit = DispatchLimiter(config)
+        self._encoder = LineEncoder()
+        self._callbacks = collections.deque()
+        self._connect_hooks = []
+
+        self._backoff = Backoff(
+                min_interval=config.getfloat(
+                    'reconnect',
+                    'MinInterval',
+                    fallback=2
+                ),
+                max_interval=config.getfloat(
+                    'reconnect',
+                    'MaxInterval',
+                    fallback=300
+                )
+        )
+        self._join_batch = config.getint('reconnect', 'JoinBatch',
+                fallback=10)
+        # Track channel members with a ChannelStore instead of irc.bot's
+        # per-channel dicts
+        self._compact_channels = config.get(section, 'ChannelState',
+                fallback='full') == 'compact'
+        self._joins = collections.deque()
+        # Channels to be in after (re)connecting, by lowercased name: the
+        # configured ones plus any joined since, minus any parted or kicked
+        # from
+        self._channels = collections.OrderedDict()
+        for chan in config.get(section, 'Channels', fallback='').split(','):
+            if chan.strip():
+                self._channels[irc.strings.lower(chan.strip())] = \
+                        chan.strip()
+
+        # Set up by init_db()
+        self.db = None
+
+        if shared is not None:
+            self._registry = shared._registry
+            self._pool = shared._pool
+            self._default_limit = getattr(shared, '_default_limit', None)
+            self.metrics = shared.metrics
+            self.profiler = shared.profiler
+            self.chatlog = shared.chatlog
+            self._watchdog = shared._watchdog
+            self._deadline = shared._deadline
+        else:
+            self._registry = Registry()
+            self._pool = None
+            self._init_pool()
+            self.metrics = Metrics()
+            self.profiler = SamplingProfiler(
+                    interval=config.getfloat(
+                        'profiler',
+                        'Interval',
+                        fallback=0.01
+                    )
+            )
+            if self._pool is not None:
+                self.metrics.add_gauge(
+                        'worker_jobs_pending',
+                        {},
+                        lambda: self._pool.pending
+                )
+            self.chatlog = None
+            self._init_chatlog()
+            self._init_watchdog()
+
+        self._admins = [
+            irc.strings.lower(mask.strip())
+            for mask in config.get('bavi', 'Admins', fallback='').split(',')
+            if mask.strip()
+        ]
+
+        self._outbound = OutboundQueue(
+                self._send_line,
+                rate=config.getfloat('outbound', 'Rate', fallback=0.5),
+                burst=config.getint('outbound', 'Burst', fallback=5),
+                max_per_target=config.getint(
+                    'outbound',
+                    'MaxQueue',
+                    fallback=20
+                ),
+                aggregate=config.getboolean(
+                    'outbound',
+                    'Aggregate',
+                    fallback=False
+                ),
+                budget=lambda target: self._encoder.budget(target)
+        )
+        self.metrics.add_gauge(
+                'outbound_queue_depth',
+                { 'network': section },
+                lambda: self._outbound.depth
+        )
+        self.metrics.add_gauge(
+                'outbound_dropped_total',
+                { 'network': section },
+                lambda: self._outbound.dropped,
+                kind='counter'
+        )
 
-        if irc_config.getboolean('SSL'):
-            additional_args['connect_factory'] = irc.connection.Factory(
-                    wrapper=ssl.wrap_socket
+    def _init_pool(self):
+        threads = self.config.getint('workers', 'Threads', fallback=0)
+        if threads > 0:
+            self._pool = HandlerPool(
+                    threads=threads,
+                    max_pending=self.config.getint(
+                        'workers',
+                        'MaxPending',
+                        fallback=64
+                    )
+            )
+            self._default_limit = self.config.getint(
+                    'workers',
+                    'PerHandler',
+                    fallback=threads
             )
 
-        nick = irc_config.get('Nickname')
+    def _init_chatlog(self):
+        directory = self.config.get('chatlog', 'Directory', fallback=None)
+        if not directory:
+            return
 
-        irc.bot.SingleServerIRCBot.__init__(
-                self,
-                [spec],
-                nick,
-                nick,
-                **additional_args
+        self.chatlog = ChatLog(
+                directory,
+                max_queue=self.config.getint(
+                    'chatlog',
+                    'MaxQueue',
+                    fallback=10000
+                ),
+                flush_interval=self.config.getfloat(
+                    'chatlog',
+                    'FlushInterval',
+                    fallback=1
+                ),
+                fsync_interval=self.config.getfloat(
+                    'chatlog',
+                    'FsyncInterval',
+                    fallback=10
+                ),
+                compress=self.config.getboolean(
+                    'chatlog',
+                    'Compress',
+                    fallback=True
+                )
+        )
+        self.chatlog.start()
+        self.metrics.add_gauge(
+                'chatlog_queue_depth',
+                {},
+                lambda: self.chatlog.depth
+        )
+        self.metrics.add_gauge(
+                'chatlog_dropped_total',
+                {},
+                lambda: self.chatlog.dropped,
+                kind='counter'
         )
 
-        log.info(
-                'Connecting to %s:%d using nick %s',
-                spec.host,
-                spec.port,
-                nick
+    def _init_watchdog(self):
+        # Default deadline for handlers registered without one; 0 disables
+        self._deadline = self.config.getfloat(
+                'watchdog',
+                'Deadline',
+                fallback=30
+        )
+        self._watchdog = Watchdog(
+                strikes=self.config.getint('watchdog', 'Strikes', fallback=3),
+                window=self.config.getfloat(
+                    'watchdog',
+                    'StrikeWindow',
+                    fallback=600
+                ),
+                disable_for=self.config.getfloat(
+                    'watchdog',
+                    'DisableFor',
+                    fallback=900
+                ),
+                # Handlers running inline are never interrupted: the
+                # exception could land in the reactor instead
+                interrupt=self.config.getboolean(
+                    'watchdog',
+                    'Interrupt',
+                    fallback=self._pool is not None
+                )
+        )
+        self.metrics.add_gauge(
+                'handlers_disabled',
+                {},
+                self._watchdog.disabled_count
+        )
+
+    def shutdown(self):
+        '''
+        Run shutdown hooks, stop the worker pool and the module sandbox,
+        commit pending database writes and flush the chat log.  Only call
+        this on the bot that owns them, i.e. not on one created with
+        `shared`.
+        '''
+
+        for fn in self._registry.shutdown_hooks:
+            try:
+                fn()
+            except Exception:
+                log.exception('Shutdown hook %r failed', fn)
+
+        if self._pool is not None:
+            self._pool.shutdown()
+        if self._registry.sandbox is not None:
+            self._registry.sandbox.stop()
+        if self.db is not None:
+            self.db.close()
+        self._watchdog.stop()
+        if self.chatlog is not None:
+            self.chatlog.close()
+
+    def toggle_profiler(self):
+        '''
+        Start the sampling profiler, or stop it and write the profile to
+        [profiler] Directory.  Returns the path written, or None if the
+        profiler was started.
+        '''
+
+        return self.profiler.toggle(
+                self.config.get('profiler', 'Directory', fallback='.'),
+                self.config.get('profiler', 'Format', fallback='collapsed')
         )
 
     def init_db(self):
-        db_config = self.config['sqlite3']
-        self.db = sqlite3.connect(db_config.get('Filename'))
+        # Handlers may run on worker threads (see [workers]); Database
+        # gives each thread its own connection and funnels writes through
+        # one writer thread
+        self.db = Database.from_config(self.config, metrics=self.metrics)
+        self.metrics.add_gauge(
+                'db_commits',
+                {},
+                lambda: self.db.commits,
+                kind='counter'
+        )
+        self.metrics.add_gauge(
+                'db_writes',
+                {},
+                lambda: self.db.writes,
+                kind='counter'
+        )
+
+    def is_admin(self, source):
+        '''
+        Check whether source (a nick!user@host mask) matches one of the
+        hostmask patterns in [bavi] Admins
+        '''
+
+        source = irc.strings.lower(str(source))
+        return any(fnmatch.fnmatchcase(source, mask) for mask in self._admins)
 
     def _addressed_to_me(self, msg):
         name = self.connection.get_nickname()
 
-        return msg.startswith(name + ': ') or msg.startswith(name + ', ')
+        if name != self._address_nick:
+            self._address_nick = name
+            self._address_prefixes = (name + ': ', name + ', ')
+
+        return msg.startswith(self._address_prefixes)
 
-    def _sanitize(self, message):
+    def _parse_command(self, msg):
         '''
-        Sanitize a message according to RFC 1459 by removing
-        NUL, CR, and LF characters
+        Split a command line into (command, arguments), or return None if
+        msg is not a command.
         '''
 
-        return ''.join(
-                ch for ch in message if ch not in {'\r', '\n', '\0'}
-        )
+        if msg.startswith(self._command_prefixes):
+            # Syntax: ".command", "!command", etc.
+            for prefix in self._command_prefixes:
+                if msg.startswith(prefix):
+                    break
+            cmd, _, rest = msg[len(prefix):].partition(' ')
+            return cmd, rest
+        elif self._addressed_to_me(msg):
+            # Syntax: "Bot: command"
+            _, _, rest = msg.partition(' ')
+            cmd, _, rest = rest.partition(' ')
+            return cmd, rest
+
+        return None
 
     def reply_to(self, source, target, message):
         '''
@@ -82,9 +371,7 @@ class Bot(irc.bot.SingleServerIRCBot):
         if target not in self.channels:
             raise KeyError(target)
 
-        message = self._sanitize(message)
-        # TODO: log outbound message to chat log
-        self.connection.privmsg(target, '{}: {}'.format(source.nick, message))
+        self._send(target, '{}: {}'.format(source.nick, message))
 
     def say(self, target, message):
         '''
@@ -94,112 +381,505 @@ class Bot(irc.bot.SingleServerIRCBot):
         if target not in self.channels:
             raise KeyError(target)
 
-        message = self._sanitize(message)
-        # TODO: log outbound message to chat log
-        self.connection.privmsg(target, message)
+        self._send(target, message)
+
+    def _send(self, target, message):
+        # Messages too long for one line are split into several PRIVMSGs
+        for line, size in self._encoder.encode(target, message):
+            self._privmsg(target, line, size)
+
+    def _send_line(self, target, line):
+        # Called by the outbound queue; lines are logged as they are sent,
+        # after any merging, so the log matches what the channel saw
+        self.connection.privmsg(target, line)
+        if self.chatlog is not None:
+            self.chatlog.record(
+                    self._network,
+                    target,
+                    self.connection.get_nickname(),
+                    line
+            )
+
+    def _privmsg(self, target, message, size):
+        priority = _priority.get()
+
+        def send():
+            self._outbound.enqueue(target, message, priority, size=size)
+            self._outbound.flush()
+
+        # Handlers running on a worker thread must not write to the
+        # connection; hand the message to the pool so it is sent from the
+        # reactor thread in order.
+        if self._pool is not None and self._pool.emit(send):
+            return
+
+        send()
 
-    def add_command(self, cmd, handler, aliases=[]):
+    def add_command(self, cmd, handler, aliases=[], max_concurrency=None,
+            deadline=None):
         '''
         Register a command
+
+        max_concurrency limits how many calls to handler may run at once
+        when handlers are executed on worker threads.  deadline is how many
+        seconds a call may take before it is reported and cancelled, if
+        different from [watchdog] Deadline; 0 means no limit.
         '''
-        for trigger in [cmd] + aliases:
-            if trigger in self._commands:
-                raise RuntimeError('Command "{}" is already registered'.format(
-                    trigger
-                ))
 
-        for trigger in [cmd] + aliases:
-            self._commands[trigger] = handler
+        self._registry.add_command(
+                cmd,
+                handler,
+                aliases=aliases,
+                max_concurrency=max_concurrency,
+                deadline=deadline
+        )
 
-    def add_matcher(self, regex, handler, priority='low'):
-        if priority not in { 'low', 'medium', 'high' }:
-            raise ValueError('priority must be low, medium, or high')
+    def add_matcher(self, regex, handler, priority='low',
+            max_concurrency=None, deadline=None):
+        self._registry.add_matcher(
+                regex,
+                handler,
+                priority=priority,
+                max_concurrency=max_concurrency,
+                deadline=deadline
+        )
 
-        if type(regex) != type(re.compile('')):
-            raise TypeError('regex argument must be a compiled regex')
+    def add_listener(self, handler):
+        '''
+        Register a function called as handler(bot, event) for every channel
+        message, before commands and matchers are dispatched.
 
-        if priority == 'low':
-            self._matchers.append((regex, handler))
-        elif priority == 'high':
-            self._matchers = [(regex, handler)] + self._matchers
-        else:
-            idx = len(self._matchers)//2
-            self._matchers = (
-                    self._matchers[:idx] +
-                    [(regex, handler)] +
-                    self._matchers[idx:]
-            )
+        Listeners run on the connection's thread and must return quickly;
+        hand anything slow to a thread of your own.
+        '''
 
-    def _dispatch_command(self, event, cmd, message):
-        if cmd not in self._commands:
+        self._registry.add_listener(handler)
+
+    def add_shutdown_hook(self, fn):
+        '''
+        Register fn() to be called by shutdown(), e.g. to flush a module's
+        background writer
+        '''
+
+        self._registry.add_shutdown_hook(fn)
+
+    def add_connect_hook(self, fn):
+        '''
+        Register fn(bot) to be called each time this bot has registered
+        with the server, before it joins its channels
+        '''
+
+        self._connect_hooks.append(fn)
+
+    @property
+    def network(self):
+        '''
+        Short name of this bot's IRC network, e.g. "example" for a bot
+        configured in [irc:example]
+        '''
+
+        return self._network
+
+    def is_command(self, message):
+        '''
+        Return True if message would be dispatched as a command
+        '''
+
+        return self._parse_command(message.strip()) is not None
+
+    def call_from_thread(self, fn):
+        '''
+        Run fn() on the thread that owns the connection, e.g. to send the
+        result of work done on a module's own thread.  Safe to call from
+        any thread.
+        '''
+
+        self._callbacks.append(fn)
+
+    def _run_callbacks(self):
+        while self._callbacks:
+            fn = self._callbacks.popleft()
+            try:
+                fn()
+            except Exception:
+                log.exception('Callback %r failed', fn)
+
+    def _run_handler(self, event, handler, fn):
+        '''
+        Run fn, either inline or on the worker pool if one is configured
+        '''
+
+        if self._pool is None:
+            fn()
+            return
+
+        limit = self._registry.limits.get(handler, self._default_limit)
+        channel = (self._section, event.target)
+        if not self._pool.submit(channel, handler, fn, limit=limit):
+            log.warning(
+                    'Worker pool full; dropping message from %s',
+                    event.source
+            )
             self.reply_to(
                     event.source,
                     event.target,
-                    "I don't know about that command."
+                    "I'm too busy right now, try again later."
             )
+
+    def _call_handler(self, event, handler, message, label, command=None,
+            **kwargs):
+        '''
+        Call a command or matcher handler and report any exception it raises
+        back to the channel.  Handlers may be coroutine functions.
+
+        label identifies the handler in metrics, e.g. "command:title".
+        command is the name of the command being run, or None for a
+        matcher; it is passed on to the handler along with kwargs.
+        '''
+
+        if command is not None:
+            kwargs['command'] = command
+            priority = PRIORITY_COMMAND
+            failure = 'Command "{}" failed'.format(command)
+            name = 'Command "{}"'.format(command)
+        else:
+            priority = PRIORITY_MATCHER
+            failure = 'Message handler failed'
+            name = 'Message handler'
+
+        disabled = self._watchdog.disabled(label)
+        if disabled:
+            if command is not None:
+                self.reply_to(
+                        event.source,
+                        event.target,
+                        '{} is disabled for another {} after timing out '
+                        'repeatedly.'.format(name, _format_minutes(disabled))
+                )
             return
 
-        try:
-            self._commands[cmd](
-                    self,
-                    event.source,
-                    event.target,
-                    message,
-                    command=cmd
-            )
-        except BaseException as e:
+        if not self._check_rate_limit(
+                event,
+                self._handler_name(handler, label.partition(':')[2])):
+            return
+
+        stats = self.metrics.handler(label)
+        deadline = self._registry.deadlines.get(handler, self._deadline)
+
+        def on_error(e):
+            stats.errors += 1
             exception_msg = type(e).__name__ + ': ' + str(e)
-            log.exception('Command "%s" failed', cmd)
+            log.error(failure, exc_info=e)
             self.say(event.target, exception_msg)
 
-    def _dispatch_matcher(self, event, message):
-        for regex, handler in self._matchers:
-            match = regex.search(message)
-            if match:
-                log.debug('Matched pattern: %s', regex.pattern)
+        def timeout_notice(disabled):
+            stats.timeouts += 1
+            notice = '{} timed out after {:g}s.'.format(name, deadline)
+            if disabled:
+                notice += ' It is disabled for {}.'.format(
+                        _format_minutes(self._watchdog.disabled(label))
+                )
+            return notice
+
+        def on_overrun(disabled):
+            # Called on the watchdog thread
+            notice = timeout_notice(disabled)
+            if job is not None:
+                self._pool.abandon(job)
+            self.call_from_thread(lambda: self.say(event.target, notice))
+
+        async def timed(result, start):
+            try:
+                if deadline:
+                    await asyncio.wait_for(result, deadline)
+                else:
+                    await result
+            except asyncio.TimeoutError:
+                log.warning('%s overran its deadline', label)
+                self.say(
+                        event.target,
+                        timeout_notice(self._watchdog.strike(label))
+                )
+            finally:
+                stats.latency.observe(time.perf_counter() - start)
+
+        job = None
+
+        def run():
+            nonlocal job
+            if self._pool is not None:
+                job = self._pool.current_job()
+
+            token = _priority.set(priority)
+            profiling = enter_handler(label)
+            stats.calls += 1
+            start = time.perf_counter()
+            # Only worker threads can be interrupted safely
+            watch = self._watchdog.watch(label, deadline, on_overrun,
+                    interrupt=job is not None)
+            result = None
+
+            def observe():
+                # timed() records the latency of coroutines itself
+                if not inspect.isawaitable(result):
+                    stats.latency.observe(time.perf_counter() - start)
+
+            try:
                 try:
-                    handler(
+                    result = handler(
                             self,
                             event.source,
                             event.target,
                             message,
-                            match=match
+                            **kwargs
                     )
-                except BaseException as e:
-                    exception_msg = type(e).__name__ + ': ' + str(e)
-                    log.exception('Message handler failed')
-                    self.say(event.target, exception_msg)
                 finally:
-                    return
+                    self._watchdog.done(watch)
+
+                # Coroutines are bounded by wait_for() in timed() instead
+                if inspect.isawaitable(result):
+                    self._await_result(timed(result, start), on_error)
+                else:
+                    observe()
+            except HandlerTimeout:
+                # The watchdog has already reported it
+                self._watchdog.done(watch)
+                observe()
+            except BaseException as e:
+                observe()
+                on_error(e)
+            finally:
+                leave_handler(profiling)
+                _priority.reset(token)
+
+        self._run_handler(event, handler, run)
+
+    def _handler_name(self, handler, name):
+        '''
+        A handler's name for rate limits, e.g. "url.title": the module that
+        registered it and the command (or function) name, so handlers with
+        the same name in different modules have separate budgets
+        '''
+
+        module = self._registry.owners.get(handler)
+        if module is not None:
+            name = '{}.{}'.format(module, name)
+        return name.lower()
+
+    def _check_rate_limit(self, event, name):
+        '''
+        Check a call to the handler called name (see _handler_name()), or
+        None for a command that does not exist, against [ratelimit]
+        '''
+
+        nick = event.source.nick
+
+        if self._ratelimit.allow(
+                irc.strings.lower(nick),
+                irc.strings.lower(event.target),
+                name):
+            return True
+
+        log.info('Rate limited %s calling %s in %s', nick,
+                name or 'an unknown command', event.target)
+        if self._ratelimit.should_notice(irc.strings.lower(nick)):
+            # Paced like replies, so that many nicks hitting their limits
+            # at once cannot flood the bot off the server
+            self._outbound.enqueue_control(lambda: self.connection.notice(
+                    nick,
+                    "You're doing that too often; try again later."
+            ))
+            self._outbound.flush()
+
+        return False
+
+    def _await_result(self, result, on_error):
+        '''
+        Wait for the awaitable returned by a coroutine handler.
+
+        The blocking cores have no event loop of their own, so the coroutine
+        is run to completion on a temporary loop; exceptions propagate to the
+        caller.  AioBot overrides this to schedule a task instead.
+        '''
+
+        async def wait():
+            await result
+
+        asyncio.run(wait())
+
+    def _dispatch_command(self, event, cmd, message):
+        try:
+            name, handler = self._registry.commands.resolve(cmd)
+            if isinstance(handler, ModuleStub):
+                # The module is only in the module cache so far
+                handler.load()
+                name, handler = self._registry.commands.resolve(cmd)
+        except AmbiguousCommand as e:
+            if not self._check_rate_limit(event, None):
+                return
+            self.reply_to(
+                    event.source,
+                    event.target,
+                    'Did you mean: {}?'.format(', '.join(e.candidates))
+            )
+            return
+        except KeyError:
+            # Replies cost output too, so they count against the budgets
+            if not self._check_rate_limit(event, None):
+                return
+            self.reply_to(
+                    event.source,
+                    event.target,
+                    "I don't know about that command."
+            )
+            return
+
+        self._call_handler(
+                event,
+                handler,
+                message,
+                'command:' + name,
+                command=name
+        )
+
+    def _dispatch_matcher(self, event, message):
+        self.metrics.matcher_checks += 1
+        result = self._registry.matchers.match(message)
+        if result is not None and isinstance(result[1], ModuleStub):
+            result[1].load()
+            result = self._registry.matchers.match(message)
+        if result is None:
+            self.metrics.matcher_misses += 1
+            return
+
+        regex, handler, match = result
+        log.debug('Matched pattern: %s', regex.pattern)
+        self._call_handler(
+                event,
+                handler,
+                message,
+                'matcher:' + getattr(handler, '__name__', repr(handler)),
+                match=match
+        )
+
+    def on_disconnect(self, conn, event):
+        self._outbound.clear()
+        # Until on_welcome(), lines can only be queued
+        self._outbound.pause()
+        self._joins.clear()
+
+    def on_join(self, conn, event):
+        # Our own JOIN shows the nick!user@host the server prefixes our
+        # messages with, which decides how much text fits on a line
+        if event.source.nick == conn.get_nickname():
+            self._encoder.set_source(event.source)
+            self._channels[irc.strings.lower(event.target)] = event.target
+
+    def on_part(self, conn, event):
+        if event.source.nick == conn.get_nickname():
+            self._channels.pop(irc.strings.lower(event.target), None)
+
+    def on_kick(self, conn, event):
+        if event.arguments[0] == conn.get_nickname():
+            self._channels.pop(irc.strings.lower(event.target), None)
+
+    def on_nick(self, conn, event):
+        if event.target == conn.get_nickname():
+            self._encoder.set_source(
+                    '{}!{}'.format(event.target, event.source.userhost)
+            )
 
     def on_welcome(self, conn, event):
-        for chan in self.config.get('irc', 'Channels').split(','):
-            log.info('Joining channel %s', chan.strip())
-            conn.join(chan.strip())
+        self._encoder.set_source(conn.get_nickname())
+        self._outbound.resume()
+
+        for fn in self._connect_hooks:
+            try:
+                fn(self)
+            except Exception:
+                log.exception('Connect hook %r failed', fn)
+
+        self._backoff.reset()
+        log.info('Joining %d channel(s)', len(self._channels))
+        self._joins.clear()
+        self.join(*self._channels.values())
+
+    @property
+    def joined_channels(self):
+        '''
+        Channels the bot is in, or will rejoin after reconnecting
+        '''
+
+        return list(self._channels.values())
+
+    def join(self, *channels):
+        '''
+        Join channels.  They are sent several to a JOIN line, as many as
+        the server allows per line, paced by the outbound queue.  Must be
+        called on the connection's thread.
+        '''
+
+        if not channels:
+            return
+
+        if not self._joins:
+            self._outbound.enqueue_control(self._send_join)
+        self._joins.extend(channels)
+
+    def _send_join(self):
+        if not self._joins:
+            return
+
+        # TARGMAX from the server's ISUPPORT, if it sent one; JOIN:
+        # without a number means no limit
+        targmax = getattr(self.connection.features, 'targmax', None) or {}
+        limit = targmax.get('JOIN', self._join_batch)
+
+        self.connection.join(join_batch(self._joins, limit))
+        if self._joins:
+            self._outbound.enqueue_control(self._send_join)
+
+    def part(self, *channels):
+        '''
+        Leave channels, paced by the outbound queue like join().  Must be
+        called on the connection's thread.
+        '''
+
+        if channels:
+            self._outbound.enqueue_control(
+                    lambda: self.connection.part(channels))
+
+    def on_action(self, conn, event):
+        if self.chatlog is not None and irc.client.is_channel(event.target):
+            self.chatlog.record(
+                    self._network,
+                    event.target,
+                    event.source.nick,
+                    event.arguments[0] if event.arguments else '',
+                    kind='ACTION'
+            )
 
     def on_pubmsg(self, conn, event):
-        # TODO: log the message to a chat log file
         try:
+            self.metrics.messages.add()
+            if self.chatlog is not None:
+                self.chatlog.record(
+                        self._network,
+                        event.target,
+                        event.source.nick,
+                        event.arguments[0]
+                )
+            for listener in self._registry.listeners:
+                try:
+                    listener(self, event)
+                except Exception:
+                    log.exception('Listener %r failed', listener)
+
             msg = event.arguments[0].strip()
 
-            if msg.startswith(self._command_prefix):
-                # Syntax: ".command", "!command", etc.
-                if ' ' in msg:
-                    cmd, rest = msg.split(' ', 1)
-                else:
-                    cmd, rest = msg, ''
-                cmd = cmd[len(self._command_prefix):]
-                self._dispatch_command(event, cmd, rest)
-                return
-            elif self._addressed_to_me(msg):
-                # Syntax: "Bot: command"
-                _, rest = msg.split(' ', 1)
-                if ' ' in rest:
-                    cmd, rest = rest.split(' ', 1)
-                else:
-                    cmd, rest = rest, ''
-                self._dispatch_command(event, cmd, rest)
-                return
+            command = self._parse_command(msg)
+            if command is not None:
+                self._dispatch_command(event, *command)
             else:
                 self._dispatch_matcher(event, msg)
         except BaseException as e:
@@ -208,3 +888,93 @@ class Bot(irc.bot.SingleServerIRCBot):
     def on_privmsg(self, conn, event):
         # TODO: support private messages
         pass
+
+class Bot(BaseBot, irc.bot.SingleServerIRCBot):
+    def init_irc(self):
+        irc_config = self.config[self._section]
+        spec = irc.bot.ServerSpec(
+                irc_config.get('ServerHost'),
+                int(irc_config.get('ServerPort')),
+                irc_config.get('ServerPassword')
+        )
+
+        additional_args = {}
+
+        if irc_config.getboolean('SSL'):
+            additional_args['connect_factory'] = irc.connection.Factory(
+                    wrapper=ssl.wrap_socket
+            )
+
+        nick = irc_config.get('Nickname')
+
+        irc.bot.SingleServerIRCBot.__init__(
+                self,
+                [spec],
+                nick,
+                nick,
+                recon=BackoffReconnect(self._backoff),
+                **additional_args
+        )
+
+        if self._compact_channels:
+            self.channels = ChannelStore()
+            self.channels.attach(self.connection, self)
+
+        if self._pool is not None:
+            self.reactor.scheduler.execute_every(
+                    WORKER_DRAIN_INTERVAL,
+                    self._pool.drain
+            )
+
+        self.reactor.scheduler.execute_every(
+                OUTBOUND_FLUSH_INTERVAL,
+                self._outbound.flush
+        )
+        self.reactor.scheduler.execute_every(
+                WORKER_DRAIN_INTERVAL,
+                self._run_callbacks
+        )
+
+        log.info(
+                '[%s] Connecting to %s:%d using nick %s',
+                self._section,
+                spec.host,
+                spec.port,
+                nick
+        )
+
+    def _on_disconnect(self, connection, event):
+        # Unlike irc.bot, keep the same (possibly compact) store
+        self.channels.clear()
+        self.recon.run(self)
+
+    @staticmethod
+    def run_group(bots, timeout=0.2):
+        '''
+        Run several bots from one thread.
+
+        Each bot keeps its own reactor, so events never cross between
+        connections, but a single select() waits on all of their sockets.
+        '''
+
+        for bot in bots:
+            bot._connect()
+
+        while True:
+            owners = {}
+            for bot in bots:
+                for sock in bot.reactor.sockets:
+                    owners[sock] = bot.reactor
+
+            if owners:
+                ready, _, _ = select.select(list(owners), [], [], timeout)
+                by_reactor = {}
+                for sock in ready:
+                    by_reactor.setdefault(owners[sock], []).append(sock)
+                for reactor, socks in by_reactor.items():
+                    reactor.process_data(socks)
+            else:
+                time.sleep(timeout)
+
+            for bot in bots:
+                bot.reactor.process_timeout()
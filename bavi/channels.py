@@ -0,0 +1,394 @@
+import array
+import bisect
+import irc.dict
+import irc.modes
+import logging
+
+log = logging.getLogger('bavi.channels')
+
+# Modes that apply to a user in a channel, as in irc.bot.Channel
+USER_MODES = 'ovqha'
+
+# RFC 1459 case folding, as irc.strings.lower() does, without creating an
+# IRCFoldedCase for every nick in a NAMES burst
+_FOLD = str.maketrans('[]\\^', '{}|~')
+
+def _fold(nick):
+    return nick.lower().translate(_FOLD)
+
+class NickTable:
+    '''
+    Every nick seen in any channel, numbered with small integer ids.
+
+    Channels store ids instead of nicks, so a user in many channels costs
+    one entry here and four bytes per channel.  Ids are reference counted
+    by channel membership and reused once a user has left every channel.
+    A nick change only touches this table.
+    '''
+
+    def __init__(self):
+        # Lowercased nick -> id
+        self._ids = {}
+        # Id -> nick as last seen, or None if the id is free
+        self._nicks = []
+        # Id -> number of channels the nick is in
+        self._refs = array.array('I')
+        self._free = []
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, nick):
+        return _fold(nick) in self._ids
+
+    def id(self, nick):
+        '''
+        The id of nick, or None if it is not in any channel
+        '''
+
+        return self._ids.get(_fold(nick))
+
+    def nick(self, id):
+        return self._nicks[id]
+
+    def acquire(self, nick):
+        '''
+        The id of nick, allocating one if needed, counting one more
+        channel it is in
+        '''
+
+        key = _fold(nick)
+        id = self._ids.get(key)
+        if id is None:
+            if self._free:
+                id = self._free.pop()
+                self._nicks[id] = nick
+            else:
+                id = len(self._nicks)
+                self._nicks.append(nick)
+                self._refs.append(0)
+            self._ids[key] = id
+
+        self._refs[id] += 1
+        return id
+
+    def release(self, id):
+        '''
+        Count one channel fewer for id, freeing it when it is in none
+        '''
+
+        self._refs[id] -= 1
+        if self._refs[id] == 0:
+            del self._ids[_fold(self._nicks[id])]
+            self._nicks[id] = None
+            self._free.append(id)
+
+    def rename(self, before, after):
+        id = self._ids.pop(_fold(before), None)
+        if id is None:
+            return
+
+        self._ids[_fold(after)] = id
+        self._nicks[id] = after
+
+    def clear(self):
+        self._ids.clear()
+        self._nicks.clear()
+        self._refs = array.array('I')
+        self._free.clear()
+
+class CompactChannel:
+    '''
+    A channel's members as a sorted array of NickTable ids, with the same
+    query methods as irc.bot.Channel.
+
+    Members listed by NAMES are collected unsorted until the end of the
+    list, then merged in one pass, so a large channel costs one sort
+    instead of an insertion per user.
+    '''
+
+    def __init__(self, nicks):
+        self._nicks = nicks
+        self._members = array.array('I')
+        self._pending = array.array('I')
+        # Id -> user modes, for members that have any
+        self._user_modes = {}
+        self.modes = {}
+
+    def __len__(self):
+        self._merge()
+        return len(self._members)
+
+    def _find(self, id):
+        i = bisect.bisect_left(self._members, id)
+        if i < len(self._members) and self._members[i] == id:
+            return i
+        return None
+
+    def _has(self, id):
+        return self._find(id) is not None or id in self._pending
+
+    def _merge(self):
+        if not self._pending:
+            return
+
+        merged = set(self._members)
+        for id in self._pending:
+            if id in merged:
+                # Listed again, e.g. by a second NAMES
+                self._nicks.release(id)
+            else:
+                merged.add(id)
+
+        self._members = array.array('I', sorted(merged))
+        self._pending = array.array('I')
+
+    def users(self):
+        self._merge()
+        return [self._nicks.nick(id) for id in self._members]
+
+    def _with_mode(self, mode):
+        return [
+            self._nicks.nick(id)
+            for id, modes in self._user_modes.items()
+            if mode in modes
+        ]
+
+    def opers(self):
+        return self._with_mode('o')
+
+    def voiced(self):
+        return self._with_mode('v')
+
+    def owners(self):
+        return self._with_mode('q')
+
+    def halfops(self):
+        return self._with_mode('h')
+
+    def admins(self):
+        return self._with_mode('a')
+
+    def has_user(self, nick):
+        id = self._nicks.id(nick)
+        return id is not None and self._has(id)
+
+    def _has_mode(self, nick, mode):
+        id = self._nicks.id(nick)
+        return id is not None and mode in self._user_modes.get(id, '')
+
+    def is_oper(self, nick):
+        return self._has_mode(nick, 'o')
+
+    def is_voiced(self, nick):
+        return self._has_mode(nick, 'v')
+
+    def is_owner(self, nick):
+        return self._has_mode(nick, 'q')
+
+    def is_halfop(self, nick):
+        return self._has_mode(nick, 'h')
+
+    def is_admin(self, nick):
+        return self._has_mode(nick, 'a')
+
+    def add_user(self, nick):
+        id = self._nicks.id(nick)
+        if id is not None and self._has(id):
+            return
+
+        id = self._nicks.acquire(nick)
+        bisect.insort(self._members, id)
+
+    def add_names(self, nicks):
+        '''
+        Add members from a NAMES reply: (nick, user modes) pairs
+        '''
+
+        for nick, modes in nicks:
+            id = self._nicks.acquire(nick)
+            self._pending.append(id)
+            if modes:
+                self._user_modes[id] = modes
+
+    def end_names(self):
+        self._merge()
+
+    def remove_user(self, nick):
+        id = self._nicks.id(nick)
+        if id is None:
+            return
+
+        self._merge()
+        i = self._find(id)
+        if i is None:
+            return
+
+        del self._members[i]
+        self._user_modes.pop(id, None)
+        self._nicks.release(id)
+
+    def clear_users(self):
+        self._merge()
+        for id in self._members:
+            self._nicks.release(id)
+        self._members = array.array('I')
+        self._user_modes.clear()
+
+    def set_mode(self, mode, value=None):
+        if mode not in USER_MODES:
+            self.modes[mode] = value
+            return
+
+        id = self._nicks.id(value)
+        if id is not None and mode not in self._user_modes.get(id, ''):
+            self._user_modes[id] = self._user_modes.get(id, '') + mode
+
+    def clear_mode(self, mode, value=None):
+        if mode not in USER_MODES:
+            self.modes.pop(mode, None)
+            return
+
+        id = self._nicks.id(value)
+        modes = self._user_modes.get(id, '').replace(mode, '')
+        if modes:
+            self._user_modes[id] = modes
+        else:
+            self._user_modes.pop(id, None)
+
+    def has_mode(self, mode):
+        return mode in self.modes
+
+    def limit(self):
+        return self.modes.get('l')
+
+    def has_key(self):
+        return self.has_mode('k')
+
+class ChannelStore(irc.dict.IRCDict):
+    '''
+    Replacement for SingleServerIRCBot's `channels`, selected with
+    ChannelState = compact in a bot's [irc] section: a case-insensitive
+    dict of channel name to CompactChannel, all sharing one NickTable.
+    Memory grows with the number of distinct users rather than users
+    times channels.
+
+    attach() has the store follow the connection's JOIN, PART, KICK, QUIT,
+    NICK, MODE and NAMES events in place of the bot's own handlers.
+    '''
+
+    EVENTS = (
+        'join',
+        'kick',
+        'mode',
+        'namreply',
+        'endofnames',
+        'nick',
+        'part',
+        'quit'
+    )
+
+    def __init__(self):
+        super().__init__()
+        self.nicks = NickTable()
+
+    def attach(self, connection, bot=None):
+        '''
+        Handle the connection's channel events, removing bot's _on_<event>
+        handlers if it has registered them
+        '''
+
+        for event in self.EVENTS:
+            if bot is not None and hasattr(bot, '_on_' + event):
+                connection.remove_global_handler(
+                        event,
+                        getattr(bot, '_on_' + event)
+                )
+            connection.add_global_handler(
+                    event,
+                    getattr(self, '_on_' + event),
+                    -20
+            )
+
+    def clear(self):
+        super().clear()
+        self.nicks.clear()
+
+    @property
+    def memberships(self):
+        '''
+        Total number of channel members, counting a user once per channel
+        '''
+
+        return sum(len(channel) for channel in self.values())
+
+    def _remove_channel(self, name):
+        channel = self.pop(name, None)
+        if channel is not None:
+            channel.clear_users()
+
+    def _on_join(self, connection, event):
+        if event.source.nick == connection.get_nickname():
+            self._remove_channel(event.target)
+            self[event.target] = CompactChannel(self.nicks)
+        elif event.target not in self:
+            return
+        self[event.target].add_user(event.source.nick)
+
+    def _on_kick(self, connection, event):
+        if event.arguments[0] == connection.get_nickname():
+            self._remove_channel(event.target)
+        elif event.target in self:
+            self[event.target].remove_user(event.arguments[0])
+
+    def _on_part(self, connection, event):
+        if event.source.nick == connection.get_nickname():
+            self._remove_channel(event.target)
+        elif event.target in self:
+            self[event.target].remove_user(event.source.nick)
+
+    def _on_quit(self, connection, event):
+        if event.source.nick not in self.nicks:
+            return
+        for channel in self.values():
+            channel.remove_user(event.source.nick)
+
+    def _on_nick(self, connection, event):
+        self.nicks.rename(event.source.nick, event.target)
+
+    def _on_mode(self, connection, event):
+        channel = self.get(event.target)
+        if channel is None:
+            return
+
+        modes = irc.modes.parse_channel_modes(' '.join(event.arguments))
+        for sign, mode, argument in modes:
+            if sign == '+':
+                channel.set_mode(mode, argument)
+            else:
+                channel.clear_mode(mode, argument)
+
+    def _on_namreply(self, connection, event):
+        _, name, names = event.arguments
+        channel = self.get(name)
+        if channel is None:
+            return
+
+        prefix = connection.features.prefix
+        members = []
+        for nick in names.split():
+            modes = ''
+            while nick and nick[0] in prefix:
+                modes += prefix[nick[0]]
+                nick = nick[1:]
+            # userhost-in-names sends nick!user@host
+            nick = nick.partition('!')[0]
+            if nick:
+                members.append((nick, modes))
+
+        channel.add_names(members)
+
+    def _on_endofnames(self, connection, event):
+        channel = self.get(event.arguments[0])
+        if channel is not None:
+            channel.end_names()
@@ -0,0 +1,285 @@
+import collections
+import gzip
+import irc.strings
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+
+log = logging.getLogger('bavi.chatlog')
+
+# Records waiting to be written before new ones are dropped
+DEFAULT_MAX_QUEUE = 10000
+
+# Wake the writer early once this many records are waiting
+BATCH_SIZE = 512
+
+# Log files kept open at once; the least recently written is closed first
+MAX_OPEN_FILES = 64
+
+# How often (in seconds) to log that records were dropped
+DROP_WARNING_INTERVAL = 60
+
+def safe_name(name):
+    '''
+    Make a network or channel name usable as a single path component
+    '''
+
+    name = name.replace(os.sep, '_').replace('\0', '_')
+    if os.altsep:
+        name = name.replace(os.altsep, '_')
+    if name in { '', '.', '..' }:
+        name = '_' + name
+    return name
+
+class ChatLog:
+    '''
+    Asynchronous chat log writer.
+
+    record() only appends to an in-memory queue, so it is cheap enough to
+    call from the reactor thread for every line.  A background thread
+    writes queued records in batches to one file per channel per day,
+    <directory>/<network>/<channel>/<YYYY-MM-DD>.log, and fsyncs them every
+    fsync_interval seconds.  When a channel's log rolls over to a new day,
+    the previous file is gzipped by a second thread.
+
+    If more than max_queue records are waiting because the disk cannot
+    keep up, new records are dropped (and counted in `dropped`) rather than
+    blocking the caller or growing without bound.
+    '''
+
+    def __init__(self, directory, max_queue=DEFAULT_MAX_QUEUE,
+            flush_interval=1.0, fsync_interval=10.0, compress=True,
+            clock=time.time):
+        self.directory = directory
+        self._max_queue = max_queue
+        self._flush_interval = flush_interval
+        self._fsync_interval = fsync_interval
+        self._compress = compress
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._wake = threading.Event()
+        self._stopping = False
+
+        # (network, channel) -> (day, file), least recently written first
+        self._files = collections.OrderedDict()
+        self._dirty = set()
+        self._last_fsync = time.monotonic()
+        self._last_drop_warning = 0
+
+        self._rotated = queue.Queue()
+        self.written = 0
+        self.dropped = 0
+        self.compressed = 0
+
+        self._writer = threading.Thread(
+                target=self._run,
+                name='bavi-chatlog',
+                daemon=True
+        )
+        self._compressor = threading.Thread(
+                target=self._run_compressor,
+                name='bavi-chatlog-gzip',
+                daemon=True
+        )
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def start(self):
+        self._writer.start()
+        self._compressor.start()
+        if self._compress:
+            self._compress_stale()
+
+    def record(self, network, channel, nick, message, kind='PRIVMSG'):
+        '''
+        Queue a line for the log.  Never blocks; returns False if the line
+        was dropped because the queue is full.
+        '''
+
+        entry = (self._clock(), network, channel, nick, message, kind)
+
+        with self._lock:
+            if self._stopping or len(self._pending) >= self._max_queue:
+                self.dropped += 1
+                self._warn_dropped()
+                return False
+
+            self._pending.append(entry)
+            if len(self._pending) >= BATCH_SIZE:
+                self._wake.set()
+
+        return True
+
+    def _warn_dropped(self):
+        now = time.monotonic()
+        if now - self._last_drop_warning >= DROP_WARNING_INTERVAL:
+            self._last_drop_warning = now
+            log.warning(
+                    'Chat log is falling behind; %d line(s) dropped so far',
+                    self.dropped
+            )
+
+    def close(self):
+        '''
+        Write everything that is queued, fsync and close all files, and
+        wait for pending compression to finish.
+        '''
+
+        with self._lock:
+            self._stopping = True
+        self._wake.set()
+        self._writer.join()
+
+        self._rotated.put(None)
+        self._compressor.join()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self._flush_interval)
+            self._wake.clear()
+
+            with self._lock:
+                batch = self._pending
+                self._pending = collections.deque()
+                stopping = self._stopping
+
+            try:
+                self._write_batch(batch)
+                self._rotate_idle()
+                if stopping or time.monotonic() - self._last_fsync >= \
+                        self._fsync_interval:
+                    self._fsync()
+            except OSError as e:
+                log.error('Failed to write chat log', exc_info=e)
+
+            if stopping:
+                for day, f in self._files.values():
+                    f.close()
+                self._files.clear()
+                return
+
+    def _write_batch(self, batch):
+        for when, network, channel, nick, message, kind in batch:
+            t = time.localtime(when)
+            day = time.strftime('%Y-%m-%d', t)
+            f = self._file(network, channel, day)
+
+            if kind == 'ACTION':
+                line = '{} * {} {}\n'.format(
+                        time.strftime('%H:%M:%S', t),
+                        nick,
+                        message
+                )
+            else:
+                line = '{} <{}> {}\n'.format(
+                        time.strftime('%H:%M:%S', t),
+                        nick,
+                        message
+                )
+
+            f.write(line)
+            self.written += 1
+
+        for f in self._dirty:
+            f.flush()
+
+    def _file(self, network, channel, day):
+        channel = irc.strings.lower(channel)
+        key = (network, channel)
+        entry = self._files.get(key)
+
+        if entry is not None:
+            self._files.move_to_end(key)
+            if entry[0] == day:
+                self._dirty.add(entry[1])
+                return entry[1]
+
+            # The channel rolled over to a new day
+            self._close_file(entry[1])
+            self._rotated.put(entry[1].name)
+            del self._files[key]
+
+        path = os.path.join(
+                self.directory,
+                safe_name(network),
+                safe_name(channel)
+        )
+        os.makedirs(path, exist_ok=True)
+        f = open(
+                os.path.join(path, day + '.log'),
+                'a',
+                encoding='utf-8',
+                errors='replace'
+        )
+        self._files[key] = (day, f)
+        self._dirty.add(f)
+
+        today = time.strftime('%Y-%m-%d', time.localtime(self._clock()))
+        while len(self._files) > MAX_OPEN_FILES:
+            _, (old_day, old) = self._files.popitem(last=False)
+            self._close_file(old)
+            # The channel will not write to a past day's file again
+            if old_day < today:
+                self._rotated.put(old.name)
+
+        return f
+
+    def _rotate_idle(self):
+        '''
+        Roll over files of channels that have been quiet since midnight
+        '''
+
+        today = time.strftime('%Y-%m-%d', time.localtime(self._clock()))
+        for key, (day, f) in list(self._files.items()):
+            if day < today:
+                self._close_file(f)
+                self._rotated.put(f.name)
+                del self._files[key]
+
+    def _close_file(self, f):
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        self._dirty.discard(f)
+
+    def _fsync(self):
+        for f in self._dirty:
+            os.fsync(f.fileno())
+        self._dirty.clear()
+        self._last_fsync = time.monotonic()
+
+    def _compress_stale(self):
+        '''
+        Queue uncompressed logs from earlier days, e.g. left behind by a
+        crash or a restart that spanned midnight.
+        '''
+
+        today = time.strftime('%Y-%m-%d', time.localtime(self._clock()))
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.log') and name[:-4] < today:
+                    self._rotated.put(os.path.join(root, name))
+
+    def _run_compressor(self):
+        while True:
+            path = self._rotated.get()
+            if path is None:
+                return
+            if not self._compress:
+                continue
+
+            try:
+                with open(path, 'rb') as src:
+                    with gzip.open(path + '.gz', 'ab') as dst:
+                        shutil.copyfileobj(src, dst)
+                os.unlink(path)
+                self.compressed += 1
+            except OSError as e:
+                log.error('Failed to compress %s', path, exc_info=e)
@@ -0,0 +1,135 @@
+import collections
+
+# Number of resolved command words to remember
+RESOLVE_CACHE_SIZE = 256
+
+class AmbiguousCommand(KeyError):
+    '''
+    Raised when an abbreviation matches more than one command
+    '''
+
+    def __init__(self, prefix, candidates):
+        KeyError.__init__(self, prefix)
+        self.prefix = prefix
+        self.candidates = candidates
+
+class CommandTrie:
+    '''
+    Mapping of command names to handlers that also resolves unambiguous
+    abbreviations, e.g. "ti" to "title" if no other command starts with
+    "ti".
+
+    Resolved words are cached until the set of commands changes, so the
+    trie is only walked the first time a word is seen.
+    '''
+
+    _END = ''
+
+    def __init__(self):
+        self._commands = {}
+        self._root = {}
+        self._cache = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __iter__(self):
+        return iter(self._commands)
+
+    def __contains__(self, name):
+        return name in self._commands
+
+    def __getitem__(self, name):
+        return self._commands[name]
+
+    def get(self, name, default=None):
+        return self._commands.get(name, default)
+
+    def items(self):
+        return self._commands.items()
+
+    def __setitem__(self, name, handler):
+        if not name:
+            raise ValueError('Command name must not be empty')
+
+        if name in self._commands:
+            del self[name]
+
+        self._commands[name] = handler
+        node = self._root
+        for ch in name:
+            node = node.setdefault(ch, {})
+        node[self._END] = name
+        self._cache.clear()
+
+    def __delitem__(self, name):
+        del self._commands[name]
+
+        path = [self._root]
+        for ch in name:
+            path.append(path[-1][ch])
+        del path[-1][self._END]
+
+        # Prune nodes that no longer lead to any command; path[i] is the
+        # node reached after name[:i]
+        for i in range(len(name), 0, -1):
+            if path[i]:
+                break
+            del path[i - 1][name[i - 1]]
+
+        self._cache.clear()
+
+    def _names_below(self, node):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for ch, child in node.items():
+                if ch == self._END:
+                    yield child
+                else:
+                    stack.append(child)
+
+    def resolve(self, word):
+        '''
+        Return the (name, handler) pair for word, which may be a command
+        name or an unambiguous abbreviation of one.
+
+        Raises KeyError if nothing matches and AmbiguousCommand if several
+        commands with different handlers match.
+        '''
+
+        result = self._cache.get(word)
+        if result is None:
+            result = self._resolve(word)
+            self._cache[word] = result
+            if len(self._cache) > RESOLVE_CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+        name, candidates = result
+        if name is not None:
+            return name, self._commands[name]
+        if candidates:
+            raise AmbiguousCommand(word, candidates)
+        raise KeyError(word)
+
+    def _resolve(self, word):
+        # Returns (name, None) on success, otherwise (None, candidates)
+        if word in self._commands:
+            return word, None
+
+        if not word:
+            return None, []
+
+        node = self._root
+        for ch in word:
+            node = node.get(ch)
+            if node is None:
+                return None, []
+
+        names = sorted(self._names_below(node))
+        handlers = set(self._commands[name] for name in names)
+        if len(handlers) > 1:
+            return None, names
+
+        # All candidates are aliases for the same handler
+        return names[0], None
@@ -0,0 +1,361 @@
+import concurrent.futures
+import contextlib
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+from .migrations import migrate
+from .writebehind import WriteBehind
+
+log = logging.getLogger('bavi.db')
+
+# Most writes committed in one transaction
+MAX_BATCH = 1000
+
+class Database:
+    '''
+    The bot's SQLite database.
+
+    Reads go through a connection per thread, so handlers on worker
+    threads never share one.  Writes are passed to a single writer thread
+    with write(), which runs them in the order they were submitted.  The
+    writer commits several handlers' writes together: everything that is
+    waiting when it starts a transaction, plus whatever arrives within
+    `commit_interval` seconds.  write() returns once its transaction has
+    been committed, so a burst of writes pays for one fsync instead of one
+    each.
+
+    Each write runs inside a savepoint, so one that raises is rolled back
+    without affecting the others committed with it.
+
+    Connections use WAL journaling, so reads are not blocked by the
+    writer, and synchronous=NORMAL, which only syncs at checkpoints.
+    sqlite3 caches up to `cached_statements` prepared statements per
+    connection, keyed by their SQL, so queries should use parameters
+    rather than formatting values into the SQL.
+
+    An in-memory database exists only for the connection that created it,
+    so for ':memory:' every thread shares one connection, and writes run
+    on the calling thread, each in its own savepoint, while holding a lock.
+    Code that makes its own transactions on connect()'s connection must
+    hold exclusive() around them too.
+    '''
+
+    def __init__(self, filename, journal_mode='WAL', synchronous='NORMAL',
+            commit_interval=0.01, cached_statements=256, busy_timeout=5.0,
+            max_pending=1000, pending_timeout=5.0, metrics=None):
+        self.filename = filename
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.commit_interval = commit_interval
+        self.cached_statements = cached_statements
+        self.busy_timeout = busy_timeout
+        self.max_pending = max_pending
+        self.pending_timeout = pending_timeout
+        self.metrics = metrics
+
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._memory_lock = threading.RLock()
+        self._jobs = queue.Queue()
+        self._thread = None
+        self._closed = False
+        # Name -> WriteBehind
+        self._queues = {}
+
+        self.commits = 0
+        self.writes = 0
+
+        self._writer = self.connect()
+
+    @classmethod
+    def from_config(cls, config, metrics=None):
+        '''
+        A Database configured from the [sqlite3] section.  Write-behind
+        queues report to metrics, if given.
+        '''
+
+        return cls(
+                config.get('sqlite3', 'Filename', fallback=':memory:'),
+                journal_mode=config.get('sqlite3', 'JournalMode',
+                    fallback='WAL'),
+                synchronous=config.get('sqlite3', 'Synchronous',
+                    fallback='NORMAL'),
+                commit_interval=config.getfloat('sqlite3', 'CommitInterval',
+                    fallback=0.01),
+                cached_statements=config.getint('sqlite3', 'StatementCache',
+                    fallback=256),
+                busy_timeout=config.getfloat('sqlite3', 'BusyTimeout',
+                    fallback=5.0),
+                max_pending=config.getint('sqlite3', 'MaxPending',
+                    fallback=1000),
+                pending_timeout=config.getfloat('sqlite3', 'PendingTimeout',
+                    fallback=5.0),
+                metrics=metrics
+        )
+
+    @property
+    def in_memory(self):
+        return self.filename == ':memory:'
+
+    def connect(self):
+        '''
+        A new connection with the database's settings, e.g. for a module
+        that runs its own writer thread.  For an in-memory database this
+        is the shared connection; see exclusive().
+        '''
+
+        if self.in_memory and getattr(self, '_writer', None) is not None:
+            return self._writer
+
+        conn = sqlite3.connect(
+                self.filename,
+                timeout=self.busy_timeout,
+                check_same_thread=False,
+                cached_statements=self.cached_statements
+        )
+        if not self.in_memory:
+            conn.execute('PRAGMA journal_mode = {}'.format(
+                self.journal_mode
+            ))
+        conn.execute('PRAGMA synchronous = {}'.format(self.synchronous))
+
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def exclusive(self):
+        '''
+        A context manager to hold around a transaction made on a connection
+        from connect().  For an in-memory database, whose connection is
+        shared, it keeps other threads' writes out of the transaction; for
+        a file, SQLite's own locking does that and it does nothing.
+        '''
+
+        if self.in_memory:
+            return self._memory_lock
+        return contextlib.nullcontext()
+
+    def connection(self):
+        '''
+        This thread's connection, for reads
+        '''
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self.connect()
+        return conn
+
+    def execute(self, sql, params=()):
+        '''
+        Run a query on this thread's connection and return the cursor
+        '''
+
+        return self.connection().execute(sql, params)
+
+    def write(self, fn, *args):
+        '''
+        Run fn(conn, *args) on the writer thread and wait for its
+        transaction to be committed.  Returns what fn returned, or raises
+        what it raised.
+        '''
+
+        if threading.current_thread() is self._thread:
+            # A write made by another write joins its transaction
+            return fn(self._writer, *args)
+
+        return self.submit(fn, *args).result()
+
+    def submit(self, fn, *args):
+        '''
+        Like write(), but return a concurrent.futures.Future instead of
+        waiting for the commit
+        '''
+
+        if self._closed:
+            raise RuntimeError('Database is closed')
+
+        future = concurrent.futures.Future()
+        if self.in_memory:
+            with self._memory_lock:
+                outcome = self._run_job(fn, args, future)
+            if outcome is not None:
+                self.writes += 1
+                future.set_result(outcome[1])
+            return future
+
+        self._start()
+        self._jobs.put((fn, args, future))
+        return future
+
+    def execute_write(self, sql, params=()):
+        '''
+        write() a single statement.  Returns the number of rows changed.
+        '''
+
+        return self.write(_execute, sql, params)
+
+    def migrate(self, module, migrations):
+        '''
+        Apply module's pending schema migrations (see
+        bavi.migrations.migrate()) in one write, so they are committed
+        all together or not at all.  Returns the module's schema version.
+        '''
+
+        return self.write(migrate, module, migrations)
+
+    def write_behind(self, name):
+        '''
+        The WriteBehind queue called name, created on first use so that it
+        survives a module reload
+        '''
+
+        with self._lock:
+            writes = self._queues.get(name)
+            if writes is not None:
+                return writes
+
+            writes = self._queues[name] = WriteBehind(
+                    self,
+                    name,
+                    max_pending=self.max_pending,
+                    timeout=self.pending_timeout
+            )
+
+        if self.metrics is not None:
+            labels = { 'queue': name }
+            self.metrics.add_gauge('db_write_behind_pending', labels,
+                    lambda: writes.pending)
+            self.metrics.add_gauge('db_write_behind_oldest_seconds', labels,
+                    writes.oldest)
+            self.metrics.add_histogram('db_write_behind_lag_seconds', labels,
+                    writes.lag)
+            self.metrics.add_gauge('db_write_behind_written', labels,
+                    lambda: writes.written, kind='counter')
+            self.metrics.add_gauge('db_write_behind_failed', labels,
+                    lambda: writes.failed, kind='counter')
+            self.metrics.add_gauge('db_write_behind_rejected', labels,
+                    lambda: writes.rejected, kind='counter')
+        return writes
+
+    def flush(self):
+        '''
+        Wait until every write submitted so far has been committed
+        '''
+
+        if self._thread is not None and not self._closed:
+            self.submit(_noop).result()
+
+    def close(self):
+        '''
+        Commit pending writes, stop the writer thread and close every
+        connection
+        '''
+
+        if self._closed:
+            return
+
+        self._closed = True
+        if self._thread is not None:
+            self._jobs.put(None)
+            self._thread.join()
+
+        with self._lock:
+            connections = self._connections
+            self._connections = []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                log.warning('Failed to close database connection: %s', e)
+
+    def _start(self):
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                        target=self._run,
+                        name='bavi-db-writer',
+                        daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            job = self._jobs.get()
+            if job is None:
+                return
+
+            # Jobs taken from the queue and (future, result) of the writes
+            # that succeeded
+            jobs = [job]
+            done = []
+            try:
+                self._writer.execute('BEGIN IMMEDIATE')
+                deadline = time.monotonic() + self.commit_interval
+                while True:
+                    outcome = self._run_job(*job)
+                    if outcome is not None:
+                        done.append(outcome)
+                    if len(jobs) >= MAX_BATCH:
+                        break
+
+                    try:
+                        job = self._jobs.get(
+                                timeout=max(0, deadline - time.monotonic())
+                        )
+                    except queue.Empty:
+                        break
+
+                    if job is None:
+                        stopping = True
+                        break
+                    jobs.append(job)
+
+                self._writer.commit()
+            except Exception as e:
+                # Keep the writer running, so later writes (and close())
+                # are not left waiting forever
+                log.error('Failed to commit %d write(s)', len(jobs),
+                        exc_info=e)
+                try:
+                    self._writer.rollback()
+                except sqlite3.Error:
+                    pass
+                for fn, args, future in jobs:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.commits += 1
+            self.writes += len(done)
+            for future, result in done:
+                future.set_result(result)
+
+    def _run_job(self, fn, args, future):
+        if not future.set_running_or_notify_cancel():
+            return None
+
+        self._writer.execute('SAVEPOINT write')
+        try:
+            result = fn(self._writer, *args)
+        except BaseException as e:
+            self._writer.execute('ROLLBACK TO write')
+            self._writer.execute('RELEASE write')
+            future.set_exception(e)
+            return None
+
+        self._writer.execute('RELEASE write')
+        return future, result
+
+def _execute(conn, sql, params):
+    return conn.execute(sql, params).rowcount
+
+def _noop(conn):
+    pass
@@ -1,25 +1,20 @@
-def create_audit_trigger(c, table_name, pk):
-    insert_trigger = '''
-            CREATE TRIGGER IF NOT EXISTS {table_name}_insert_aud
-            AFTER INSERT ON {table_name} FOR EACH ROW
-            BEGIN
-                UPDATE {table_name}
-                   SET created_at = DATETIME(),
-                       updated_at = DATETIME()
-                 WHERE {pk} = NEW.{pk};
-            END;
-    '''.format(table_name=table_name, pk=pk)
+def table_exists(conn, table_name):
+    row = conn.execute('''
+            SELECT 1
+              FROM sqlite_master
+             WHERE type = 'table' AND name = ?
+    ''', (table_name,)).fetchone()
+    return row is not None
 
-    c.execute(insert_trigger)
+def drop_audit_triggers(conn, table_name):
+    '''
+    Drop the triggers that used to maintain created_at and updated_at with
+    a second UPDATE of every row written.  Tables now give those columns a
+    DEFAULT, and updates set updated_at themselves.
+    '''
 
-    update_trigger = '''
-            CREATE TRIGGER IF NOT EXISTS {table_name}_update_aud
-            AFTER UPDATE ON {table_name} FOR EACH ROW
-            BEGIN
-                UPDATE {table_name}
-                   SET updated_at = DATETIME()
-                 WHERE {pk} = NEW.{pk};
-            END;
-    '''.format(table_name=table_name, pk=pk)
-
-    c.execute(update_trigger)
+    for suffix in ['insert_aud', 'update_aud']:
+        conn.execute('DROP TRIGGER IF EXISTS {}_{}'.format(
+            table_name,
+            suffix
+        ))
@@ -0,0 +1,106 @@
+import irc.client
+
+# RFC 1459 limit on the length of a line, including the trailing CRLF
+MAX_LINE_BYTES = 512
+
+# Used for our own user@host until the server tells us what it is; these
+# are the usual USERLEN and HOSTLEN limits
+DEFAULT_USER_LENGTH = 10
+DEFAULT_HOST_LENGTH = 63
+
+# Removes NUL, CR and LF, which would end or corrupt the line
+SANITIZE_TABLE = str.maketrans('', '', '\0\r\n')
+
+def sanitize(message):
+    '''
+    Sanitize a message according to RFC 1459 by removing
+    NUL, CR, and LF characters
+    '''
+
+    return message.translate(SANITIZE_TABLE)
+
+def split_utf8(data, limit):
+    '''
+    Split UTF-8 encoded bytes into chunks of at most `limit` bytes.
+
+    Chunks never end in the middle of a multibyte character.  Where
+    possible they end at a space, which is then dropped.
+    '''
+
+    chunks = []
+    start = 0
+    length = len(data)
+
+    while length - start > limit:
+        end = start + limit
+
+        # Continuation bytes look like 0b10xxxxxx
+        while end > start and data[end] & 0xC0 == 0x80:
+            end -= 1
+
+        space = data.rfind(b' ', start, end + 1)
+        if space > start:
+            chunks.append(data[start:space])
+            start = space + 1
+        else:
+            chunks.append(data[start:end])
+            start = end
+
+    chunks.append(data[start:])
+    return chunks
+
+class LineEncoder:
+    '''
+    Sanitizes, encodes and splits outgoing PRIVMSG text so that every line
+    fits in 512 bytes once the server has added our nick!user@host prefix.
+
+    The space left for text depends on the target and on our own hostmask,
+    so it is cached per target and recomputed when the hostmask changes.
+    '''
+
+    def __init__(self, nick=''):
+        self._budgets = {}
+        self.set_source(nick)
+
+    def set_source(self, source):
+        '''
+        Set our own nick or nick!user@host, as last seen from the server
+        '''
+
+        mask = irc.client.NickMask(source)
+        if mask.user is None or mask.host is None:
+            length = len(mask.nick.encode('utf-8')) + 2 + \
+                    DEFAULT_USER_LENGTH + DEFAULT_HOST_LENGTH
+        else:
+            length = len(mask.encode('utf-8'))
+
+        self._source_length = length
+        self._budgets.clear()
+
+    def budget(self, target):
+        '''
+        Number of bytes of text that fit in one PRIVMSG to target
+        '''
+
+        budget = self._budgets.get(target)
+        if budget is None:
+            # ":<source> PRIVMSG <target> :<text>\r\n"
+            overhead = 1 + self._source_length + len(' PRIVMSG ') + \
+                    len(target.encode('utf-8')) + len(' :\r\n')
+            budget = self._budgets[target] = MAX_LINE_BYTES - overhead
+
+        return budget
+
+    def encode(self, target, message):
+        '''
+        Sanitize message and split it into lines for target.
+
+        Returns a list of (text, size) tuples, where size is the encoded
+        length of text in bytes.
+        '''
+
+        data = sanitize(message).encode('utf-8')
+        return [
+            (chunk.decode('utf-8'), len(chunk))
+            for chunk in split_utf8(data, self.budget(target))
+        ]
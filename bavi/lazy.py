@@ -0,0 +1,53 @@
+import importlib
+import sys
+import types
+
+class LazyModule(types.ModuleType):
+    '''
+    Stand-in for a module that is only imported when one of its attributes
+    is first used.
+
+    Attributes are looked up on the real module and then cached on the
+    stand-in.  The import itself goes through importlib, whose per-module
+    locks make the first access safe from several worker threads at once
+    (unlike importlib.util.LazyLoader before Python 3.12).
+    '''
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        if attr.startswith('__') and attr.endswith('__'):
+            # Keep introspection (e.g. by mock or pickle) from importing
+            # the module
+            raise AttributeError(attr)
+
+        value = getattr(self._load(), attr)
+        setattr(self, attr, value)
+        return value
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_lazy_module'] else 'not loaded'
+        return '<lazy module {!r} ({})>'.format(self.__name__, state)
+
+def lazy_import(name):
+    '''
+    Return module `name` if it has already been imported, otherwise a
+    LazyModule that imports it on first use.  Use it at the top of a bot
+    module for dependencies only its handlers need, so loading the module
+    (and registering its commands) stays cheap.
+    '''
+
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+
+    return LazyModule(name)
@@ -0,0 +1,272 @@
+import collections
+import importlib.util
+import json
+import logging
+import os
+import re
+
+try:
+    import importlib.metadata as importlib_metadata
+except ImportError:
+    # Python < 3.8
+    import importlib_metadata
+
+log = logging.getLogger('bavi.manifest')
+
+# Third-party packages make modules available to the bot by declaring an
+# entry point in this group, e.g. in setup.cfg:
+#
+#   [options.entry_points]
+#   bavi.modules =
+#       weather = bavi_weather.module
+ENTRY_POINT_GROUP = 'bavi.modules'
+
+MODULES_DIR = os.path.join(os.path.dirname(__file__), 'modules')
+
+# Bump when the format of cache entries changes
+CACHE_VERSION = 2
+
+ModuleSpec = collections.namedtuple(
+        'ModuleSpec',
+        ['name', 'import_name', 'path']
+)
+
+def discover_modules():
+    '''
+    List the modules the bot can load, without importing them: every file
+    in bavi/modules, followed by the modules of installed packages that
+    declare a "bavi.modules" entry point.  Built-in modules win over
+    third-party modules of the same name.
+    '''
+
+    specs = collections.OrderedDict()
+
+    for f in sorted(os.listdir(MODULES_DIR)):
+        if f.endswith('.py') and f != '__init__.py':
+            name = f[:-3]
+            specs[name] = ModuleSpec(
+                    name,
+                    'bavi.modules.' + name,
+                    os.path.join(MODULES_DIR, f)
+            )
+
+    for entry_point in _entry_points():
+        if entry_point.name in specs:
+            log.warning(
+                    'Ignoring module "%s" from %s; a module with that name '
+                    'is already loaded',
+                    entry_point.name,
+                    entry_point.value
+            )
+            continue
+
+        import_name = entry_point.value.partition(':')[0].strip()
+        spec = _find_spec(entry_point.name, import_name)
+        if spec is not None:
+            specs[spec.name] = spec
+
+    return list(specs.values())
+
+def find_module(name):
+    '''
+    The ModuleSpec of module `name`, or None if there is no such module
+    '''
+
+    for spec in discover_modules():
+        if spec.name == name:
+            return spec
+    return None
+
+def _entry_points():
+    entry_points = importlib_metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        return sorted(
+                entry_points.select(group=ENTRY_POINT_GROUP),
+                key=lambda entry_point: entry_point.name
+        )
+
+    # Python < 3.10 returns a dict of group name to entry points
+    return sorted(
+            entry_points.get(ENTRY_POINT_GROUP, []),
+            key=lambda entry_point: entry_point.name
+    )
+
+def _find_spec(name, import_name):
+    try:
+        spec = importlib.util.find_spec(import_name)
+    except (ImportError, ValueError) as e:
+        log.error('Cannot find module "%s" (%s)', name, import_name,
+                exc_info=e)
+        return None
+
+    if spec is None or not spec.origin:
+        log.error('Cannot find module "%s" (%s)', name, import_name)
+        return None
+
+    return ModuleSpec(name, import_name, spec.origin)
+
+class ModuleCache:
+    '''
+    What each module registers, saved between runs so the bot can set up
+    its dispatch tables without importing the modules.
+
+    An entry records a module's commands (with their aliases) and matchers
+    (with their pattern, flags and prefilter literal).  It is valid as long
+    as the module's file has the same mtime and size.  Modules that
+    register listeners or shutdown hooks have to run at startup, so they
+    are not cached.  For a module with schema migrations, the entry also
+    records how many it had, so the bot can tell whether the database
+    needs them.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        self._dirty = False
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.warning('Ignoring unreadable module cache %s: %s',
+                    self.path, e)
+            return
+
+        if not isinstance(data, dict) or \
+                data.get('version') != CACHE_VERSION:
+            log.info('Module cache %s is outdated; rebuilding it',
+                    self.path)
+            return
+
+        self._entries = data.get('modules', {})
+
+    def save(self):
+        if not self._dirty:
+            return
+
+        tmp = self.path + '.tmp'
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'version': CACHE_VERSION,
+                    'modules': self._entries
+                }, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.warning('Could not write module cache %s: %s', self.path, e)
+            return
+
+        self._dirty = False
+
+    def get(self, spec):
+        '''
+        The cached entry for spec, or None if there is none or the module's
+        file has changed since it was made
+        '''
+
+        entry = self._entries.get(spec.name)
+        if entry is None:
+            return None
+
+        if entry.get('import_name') != spec.import_name or \
+                entry.get('stamp') != _stamp(spec.path):
+            return None
+
+        return entry
+
+    def update(self, spec, registrations, literal, schema_version=None):
+        '''
+        Record what spec's module registered, as returned by
+        Registry.unregister().  literal(regex) returns a matcher's
+        prefilter literal.  schema_version is the number of migrations the
+        module has, if any.
+        '''
+
+        entry = describe(registrations, literal)
+        stamp = _stamp(spec.path)
+        if entry is None or stamp is None:
+            self.discard(spec.name)
+            return
+
+        entry['import_name'] = spec.import_name
+        entry['stamp'] = stamp
+        if schema_version is not None:
+            entry['schema_version'] = schema_version
+        if self._entries.get(spec.name) != entry:
+            self._entries[spec.name] = entry
+            self._dirty = True
+
+    def discard(self, name):
+        if self._entries.pop(name, None) is not None:
+            self._dirty = True
+
+    def retain(self, names):
+        '''
+        Drop entries for modules that no longer exist
+        '''
+
+        for name in list(self._entries):
+            if name not in names:
+                self.discard(name)
+
+def describe(registrations, literal):
+    '''
+    Turn a module's registrations into a cache entry, or None if they
+    cannot be replayed without running the module.  Handlers are numbered
+    in order of first registration, so aliases and matchers that share a
+    handler still share it.
+    '''
+
+    handlers = {}
+    commands = []
+    matchers = []
+
+    def index(handler):
+        return handlers.setdefault(id(handler), len(handlers))
+
+    for method, args, kwargs in registrations:
+        if method == 'add_command':
+            cmd, handler = args
+            commands.append({
+                'name': cmd,
+                'aliases': list(kwargs['aliases']),
+                'handler': index(handler),
+                'max_concurrency': kwargs['max_concurrency'],
+                'deadline': kwargs['deadline']
+            })
+        elif method == 'add_matcher':
+            regex, handler = args
+            if not isinstance(regex.pattern, str):
+                return None
+            matchers.append({
+                'pattern': regex.pattern,
+                'flags': regex.flags,
+                'literal': literal(regex),
+                'priority': kwargs['priority'],
+                'handler': index(handler),
+                'max_concurrency': kwargs['max_concurrency'],
+                'deadline': kwargs['deadline']
+            })
+        else:
+            return None
+
+    if not commands and not matchers:
+        return None
+
+    return { 'commands': commands, 'matchers': matchers }
+
+def compile_matcher(entry):
+    return re.compile(entry['pattern'], entry['flags'])
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
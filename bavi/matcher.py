@@ -0,0 +1,226 @@
+import bisect
+import fractions
+import logging
+import re
+
+try:
+    import re._parser as sre_parse
+    from re._constants import (
+            LITERAL,
+            SUBPATTERN,
+            MAX_REPEAT,
+            MIN_REPEAT
+    )
+except ImportError:
+    import sre_parse
+    from sre_constants import (
+            LITERAL,
+            SUBPATTERN,
+            MAX_REPEAT,
+            MIN_REPEAT
+    )
+
+log = logging.getLogger('bavi.matcher')
+
+PRIORITIES = { 'low', 'medium', 'high' }
+
+def required_literal(regex):
+    '''
+    Return the longest literal substring that must appear in any string
+    matched by the given compiled regex, or None if no such literal could
+    be determined.
+
+    Case-insensitive patterns never get a literal, since a plain substring
+    test cannot reproduce Unicode case folding.
+    '''
+
+    if not isinstance(regex.pattern, str):
+        return None
+    if regex.flags & re.IGNORECASE:
+        return None
+
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception:
+        log.debug('Could not parse pattern %s', regex.pattern)
+        return None
+
+    candidates = []
+    run = []
+
+    def end_run():
+        if run:
+            candidates.append(''.join(run))
+            del run[:]
+
+    def walk(items):
+        for op, av in items:
+            if op is LITERAL:
+                run.append(chr(av))
+            elif op is SUBPATTERN:
+                # Python 3.6+: (group, add_flags, del_flags, pattern)
+                if len(av) == 4 and av[1] & re.IGNORECASE:
+                    end_run()
+                else:
+                    walk(av[-1])
+            elif op in (MAX_REPEAT, MIN_REPEAT) and av[0] >= 1:
+                # The repeated item must appear at least once, but it is
+                # not contiguous with whatever surrounds it
+                end_run()
+                walk(av[2])
+                end_run()
+            else:
+                end_run()
+
+    walk(parsed)
+    end_run()
+
+    if not candidates:
+        return None
+
+    return max(candidates, key=len)
+
+class MatcherEngine:
+    '''
+    Ordered collection of (regex, handler) matchers.
+
+    Matchers are kept in priority order and the first one whose regex
+    matches a message wins.  To avoid running every regex against every
+    line, each pattern is reduced to a literal that it requires, and all
+    of those literals are merged into a single alternation.  A message that
+    contains none of the literals is rejected with one scan; otherwise only
+    the matchers whose literal is present are tried.
+
+    Each matcher has a sort key that fixes its place in the order.  add()
+    returns it, and remove() hands it back, so that a matcher can be put
+    back in the same place later, e.g. when its module is reloaded.
+    '''
+
+    def __init__(self):
+        self._matchers = []
+        # Sort key of each matcher, in the same order as _matchers
+        self._keys = []
+        self._compiled = None
+        # regex -> its required literal (or None), computed once
+        self._literals = {}
+
+    def __len__(self):
+        return len(self._matchers)
+
+    def __iter__(self):
+        return iter(self._matchers)
+
+    def add(self, regex, handler, priority='low', key=None):
+        '''
+        Add a matcher: at the end for low priority, at the front for high,
+        in the middle for medium, or at key if one is given.  Returns the
+        matcher's key.
+        '''
+
+        if priority not in PRIORITIES:
+            raise ValueError('priority must be low, medium, or high')
+
+        if key is None:
+            key = self._new_key(priority)
+
+        i = bisect.bisect_right(self._keys, key)
+        self._keys.insert(i, key)
+        self._matchers.insert(i, (regex, handler))
+        self._compiled = None
+        return key
+
+    def _new_key(self, priority):
+        keys = self._keys
+        if not keys:
+            return fractions.Fraction(0)
+
+        middle = len(keys) // 2
+        if priority == 'low':
+            return keys[-1] + 1
+        elif priority == 'high' or middle == 0:
+            return keys[0] - 1
+        else:
+            # Exact, so that repeated halving never runs out of precision
+            return (keys[middle - 1] + keys[middle]) / 2
+
+    def literal(self, regex):
+        '''
+        The literal used to prefilter messages for regex (see
+        required_literal())
+        '''
+
+        try:
+            return self._literals[regex]
+        except KeyError:
+            literal = self._literals[regex] = required_literal(regex)
+            return literal
+
+    def set_literal(self, regex, literal):
+        '''
+        Use a literal worked out earlier, e.g. read from the module cache,
+        instead of parsing regex again
+        '''
+
+        self._literals[regex] = literal
+        self._compiled = None
+
+    def remove(self, regex, handler):
+        '''
+        Remove a matcher added with add() and return its key.  Raises
+        ValueError if there is no such matcher.
+        '''
+
+        i = self._matchers.index((regex, handler))
+        del self._matchers[i]
+        self._compiled = None
+        return self._keys.pop(i)
+
+    def _compile(self):
+        entries = []
+        unfiltered = []
+        literals = set()
+
+        for regex, handler in self._matchers:
+            literal = self.literal(regex)
+            entry = (literal, regex, handler)
+            entries.append(entry)
+
+            if literal is None:
+                unfiltered.append(entry)
+            else:
+                literals.add(literal)
+
+        if literals:
+            gate = re.compile('|'.join(
+                re.escape(literal)
+                for literal in sorted(literals, key=len, reverse=True)
+            ))
+        else:
+            gate = None
+
+        self._compiled = (gate, entries, unfiltered)
+        return self._compiled
+
+    def match(self, message):
+        '''
+        Find the highest priority matcher for the given message.
+
+        Returns a (regex, handler, match) tuple, or None if nothing matched.
+        '''
+
+        gate, entries, unfiltered = self._compiled or self._compile()
+
+        if gate is None or gate.search(message) is None:
+            # None of the literals are present, so only the matchers
+            # without a prefilter can possibly match
+            entries = unfiltered
+
+        for literal, regex, handler in entries:
+            if literal is not None and literal not in message:
+                continue
+
+            match = regex.search(message)
+            if match:
+                return regex, handler, match
+
+        return None
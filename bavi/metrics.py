@@ -0,0 +1,361 @@
+import bisect
+import http.server
+import logging
+import threading
+import time
+
+log = logging.getLogger('bavi.metrics')
+
+# Upper bounds (in seconds) of the handler latency histogram buckets
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30
+)
+
+# Message rate is averaged over this many one-second slots
+RATE_WINDOW = 60
+
+class Histogram:
+    '''
+    Fixed-bucket histogram.  Recording a value is one bisect and two
+    additions, cheap enough to do for every handler call.
+    '''
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        '''
+        Estimate the q-quantile as the upper bound of the bucket it falls
+        in.  Returns None if nothing has been recorded, and infinity if it
+        falls past the last bucket.
+        '''
+
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+
+        return float('inf')
+
+class HandlerStats:
+    __slots__ = ('calls', 'errors', 'timeouts', 'latency')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.latency = Histogram()
+
+class RateCounter:
+    '''
+    Counts events in one-second slots to report a moving per-second rate
+    '''
+
+    def __init__(self, window=RATE_WINDOW, clock=time.monotonic):
+        self._window = window
+        self._clock = clock
+        self._slots = [0] * window
+        self._second = int(clock())
+        self.total = 0
+
+    def _advance(self, second):
+        if second == self._second:
+            return
+
+        for s in range(self._second + 1,
+                min(second, self._second + self._window) + 1):
+            self._slots[s % self._window] = 0
+        self._second = second
+
+    def add(self, n=1):
+        second = int(self._clock())
+        self._advance(second)
+        self._slots[second % self._window] += n
+        self.total += n
+
+    def rate(self):
+        self._advance(int(self._clock()))
+        return sum(self._slots) / self._window
+
+class Metrics:
+    '''
+    Counters for the message processing hot path.
+
+    Updates are plain attribute increments with no locking; counts from
+    worker threads may very rarely be lost, which is acceptable for
+    monitoring.  Adding a handler or gauge takes a lock, so that readers
+    on other threads (e.g. the MetricsServer) can take a consistent copy.
+    '''
+
+    def __init__(self, clock=time.monotonic):
+        self.handlers = {}
+        self.messages = RateCounter(clock=clock)
+        self.matcher_checks = 0
+        self.matcher_misses = 0
+        self._gauges = []
+        self._histograms = []
+        self._lock = threading.Lock()
+
+    def handler(self, label):
+        stats = self.handlers.get(label)
+        if stats is None:
+            with self._lock:
+                stats = self.handlers.get(label)
+                if stats is None:
+                    stats = self.handlers[label] = HandlerStats()
+        return stats
+
+    def handler_stats(self):
+        '''
+        (label, HandlerStats) of every handler, sorted by label
+        '''
+
+        with self._lock:
+            handlers = list(self.handlers.items())
+        return sorted(handlers)
+
+    def add_gauge(self, name, labels, fn, kind='gauge'):
+        '''
+        Report the value returned by fn() when metrics are read.  labels is
+        a dict of Prometheus labels; kind is the Prometheus metric type.
+        '''
+
+        with self._lock:
+            self._gauges.append((name, labels, fn, kind))
+
+    def gauges(self):
+        with self._lock:
+            gauges = list(self._gauges)
+        for name, labels, fn, kind in gauges:
+            yield name, labels, fn()
+
+    def add_histogram(self, name, labels, histogram):
+        '''
+        Report a Histogram that is filled elsewhere when metrics are read
+        '''
+
+        with self._lock:
+            self._histograms.append((name, labels, histogram))
+
+    def histograms(self):
+        with self._lock:
+            return list(self._histograms)
+
+    def _gauge_kinds(self):
+        with self._lock:
+            gauges = list(self._gauges)
+        return dict((name, kind) for name, labels, fn, kind in gauges)
+
+    def miss_rate(self):
+        if self.matcher_checks == 0:
+            return 0.0
+        return self.matcher_misses / self.matcher_checks
+
+    def summary(self):
+        '''
+        One-line summary for chat
+        '''
+
+        parts = [
+            '{} msgs ({:.2f}/s)'.format(
+                self.messages.total,
+                self.messages.rate()
+            ),
+            'matcher miss rate {:.1%}'.format(self.miss_rate())
+        ]
+
+        for name, labels, value in self.gauges():
+            if labels:
+                name += '[{}]'.format(','.join(labels.values()))
+            parts.append('{} {}'.format(name, value))
+
+        busiest = sorted(
+                self.handler_stats(),
+                key=lambda item: item[1].calls,
+                reverse=True
+        )[:5]
+        for label, stats in busiest:
+            parts.append('{}: {} calls, {} errors, {} timeouts, '
+                    'p50 {} p99 {}'.format(
+                label,
+                stats.calls,
+                stats.errors,
+                stats.timeouts,
+                _format_seconds(stats.latency.quantile(0.5)),
+                _format_seconds(stats.latency.quantile(0.99))
+            ))
+
+        return '; '.join(parts)
+
+    def render_prometheus(self):
+        '''
+        Render all metrics in the Prometheus text exposition format
+        '''
+
+        lines = []
+
+        def metric(name, kind, samples):
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                lines.append('{}{}{} {}'.format(
+                    name,
+                    suffix,
+                    _format_labels(labels),
+                    _format_value(value)
+                ))
+
+        metric('bavi_messages_total', 'counter', [
+            ('', {}, self.messages.total)
+        ])
+        metric('bavi_messages_per_second', 'gauge', [
+            ('', {}, self.messages.rate())
+        ])
+        metric('bavi_matcher_checks_total', 'counter', [
+            ('', {}, self.matcher_checks)
+        ])
+        metric('bavi_matcher_misses_total', 'counter', [
+            ('', {}, self.matcher_misses)
+        ])
+
+        handlers = self.handler_stats()
+        metric('bavi_handler_calls_total', 'counter', [
+            ('', { 'handler': label }, stats.calls)
+            for label, stats in handlers
+        ])
+        metric('bavi_handler_errors_total', 'counter', [
+            ('', { 'handler': label }, stats.errors)
+            for label, stats in handlers
+        ])
+        metric('bavi_handler_timeouts_total', 'counter', [
+            ('', { 'handler': label }, stats.timeouts)
+            for label, stats in handlers
+        ])
+
+        samples = []
+        for label, stats in handlers:
+            samples.extend(_histogram_samples({ 'handler': label },
+                    stats.latency))
+        metric('bavi_handler_latency_seconds', 'histogram', samples)
+
+        by_name = {}
+        for name, labels, value in self.gauges():
+            by_name.setdefault(name, []).append(('', labels, value))
+        kinds = self._gauge_kinds()
+        for name, histogram_samples in self._histogram_samples().items():
+            by_name[name] = histogram_samples
+            kinds[name] = 'histogram'
+        for name, samples in sorted(by_name.items()):
+            metric('bavi_' + name, kinds[name], samples)
+
+        return '\n'.join(lines) + '\n'
+
+    def _histogram_samples(self):
+        by_name = {}
+        for name, labels, histogram in self.histograms():
+            by_name.setdefault(name, []).extend(
+                    _histogram_samples(labels, histogram))
+        return by_name
+
+def _histogram_samples(labels, histogram):
+    samples = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        samples.append((
+            '_bucket',
+            dict(labels, le=_format_value(bound)),
+            cumulative
+        ))
+    samples.append(('_bucket', dict(labels, le='+Inf'), histogram.count))
+    samples.append(('_sum', labels, histogram.sum))
+    samples.append(('_count', labels, histogram.count))
+    return samples
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{' + ','.join(
+        '{}="{}"'.format(
+            key,
+            str(value).replace('\\', '\\\\').replace('"', '\\"')
+        )
+        for key, value in labels.items()
+    ) + '}'
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def _format_seconds(value):
+    if value is None:
+        return '-'
+    if value == float('inf'):
+        return '>{}s'.format(LATENCY_BUCKETS[-1])
+    if value < 1:
+        return '{:g}ms'.format(value * 1000)
+    return '{:g}s'.format(value)
+
+class MetricsServer:
+    '''
+    Serves metrics in the Prometheus text format over HTTP from a
+    background thread
+    '''
+
+    def __init__(self, metrics, host='127.0.0.1', port=9100):
+        self.metrics = metrics
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path != '/metrics':
+                    handler.send_error(404)
+                    return
+
+                body = metrics.render_prometheus().encode('utf-8')
+                handler.send_response(200)
+                handler.send_header(
+                        'Content-Type',
+                        'text/plain; version=0.0.4; charset=utf-8'
+                )
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                log.debug(format, *args)
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(
+                target=self._server.serve_forever,
+                name='bavi-metrics',
+                daemon=True
+        )
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def start(self):
+        log.info('Serving metrics on http://%s:%d/metrics', *self.address)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,77 @@
+import logging
+import sqlite3
+
+log = logging.getLogger('bavi.migrations')
+
+class MigrationError(Exception):
+    '''
+    A module's schema cannot be brought up to date
+    '''
+
+def migrate(conn, module, migrations):
+    '''
+    Bring module's tables up to date.
+
+    migrations is the module's list of schema changes, oldest first; each
+    is fn(conn) or a single SQL statement.  The schema_versions table
+    records how many of them have been applied to the database, and only
+    the ones after that are run, in order.  Call this inside a transaction
+    (see Database.migrate()), so that if one fails none of them are kept.
+
+    Returns the module's new schema version.
+    '''
+
+    conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_versions (
+                module TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                updated_at DATETIME NOT NULL DEFAULT (DATETIME())
+            )
+    ''')
+
+    version = schema_version(conn, module)
+
+    if version > len(migrations):
+        raise MigrationError(
+                'Schema of module "{}" is at version {}, but the module '
+                'only knows {} migration(s)'.format(
+                    module,
+                    version,
+                    len(migrations)
+                )
+        )
+
+    if version == len(migrations):
+        return version
+
+    for version, migration in enumerate(migrations[version:], version + 1):
+        log.info('Migrating schema of module %s to version %d', module,
+                version)
+        if isinstance(migration, str):
+            conn.execute(migration)
+        else:
+            migration(conn)
+
+    conn.execute('''
+            INSERT OR REPLACE INTO schema_versions (module, version)
+            VALUES (?, ?)
+    ''', (module, version))
+
+    return version
+
+def schema_version(conn, module):
+    '''
+    How many of module's migrations have been applied to the database
+    '''
+
+    try:
+        row = conn.execute('''
+                SELECT version
+                  FROM schema_versions
+                 WHERE module = ?
+        ''', (module,)).fetchone()
+    except sqlite3.OperationalError:
+        # No schema_versions table yet
+        return 0
+
+    return row[0] if row is not None else 0
@@ -1,21 +1,440 @@
+import concurrent.futures
 import importlib
+import importlib.util
 import logging
 import os
+import sys
+import time
 
 import bavi.modules
+from .manifest import (
+        MODULES_DIR,
+        ModuleCache,
+        ModuleSpec,
+        compile_matcher,
+        discover_modules,
+        find_module
+)
+from .migrations import schema_version
+from .sandbox import Sandbox, SandboxError, SandboxHandler
 
 log = logging.getLogger('bavi.module_loader')
 
+# Threads used to import modules at startup
+IMPORT_THREADS = 4
+
 def load_modules(bot):
-    for f in os.listdir(os.path.join(os.path.dirname(__file__), 'modules')):
-        if f.endswith('.py') and not f.endswith('__init__.py'):
-            load_module(bot, f)
+    '''
+    Load every module found by discover_modules().
+
+    With [modules] Cache set, modules whose registrations are in the cache
+    are not imported: their commands and matchers are registered with
+    ModuleStub handlers, and the module is only loaded when a message is
+    first dispatched to one of them.  The other modules are imported in
+    parallel, then initialized one at a time, and the cache is updated.
+    Stubs are registered and modules initialized in discover_modules()
+    order, so matcher priority does not depend on what is cached.
+    A cached module whose MIGRATIONS have not all been applied to the
+    database is imported too, so that its init() migrates it at startup.
+
+    Modules listed in [sandbox] Modules are never imported by the bot; see
+    load_sandbox().
+
+    Returns a dict of module name to (import seconds, init seconds), for
+    the startup report.
+    '''
+
+    specs = discover_modules()
+    timings = {}
+
+    sandboxed = _sandboxed_names(bot.config)
+    if sandboxed:
+        start = time.perf_counter()
+        load_sandbox(bot, [spec for spec in specs if spec.name in sandboxed])
+        timings['sandbox'] = (0.0, time.perf_counter() - start)
+        specs = [spec for spec in specs if spec.name not in sandboxed]
+
+    cache = None
+    path = bot.config.get('modules', 'Cache', fallback='')
+    if path:
+        cache = ModuleCache(path)
+        cache.load()
+        cache.retain(set(spec.name for spec in specs))
+
+    entries = {}
+    load = []
+    for spec in specs:
+        entry = cache.get(spec) if cache is not None else None
+        if entry is not None and not _schema_current(bot, spec, entry):
+            log.info('Schema of module %s is out of date', spec.name)
+            entry = None
+        if entry is None:
+            load.append(spec)
+        else:
+            entries[spec.name] = entry
+
+    imported = _import_modules(load)
+    for spec in specs:
+        entry = entries.get(spec.name)
+        if entry is not None:
+            start = time.perf_counter()
+            register_stubs(bot, spec, entry)
+            timings[spec.name] = (0.0, time.perf_counter() - start)
+            continue
+
+        module, import_time = imported[spec.name]
+        start = time.perf_counter()
+        if module is not None and _init_module(bot, spec, module) and \
+                cache is not None:
+            cache.update(
+                    spec,
+                    bot._registry.registrations(spec.name),
+                    bot._registry.matchers.literal,
+                    schema_version=_migration_count(module)
+            )
+        timings[spec.name] = (import_time, time.perf_counter() - start)
+
+    if cache is not None:
+        cache.save()
+
+    return timings
+
+def _migration_count(module):
+    migrations = getattr(module, 'MIGRATIONS', None)
+    return len(migrations) if migrations is not None else None
+
+def _schema_current(bot, spec, entry):
+    '''
+    Whether the database has every migration the module had when its cache
+    entry was made (see bavi.migrations)
+    '''
+
+    version = entry.get('schema_version')
+    if version is None or bot.db is None:
+        return True
+
+    return schema_version(bot.db.connection(), spec.name) == version
 
 def load_module(bot, filename):
-    path = os.path.basename(filename)[:-3]
-    log.info('Loading module %s', path)
+    '''
+    Import and initialize one file from bavi/modules.  Returns (import
+    seconds, init seconds).
+    '''
+
+    name = os.path.basename(filename)[:-3]
+    spec = ModuleSpec(
+            name,
+            'bavi.modules.' + name,
+            os.path.join(MODULES_DIR, name + '.py')
+    )
+
+    module, import_time = _import_modules([spec])[name]
+    start = time.perf_counter()
+    if module is not None:
+        _init_module(bot, spec, module)
+    return (import_time, time.perf_counter() - start)
+
+def _import_modules(specs):
+    '''
+    Import specs' modules on several threads.  Returns a dict of module
+    name to (module or None if the import failed, import seconds).
+    '''
+
+    def import_one(spec):
+        start = time.perf_counter()
+        try:
+            module = importlib.import_module(spec.import_name)
+        except BaseException:
+            log.exception('Failed to import module "%s"', spec.name)
+            module = None
+        return spec.name, (module, time.perf_counter() - start)
+
+    if len(specs) <= 1:
+        return dict(import_one(spec) for spec in specs)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=IMPORT_THREADS,
+            thread_name_prefix='bavi-import') as executor:
+        return dict(executor.map(import_one, specs))
+
+def _init_module(bot, spec, module):
+    log.info('Loading module %s', spec.name)
     try:
-        mod = importlib.import_module('.' + path, 'bavi.modules')
-        mod.init(bot)
-    except BaseException as e:
-        log.exception('Failed to load module "%s"', path)
+        with bot._registry.loading(spec.name):
+            module.init(bot)
+    except BaseException:
+        log.exception('Failed to load module "%s"', spec.name)
+        return False
+    return True
+
+class ModuleStub:
+    '''
+    Handler registered for a module that has not been imported yet, using
+    what the module cache says it registers.
+
+    The bot calls load() when it is about to dispatch to a stub, which
+    replaces all of the module's stubs with its real handlers.  The real
+    matchers take the stubs' places in the matcher order (see Registry).
+    '''
+
+    def __init__(self, bot, spec, handler):
+        self.bot = bot
+        self.spec = spec
+        self.__name__ = '{}#{}'.format(spec.name, handler)
+
+    def load(self):
+        '''
+        Import and initialize the module, on the connection's thread.
+        Returns False if that failed, in which case the module is left
+        unloaded.
+        '''
+
+        registry = self.bot._registry
+        if not any(
+                method in { 'add_command', 'add_matcher' } and
+                        isinstance(args[1], ModuleStub)
+                for method, args, kwargs in registry.registrations(
+                    self.spec.name
+                )):
+            # Already loaded by an earlier dispatch or .reload
+            return True
+
+        log.info('Loading module %s on first use', self.spec.name)
+        registry.unregister(self.spec.name)
+        try:
+            module = importlib.import_module(self.spec.import_name)
+        except BaseException:
+            log.exception('Failed to import module "%s"', self.spec.name)
+            return False
+
+        return _init_module(self.bot, self.spec, module)
+
+    def __call__(self, *args, **kwargs):
+        raise RuntimeError(
+                'Module "{}" was not loaded before dispatch'.format(
+                    self.spec.name
+                )
+        )
+
+def register_stubs(bot, spec, entry):
+    '''
+    Register ModuleStub handlers for the commands and matchers of a module
+    cache entry
+    '''
+
+    _register_entry(
+            bot,
+            spec.name,
+            entry,
+            lambda handler: ModuleStub(bot, spec, handler)
+    )
+
+def _register_entry(bot, name, entry, make_handler):
+    '''
+    Register the commands and matchers of a module cache entry, with
+    make_handler(index) standing in for each of the module's handlers
+    '''
+
+    registry = bot._registry
+    handlers = {}
+
+    def stub(handler):
+        if handler not in handlers:
+            handlers[handler] = make_handler(handler)
+        return handlers[handler]
+
+    with registry.loading(name):
+        for command in entry['commands']:
+            registry.add_command(
+                    command['name'],
+                    stub(command['handler']),
+                    aliases=command['aliases'],
+                    max_concurrency=command['max_concurrency'],
+                    deadline=command['deadline']
+            )
+
+        for matcher in entry['matchers']:
+            regex = compile_matcher(matcher)
+            registry.matchers.set_literal(regex, matcher['literal'])
+            registry.add_matcher(
+                    regex,
+                    stub(matcher['handler']),
+                    priority=matcher['priority'],
+                    max_concurrency=matcher['max_concurrency'],
+                    deadline=matcher['deadline']
+            )
+
+def _sandboxed_names(config):
+    return set(
+        name.strip()
+        for name in config.get('sandbox', 'Modules', fallback='').split(',')
+        if name.strip()
+    )
+
+def load_sandbox(bot, specs):
+    '''
+    Start a Sandbox running the modules of specs, and register a
+    SandboxHandler for each of their handlers.  Stops the sandbox the bot
+    already has, if any, letting calls that are running finish.  If no
+    worker process can be started the modules are left unloaded.
+
+    A call blocks its thread until the worker process is done, so the
+    modules are only loaded if the bot has a [workers] pool to run them on,
+    rather than the connection's thread.
+    '''
+
+    registry = bot._registry
+    if registry.sandbox is not None:
+        registry.sandbox.stop()
+        for name, import_name in registry.sandbox.modules:
+            registry.unregister(name)
+        registry.sandbox = None
+
+    if not specs:
+        return
+
+    if bot._pool is None:
+        log.error('Sandboxed modules need a [workers] pool; not loading %s',
+                ', '.join(spec.name for spec in specs))
+        return
+
+    sandbox = Sandbox(
+            bot.config,
+            [(spec.name, spec.import_name) for spec in specs],
+            processes=bot.config.getint('sandbox', 'Processes', fallback=2),
+            timeout=bot.config.getfloat('sandbox', 'Timeout', fallback=60)
+    )
+
+    log.info('Starting sandbox for %s',
+            ', '.join(spec.name for spec in specs))
+    try:
+        registrations = sandbox.start()
+    except SandboxError as e:
+        log.error('Cannot load sandboxed modules: %s', e)
+        return
+
+    registry.sandbox = sandbox
+
+    for name, (entry, names) in registrations.items():
+        log.info('Loading module %s in the sandbox', name)
+        _register_entry(
+                bot,
+                name,
+                entry,
+                lambda index, name=name, names=names: SandboxHandler(
+                    sandbox,
+                    name,
+                    index,
+                    names[index]
+                )
+        )
+
+def module_exists(name):
+    return find_module(name) is not None
+
+def reload_module(bot, name):
+    '''
+    Re-import a module and swap its commands, matchers, listeners and
+    shutdown hooks for the ones registered by the new code.  Loads the
+    module if it is not loaded yet.
+
+    Call this on the connection's thread (see bot.call_from_thread()), so
+    no message is dispatched halfway through the swap.  Handlers that are
+    already running finish with the old code.  The old module's shutdown
+    hooks are run once the new one has been initialized.  The new matchers
+    take the old ones' places in the matcher order (see Registry).
+
+    The new code is imported into a new module object, which replaces the
+    old one in sys.modules only once its init() has succeeded; the old
+    module's globals are never touched.  If the module cannot be imported
+    or its init() raises, the exception is passed on and the old handlers
+    stay registered.
+
+    Reloading a sandboxed module restarts the sandbox's worker processes,
+    which reload all of the sandboxed modules.
+    '''
+
+    spec = find_module(name)
+    if spec is None:
+        raise KeyError(name)
+
+    registry = bot._registry
+
+    sandboxed = _sandboxed_names(bot.config)
+    if name in sandboxed:
+        log.info('Restarting sandbox to reload module %s', name)
+        load_sandbox(bot, [
+            spec for spec in discover_modules() if spec.name in sandboxed
+        ])
+        if name not in registry.modules:
+            raise SandboxError(
+                    'Module "{}" did not load in the sandbox'.format(name)
+            )
+        return
+
+    log.info('Reloading module %s', name)
+    if spec.import_name in sys.modules:
+        mod = _import_fresh(spec.import_name)
+    else:
+        mod = importlib.import_module(spec.import_name)
+
+    old = registry.unregister(name)
+    try:
+        with registry.loading(name):
+            mod.init(bot)
+    except BaseException:
+        registry.unregister(name)
+        registry.restore(name, old)
+        raise
+
+    _install(spec.import_name, mod)
+    _run_shutdown_hooks(name, old)
+
+def _import_fresh(import_name):
+    '''
+    Execute a module's code in a new module object.  Unlike
+    importlib.reload(), this leaves the loaded module alone, so handlers
+    that are still running keep their globals (locks, caches, stores),
+    and so do the old handlers if the new module's init() fails.
+    '''
+
+    spec = importlib.util.find_spec(import_name)
+    if spec is None:
+        raise ImportError('No module named {!r}'.format(import_name),
+                name=import_name)
+
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+def _install(import_name, mod):
+    '''
+    Make mod the module imported as import_name from now on
+    '''
+
+    sys.modules[import_name] = mod
+    parent, _, child = import_name.rpartition('.')
+    if parent in sys.modules:
+        setattr(sys.modules[parent], child, mod)
+
+def unload_module(bot, name):
+    '''
+    Unregister everything a module registered and run its shutdown hooks.
+    Like reload_module(), call this on the connection's thread.
+    '''
+
+    if name not in bot._registry.modules:
+        raise KeyError(name)
+
+    log.info('Unloading module %s', name)
+    _run_shutdown_hooks(name, bot._registry.unregister(name))
+
+def _run_shutdown_hooks(name, registrations):
+    for method, args, kwargs in registrations:
+        if method != 'add_shutdown_hook':
+            continue
+
+        try:
+            args[0]()
+        except Exception:
+            log.exception('Shutdown hook of module "%s" failed', name)
@@ -0,0 +1,148 @@
+import logging
+
+from bavi.module_loader import module_exists, reload_module, unload_module
+
+log = logging.getLogger('bavi.modules.admin')
+
+def init(bot):
+    bot.add_command('stats', stats_command)
+    bot.add_command('profile', profile_command)
+    bot.add_command('reload', reload_command)
+    bot.add_command('unload', unload_command)
+    bot.add_command('join', join_command)
+    bot.add_command('part', part_command)
+
+def stats_command(bot, source, target, message, **kwargs):
+    '''
+    .stats: Show message and handler statistics (admins only)
+    '''
+
+    if not bot.is_admin(source):
+        bot.reply_to(source, target, "You aren't allowed to do that.")
+        return
+
+    bot.say(target, bot.metrics.summary())
+
+def profile_command(bot, source, target, message, **kwargs):
+    '''
+    .profile start|stop: Start or stop the sampling profiler (admins only)
+    '''
+
+    if not bot.is_admin(source):
+        bot.reply_to(source, target, "You aren't allowed to do that.")
+        return
+
+    action = message.strip().lower()
+    if action not in { 'start', 'stop' }:
+        bot.reply_to(source, target, 'Usage: .profile start|stop')
+        return
+
+    if (action == 'start') == bot.profiler.running:
+        bot.reply_to(source, target, 'The profiler is already {}.'.format(
+            'running' if bot.profiler.running else 'stopped'
+        ))
+        return
+
+    path = bot.toggle_profiler()
+    if path is None:
+        bot.reply_to(source, target, 'Profiler started.')
+    else:
+        log.info('%s wrote profile %s', source, path)
+        bot.reply_to(source, target, 'Profile written to {}'.format(path))
+
+def reload_command(bot, source, target, message, **kwargs):
+    '''
+    .reload module: Reload a module's code without reconnecting (admins
+    only)
+    '''
+
+    if not bot.is_admin(source):
+        bot.reply_to(source, target, "You aren't allowed to do that.")
+        return
+
+    name = message.strip()
+    if not name:
+        bot.reply_to(source, target, 'Usage: .reload <module>')
+        return
+    if not module_exists(name):
+        bot.reply_to(source, target, 'No module named "{}".'.format(name))
+        return
+
+    def swap():
+        try:
+            reload_module(bot, name)
+        except BaseException as e:
+            log.exception('Failed to reload module "%s"', name)
+            bot.reply_to(source, target, 'Reloading {} failed: {}'.format(
+                name,
+                type(e).__name__ + ': ' + str(e)
+            ))
+            return
+
+        log.info('%s reloaded module %s', source, name)
+        bot.reply_to(source, target, 'Reloaded {}.'.format(name))
+
+    # Swap the handlers between two messages rather than in the middle of
+    # dispatching one
+    bot.call_from_thread(swap)
+
+def unload_command(bot, source, target, message, **kwargs):
+    '''
+    .unload module: Remove a module's commands and matchers (admins only)
+    '''
+
+    if not bot.is_admin(source):
+        bot.reply_to(source, target, "You aren't allowed to do that.")
+        return
+
+    name = message.strip()
+    if not name:
+        bot.reply_to(source, target, 'Usage: .unload <module>')
+        return
+    if name == __name__.rpartition('.')[2]:
+        bot.reply_to(source, target, "I can't unload the module that "
+                "reloads modules.")
+        return
+
+    def unload():
+        try:
+            unload_module(bot, name)
+        except KeyError:
+            bot.reply_to(source, target, '{} is not loaded.'.format(name))
+            return
+
+        log.info('%s unloaded module %s', source, name)
+        bot.reply_to(source, target, 'Unloaded {}.'.format(name))
+
+    bot.call_from_thread(unload)
+
+def join_command(bot, source, target, message, **kwargs):
+    '''
+    .join #channel [#channel ...]: Join channels, and rejoin them after
+    reconnecting (admins only)
+    '''
+
+    if not bot.is_admin(source):
+        bot.reply_to(source, target, "You aren't allowed to do that.")
+        return
+
+    channels = message.replace(',', ' ').split()
+    if not channels:
+        bot.reply_to(source, target, 'Usage: .join #channel [#channel ...]')
+        return
+
+    log.info('%s asked to join %s', source, ', '.join(channels))
+    bot.call_from_thread(lambda: bot.join(*channels))
+
+def part_command(bot, source, target, message, **kwargs):
+    '''
+    .part [#channel]: Leave a channel, this one by default (admins only)
+    '''
+
+    if not bot.is_admin(source):
+        bot.reply_to(source, target, "You aren't allowed to do that.")
+        return
+
+    channel = message.strip() or target
+    log.info('%s asked to part %s', source, channel)
+    bot.call_from_thread(lambda: bot.part(channel))
@@ -0,0 +1,520 @@
+import collections
+import contextlib
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+import irc.strings
+
+from bavi.migrations import migrate
+
+log = logging.getLogger('bavi.modules.history')
+
+# Lines are written in one transaction once this many are waiting, or
+# every FLUSH_INTERVAL seconds
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+
+# Lines waiting to be written before new ones are dropped
+MAX_PENDING = 20000
+
+# Lines older than this many days are deleted unless [history] RetentionDays
+# says otherwise
+DEFAULT_RETENTION_DAYS = 30
+
+# How often (in seconds) to delete lines older than [history] RetentionDays,
+# and how many to delete per transaction
+PRUNE_INTERVAL = 3600
+PRUNE_CHUNK = 1000
+
+# Matches shown by .grep
+GREP_RESULTS = 3
+
+_store = None
+
+def init(bot):
+    global _store
+
+    # History is written in large batches by the store's own thread, so
+    # it gets its own connection rather than going through bot.db.write()
+    _store = HistoryStore(
+            bot.db.connect,
+            exclusive=bot.db.exclusive,
+            retention_days=bot.config.getint(
+                'history',
+                'RetentionDays',
+                fallback=DEFAULT_RETENTION_DAYS
+            ),
+            fts=fts5_available()
+    )
+    _store.start()
+
+    bot.add_listener(record_message)
+    bot.add_shutdown_hook(_store.close)
+    bot.add_command('seen', seen_command)
+    bot.add_command('last', last_command)
+    if _store.fts:
+        bot.add_command('grep', grep_command)
+    else:
+        log.warning('SQLite was built without FTS5; .grep is disabled')
+
+def _create_history(conn):
+    # IF NOT EXISTS adopts tables made before migrations were tracked
+    conn.execute('''
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY,
+                ts REAL NOT NULL,
+                network TEXT NOT NULL,
+                channel TEXT NOT NULL,
+                nick TEXT NOT NULL,
+                display_nick TEXT NOT NULL,
+                message TEXT NOT NULL
+            )
+    ''')
+    conn.execute('''
+            CREATE INDEX IF NOT EXISTS history_nick
+                ON history (network, nick, id)
+    ''')
+    conn.execute('''
+            CREATE INDEX IF NOT EXISTS history_channel_nick
+                ON history (network, channel, nick, id)
+    ''')
+    conn.execute('''
+            CREATE INDEX IF NOT EXISTS history_ts
+                ON history (ts)
+    ''')
+
+# Schema changes, oldest first; see bavi.migrations
+MIGRATIONS = [
+    _create_history
+]
+
+def fts5_available():
+    db = sqlite3.connect(':memory:')
+    try:
+        db.execute('CREATE VIRTUAL TABLE fts5_test USING fts5 (x)')
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        db.close()
+
+def fts_query(text):
+    '''
+    Turn user input into an FTS5 query matching lines that contain all of
+    the words, so quotes and operators in the input cannot cause syntax
+    errors
+    '''
+
+    return ' '.join(
+        '"{}"'.format(word.replace('"', '""')) for word in text.split()
+    )
+
+def format_ago(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return 'just now'
+
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+
+    if days:
+        return '{}d {}h ago'.format(days, hours)
+    if hours:
+        return '{}h {}m ago'.format(hours, minutes)
+    return '{}m ago'.format(minutes)
+
+class HistoryStore:
+    '''
+    Searchable log of channel messages in SQLite.
+
+    record() only queues a line.  A background thread owns the database
+    connection: it inserts queued lines in batches (one transaction per
+    batch, indexing them in an FTS5 table at the same time), answers
+    queries and deletes lines past the retention period a chunk at a time,
+    so none of this happens on the connection's thread.
+
+    Query results are passed to a callback on the store's thread; use
+    bot.call_from_thread() to reply from there.
+
+    Each transaction is made inside exclusive(), e.g. Database.exclusive,
+    in case the connection is shared with other threads.
+    '''
+
+    _STOP = object()
+    _FLUSH = object()
+
+    def __init__(self, connect, exclusive=contextlib.nullcontext,
+            retention_days=0, fts=True, clock=time.time):
+        self._connect = connect
+        self._exclusive = exclusive
+        self._retention = retention_days * 86400
+        self.fts = fts
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._flush_requested = False
+        self._jobs = queue.Queue()
+        self._last_flush = time.monotonic()
+        self._last_prune = None
+        self._prune_more = False
+
+        self.written = 0
+        self.dropped = 0
+        self.pruned = 0
+
+        self._thread = threading.Thread(
+                target=self._run,
+                name='bavi-history',
+                daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        '''
+        Write queued lines and stop the store's thread
+        '''
+
+        self._jobs.put(self._STOP)
+        self._thread.join()
+
+    def record(self, network, channel, nick, message):
+        with self._lock:
+            if len(self._pending) >= MAX_PENDING:
+                self.dropped += 1
+                return False
+
+            self._pending.append((
+                self._clock(),
+                network,
+                irc.strings.lower(channel),
+                irc.strings.lower(nick),
+                nick,
+                message
+            ))
+
+            if len(self._pending) >= BATCH_SIZE and not self._flush_requested:
+                self._flush_requested = True
+                self._jobs.put(self._FLUSH)
+
+        return True
+
+    def query(self, fn, args, callback, errback):
+        '''
+        Run fn(db, *args) on the store's thread and pass the result to
+        callback, or the exception to errback
+        '''
+
+        self._jobs.put((fn, args, callback, errback))
+
+    def seen(self, network, nick, callback, errback):
+        '''
+        The most recent line from nick in any channel, as (time, channel,
+        nick, message), or None
+        '''
+
+        self.query(_seen, (network, irc.strings.lower(nick)), callback, errback)
+
+    def last(self, network, channel, nick, callback, errback):
+        '''
+        The most recent line from nick in channel, as (time, nick, message),
+        or None
+        '''
+
+        self.query(
+                _last,
+                (network, irc.strings.lower(channel), irc.strings.lower(nick)),
+                callback,
+                errback
+        )
+
+    def grep(self, network, channel, text, callback, errback,
+            limit=GREP_RESULTS):
+        '''
+        The newest lines in channel containing all words of text, as a list
+        of (time, nick, message)
+        '''
+
+        self.query(
+                _grep,
+                (network, irc.strings.lower(channel), fts_query(text), limit),
+                callback,
+                errback
+        )
+
+    def _run(self):
+        self._db = self._connect()
+        self._create_tables()
+
+        while True:
+            try:
+                job = self._jobs.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                job = None
+
+            # Write before answering a query so it sees everything said
+            # before it was asked
+            if job is not None or \
+                    time.monotonic() - self._last_flush >= FLUSH_INTERVAL:
+                self._flush()
+
+            if job is self._STOP:
+                return
+            elif job is not None and job is not self._FLUSH:
+                fn, args, callback, errback = job
+                try:
+                    result = fn(self._db, *args)
+                except Exception as e:
+                    errback(e)
+                else:
+                    callback(result)
+
+            if self._retention and self._jobs.empty():
+                self._prune()
+
+    def _create_tables(self):
+        with self._exclusive():
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                migrate(self._db, 'history', MIGRATIONS)
+            except BaseException:
+                self._db.rollback()
+                raise
+            self._db.commit()
+
+            # Depends on how SQLite was built rather than on the schema
+            # version
+            if self.fts:
+                self._db.execute('''
+                        CREATE VIRTUAL TABLE IF NOT EXISTS history_fts
+                         USING fts5 (
+                            message,
+                            content='history',
+                            content_rowid='id'
+                         )
+                ''')
+            self._db.commit()
+
+    def _flush(self):
+        with self._lock:
+            batch = self._pending
+            self._pending = collections.deque()
+            self._flush_requested = False
+        self._last_flush = time.monotonic()
+
+        if not batch:
+            return
+
+        try:
+            with self._exclusive(), self._db:
+                last_id, = self._db.execute(
+                        'SELECT COALESCE(MAX(id), 0) FROM history'
+                ).fetchone()
+                self._db.executemany('''
+                        INSERT INTO history (
+                            ts, network, channel, nick, display_nick, message
+                        ) VALUES (?, ?, ?, ?, ?, ?)
+                ''', batch)
+                if self.fts:
+                    self._db.execute('''
+                            INSERT INTO history_fts (rowid, message)
+                            SELECT id, message
+                              FROM history
+                             WHERE id > ?
+                    ''', (last_id,))
+            self.written += len(batch)
+        except sqlite3.Error as e:
+            self.dropped += len(batch)
+            log.error('Failed to write %d history line(s)', len(batch),
+                    exc_info=e)
+
+    def _prune(self):
+        now = time.monotonic()
+        if not self._prune_more and self._last_prune is not None and \
+                now - self._last_prune < PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+
+        # One chunk at a time, so queries are not held up for long
+        rows = self._db.execute('''
+                SELECT id, message
+                  FROM history
+                 WHERE ts < ?
+                 ORDER BY ts
+                 LIMIT ?
+        ''', (self._clock() - self._retention, PRUNE_CHUNK)).fetchall()
+        self._prune_more = len(rows) == PRUNE_CHUNK
+
+        if not rows:
+            return
+
+        with self._exclusive(), self._db:
+            if self.fts:
+                self._db.executemany('''
+                        INSERT INTO history_fts (history_fts, rowid, message)
+                        VALUES ('delete', ?, ?)
+                ''', rows)
+            self._db.executemany(
+                    'DELETE FROM history WHERE id = ?',
+                    [(row_id,) for row_id, message in rows]
+            )
+        self.pruned += len(rows)
+
+def _seen(db, network, nick):
+    return db.execute('''
+            SELECT ts, channel, display_nick, message
+              FROM history
+             WHERE network = ?
+               AND nick = ?
+             ORDER BY id DESC
+             LIMIT 1
+    ''', (network, nick)).fetchone()
+
+def _last(db, network, channel, nick):
+    return db.execute('''
+            SELECT ts, display_nick, message
+              FROM history
+             WHERE network = ?
+               AND channel = ?
+               AND nick = ?
+             ORDER BY id DESC
+             LIMIT 1
+    ''', (network, channel, nick)).fetchone()
+
+def _grep(db, network, channel, query, limit):
+    if not query:
+        return []
+
+    return db.execute('''
+            SELECT h.ts, h.display_nick, h.message
+              FROM history_fts f
+              JOIN history h ON h.id = f.rowid
+             WHERE history_fts MATCH ?
+               AND h.network = ?
+               AND h.channel = ?
+             ORDER BY f.rowid DESC
+             LIMIT ?
+    ''', (query, network, channel, limit)).fetchall()
+
+def record_message(bot, event):
+    message = event.arguments[0]
+    if not bot.is_command(message):
+        _store.record(bot.network, event.target, event.source.nick, message)
+
+def _callbacks(bot, target, done):
+    '''
+    Callback and errback for a store query that run on the bot's thread
+    '''
+
+    def callback(result):
+        bot.call_from_thread(lambda: done(result))
+
+    def errback(e):
+        log.error('History query failed', exc_info=e)
+        bot.call_from_thread(lambda: bot.say(
+            target,
+            type(e).__name__ + ': ' + str(e)
+        ))
+
+    return callback, errback
+
+def seen_command(bot, source, target, message, **kwargs):
+    '''
+    .seen: Show when a user last said something
+
+    Usage:
+      .seen nick    Show when nick was last seen talking, in any channel
+
+    What they said is only shown if it was said in this channel, so that
+    lines from other (possibly secret) channels are not repeated here.
+    '''
+
+    nick = message.strip()
+    if not nick:
+        bot.reply_to(source, target, 'Usage: .seen <nick>')
+        return
+
+    def done(row):
+        if row is None:
+            bot.reply_to(source, target, "I haven't seen {}.".format(nick))
+            return
+
+        ts, channel, display_nick, line = row
+        if channel != irc.strings.lower(target):
+            bot.reply_to(source, target, '{} was last seen {}.'.format(
+                display_nick,
+                format_ago(time.time() - ts)
+            ))
+            return
+
+        bot.reply_to(source, target, '{} was last seen here {}: {}'.format(
+            display_nick,
+            format_ago(time.time() - ts),
+            line
+        ))
+
+    _store.seen(bot.network, nick, *_callbacks(bot, target, done))
+
+def last_command(bot, source, target, message, **kwargs):
+    '''
+    .last: Show the last thing a user said in this channel
+
+    Usage:
+      .last nick    Show nick's last message in this channel
+    '''
+
+    nick = message.strip()
+    if not nick:
+        bot.reply_to(source, target, 'Usage: .last <nick>')
+        return
+
+    def done(row):
+        if row is None:
+            bot.reply_to(
+                    source,
+                    target,
+                    "{} hasn't said anything here.".format(nick)
+            )
+            return
+
+        ts, display_nick, line = row
+        bot.say(target, '[{}] <{}> {}'.format(
+            format_ago(time.time() - ts),
+            display_nick,
+            line
+        ))
+
+    _store.last(bot.network, target, nick, *_callbacks(bot, target, done))
+
+def grep_command(bot, source, target, message, **kwargs):
+    '''
+    .grep: Search this channel's history
+
+    Usage:
+      .grep some words    Show the newest lines containing all of the words
+    '''
+
+    text = message.strip()
+    if not text:
+        bot.reply_to(source, target, 'Usage: .grep <words>')
+        return
+
+    def done(rows):
+        if not rows:
+            bot.reply_to(source, target, 'No matches.')
+            return
+
+        for ts, display_nick, line in rows:
+            bot.say(target, '[{}] <{}> {}'.format(
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(ts)),
+                display_nick,
+                line
+            ))
+
+    _store.grep(bot.network, target, text, *_callbacks(bot, target, done))
@@ -1,26 +1,55 @@
 import datetime
-import pytz
 
 import irc.strings
 
-from bavi.db_util import create_audit_trigger
+from bavi.db_util import drop_audit_triggers, table_exists
+from bavi.lazy import lazy_import
+from bavi.writebehind import QueueFull
+
+pytz = lazy_import('pytz')
 
 def init(bot):
     bot.add_command('settz', set_tz)
     bot.add_command('time', time)
 
-    c = bot.db.cursor()
-    c.execute('''
-            CREATE TABLE IF NOT EXISTS tz_info (
+    bot.db.migrate('tz', MIGRATIONS)
+
+def _audit_defaults(conn):
+    '''
+    Stamp created_at and updated_at with column defaults and the UPSERT in
+    _store_tz() instead of AFTER triggers, which updated every row again
+    after it was written.  Rebuilds tz_info if it exists, as SQLite cannot
+    add a default to an existing column.
+    '''
+
+    drop_audit_triggers(conn, 'tz_info')
+    conn.execute('''
+            CREATE TABLE tz_info_new (
                 nick TEXT,
                 tz TEXT,
-                created_at DATETIME,
-                updated_at DATETIME,
+                created_at DATETIME NOT NULL DEFAULT (DATETIME()),
+                updated_at DATETIME NOT NULL DEFAULT (DATETIME()),
                 PRIMARY KEY (nick)
             )
     ''')
 
-    create_audit_trigger(c, 'tz_info', 'nick')
+    if table_exists(conn, 'tz_info'):
+        conn.execute('''
+                INSERT INTO tz_info_new (nick, tz, created_at, updated_at)
+                SELECT nick,
+                       tz,
+                       COALESCE(created_at, DATETIME()),
+                       COALESCE(updated_at, created_at, DATETIME())
+                  FROM tz_info
+        ''')
+        conn.execute('DROP TABLE tz_info')
+
+    conn.execute('ALTER TABLE tz_info_new RENAME TO tz_info')
+
+# Schema changes, oldest first; see bavi.migrations
+MIGRATIONS = [
+    _audit_defaults
+]
 
 def set_tz(bot, source, target, message, **kwargs):
     '''
@@ -49,24 +78,16 @@ def set_tz(bot, source, target, message, **kwargs):
         )
         return
 
-    c = bot.db.cursor()
-    now = datetime.datetime.now()
-
-    c.execute('''
-            UPDATE tz_info
-               SET tz = ?
-             WHERE nick = ?
-    ''', (tz, nick))
-
-    if c.rowcount == 0:
-        c.execute('''
-                INSERT INTO tz_info (nick, tz) VALUES (
-                    ?,
-                    ?
-                )
-        ''', (nick, tz))
-
-    bot.db.commit()
+    # Written in the background; tz_for_nick() sees it before then
+    try:
+        bot.db.write_behind('tz').put(nick, tz, _store_tz, nick, tz)
+    except QueueFull:
+        bot.reply_to(
+                source,
+                target,
+                "I'm too busy to save that right now, try again later"
+        )
+        return
 
     bot.reply_to(
             source,
@@ -74,6 +95,14 @@ def set_tz(bot, source, target, message, **kwargs):
             'Your timezone has been set to {}'.format(tz)
     )
 
+def _store_tz(conn, nick, tz):
+    conn.execute('''
+            INSERT INTO tz_info (nick, tz) VALUES (?, ?)
+            ON CONFLICT (nick) DO UPDATE
+               SET tz = excluded.tz,
+                   updated_at = DATETIME()
+    ''', (nick, tz))
+
 def time(bot, source, target, message, **kwargs):
     '''
     .time: Print the current time in the given user's timezone.
@@ -121,16 +150,23 @@ def time(bot, source, target, message, **kwargs):
 
 def tz_for_nick(bot, nick):
     arg = irc.strings.lower(nick)
-    c = bot.db.cursor()
-    c.execute('''
+    name = bot.db.write_behind('tz').read(arg, _load_tz, bot, arg)
+
+    if name is None:
+        raise KeyError('No timezone data found for {}'.format(nick))
+
+    return pytz.timezone(name)
+
+def _load_tz(bot, nick):
+    c = bot.db.execute('''
             SELECT tz
               FROM tz_info
              WHERE nick = ?
-    ''', (arg,))
+    ''', (nick,))
 
     results = [tz for tz, in c]
 
     if len(results) == 0:
-        raise KeyError('No timezone data found for {}'.format(nick))
+        return None
 
-    return pytz.timezone(results[0])
+    return results[0]
@@ -1,9 +1,14 @@
 import logging
-import requests
-import urllib3.exceptions
-from bs4 import BeautifulSoup
 from urllib.parse import urlparse
 import re
+import threading
+
+from bavi.lazy import lazy_import
+
+# Only imported when the first title is fetched
+bs4 = lazy_import('bs4')
+requests = lazy_import('requests')
+urllib3 = lazy_import('urllib3')
 
 log = logging.getLogger('bavi.modules.url')
 
@@ -19,6 +24,19 @@ compiled_ignore_regex = re.compile(IGNORE_REGEX)
 
 TITLE_FORMAT = '[ {0} ] - {1}'
 
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# Seconds requests waits for the server to send something
+REQUEST_TIMEOUT = 5
+
+# Seconds to wait for another handler's fetch of the same page before
+# fetching it directly
+FLIGHT_TIMEOUT = REQUEST_TIMEOUT * 2
+
+# Title fetches in progress, by normalized URL
+_flights = {}
+_flights_lock = threading.Lock()
+
 
 def init(bot):
     bot.add_command('title', title_command)
@@ -90,7 +108,7 @@ def get_user_readable_response(url):
 
     if len(url) > 0:
         #now start a request for the page title
-        title = get_http_title(url)
+        title = fetch_title(url)
 
         if (len(title) > 0):
             response = TITLE_FORMAT.format(title, get_domain_from_url(url))
@@ -116,6 +134,96 @@ def get_valid_urls(string_statement):
     return valid_urls
 
 
+def normalize_url(url):
+    '''
+    Reduce url to a key that is the same for every spelling of the same
+    page: lowercase scheme and host, no default port and no fragment
+    '''
+
+    try:
+        parts = urlparse(url)
+        port = parts.port
+    except ValueError:
+        return url
+
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if parts.username is not None:
+        netloc = parts.netloc.rsplit('@', 1)[0] + '@' + netloc
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        netloc += ':{0}'.format(port)
+
+    return parts._replace(
+        scheme=scheme,
+        netloc=netloc,
+        path=parts.path or '/',
+        fragment=''
+    ).geturl()
+
+
+class _Flight:
+    __slots__ = ('done', 'finished', 'title', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.finished = False
+        self.title = None
+        self.error = None
+
+
+def fetch_title(url):
+    '''
+    Like get_http_title, but concurrent calls for the same page share a
+    single request: the first caller fetches the title and the others wait
+    for its result (or its exception).  A waiter gives up after
+    FLIGHT_TIMEOUT seconds and fetches the page itself.
+
+    Handlers only run concurrently on a [workers] pool; without one, every
+    call is the first for its page and this is the same as
+    get_http_title.
+    '''
+
+    key = normalize_url(url)
+
+    while True:
+        with _flights_lock:
+            flight = _flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _flights[key] = _Flight()
+
+        if not leader:
+            log.debug('Waiting for title fetch in progress for %s', key)
+            if not flight.done.wait(FLIGHT_TIMEOUT):
+                log.warning('Title fetch in progress for %s is taking too '
+                        'long; fetching it again', key)
+                return get_http_title(url)
+            if not flight.finished:
+                # The leader was interrupted (e.g. by the watchdog) before
+                # it had a result; fetch it again
+                continue
+            if flight.error is not None:
+                raise flight.error
+            return flight.title
+
+        try:
+            flight.title = get_http_title(url)
+            flight.finished = True
+            return flight.title
+        except Exception as e:
+            flight.error = e
+            flight.finished = True
+            raise
+        finally:
+            # Always wake the waiters, even if the flight is already gone
+            try:
+                with _flights_lock:
+                    if _flights.get(key) is flight:
+                        del _flights[key]
+            finally:
+                flight.done.set()
+
+
 def get_http_title(url):
     log.debug('Requesting url %s', url)
 
@@ -126,7 +234,8 @@ def get_http_title(url):
     page = b''
 
     #use `with` to make sure the connection goes back into the pool
-    with requests.get(url, headers=headers, timeout=5, stream=True) as r:
+    with requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT,
+            stream=True) as r:
         for chunk in r.iter_content(chunk_size=128):
             page += chunk
 
@@ -134,7 +243,7 @@ def get_http_title(url):
             if b'</title>' in page or len(page) > 512000:
                 break
 
-    bs = BeautifulSoup(page, 'html.parser')
+    bs = bs4.BeautifulSoup(page, 'html.parser')
 
     return bs.find('title').string
 
@@ -0,0 +1,70 @@
+import logging
+
+from .bot import Bot
+
+log = logging.getLogger('bavi.network')
+
+def irc_sections(config):
+    '''
+    Return the names of the config sections describing IRC connections.
+
+    Each network is configured in its own [irc:<name>] section.  A plain
+    [irc] section is still accepted for single-network setups.
+    '''
+
+    sections = [s for s in config.sections() if s.startswith('irc:')]
+
+    if not sections and config.has_section('irc'):
+        sections = ['irc']
+
+    return sections
+
+class BotGroup:
+    '''
+    Several bots, one per IRC network, hosted in one process.
+
+    The bots share one command/matcher registry, worker pool and database
+    handle, so modules are imported and initialized once no matter how
+    many networks the process is connected to.
+    '''
+
+    def __init__(self, config, bot_class=Bot):
+        self.config = config
+        self.bot_class = bot_class
+        self.bots = []
+
+        sections = irc_sections(config)
+        if not sections:
+            raise ValueError('No [irc] or [irc:<name>] sections configured')
+
+        for section in sections:
+            shared = self.bots[0] if self.bots else None
+            self.bots.append(bot_class(config, section=section, shared=shared))
+
+    @property
+    def primary(self):
+        '''
+        The bot that modules should be initialized with
+        '''
+
+        return self.bots[0]
+
+    def init_irc(self):
+        for bot in self.bots:
+            bot.init_irc()
+
+    def init_db(self):
+        self.primary.init_db()
+        for bot in self.bots[1:]:
+            bot.db = self.primary.db
+
+    def start(self):
+        log.info('Starting %d connection(s)', len(self.bots))
+        self.bot_class.run_group(self.bots)
+
+    def shutdown(self):
+        '''
+        Release resources shared by the bots, e.g. flush the chat log
+        '''
+
+        self.primary.shutdown()
@@ -0,0 +1,205 @@
+import collections
+import logging
+import time
+
+import irc.client
+
+log = logging.getLogger('bavi.outbound')
+
+# Queued lines are sent in priority order: replies to commands before
+# output from matchers
+PRIORITY_COMMAND = 0
+PRIORITY_MATCHER = 1
+
+class TokenBucket:
+    '''
+    Token bucket allowing `burst` lines at once, refilled at `rate` lines
+    per second.
+    '''
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._tokens = burst
+        self._last = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(
+                self.burst,
+                self._tokens + (now - self._last) * self.rate
+        )
+        self._last = now
+
+    def take(self):
+        '''
+        Take one token.  Returns False if the bucket is empty.
+        '''
+
+        self._refill()
+        if self._tokens < 1:
+            return False
+
+        self._tokens -= 1
+        return True
+
+class OutboundQueue:
+    '''
+    Per-connection scheduler for outgoing PRIVMSGs.
+
+    Lines are queued per target and sent as the token bucket allows.  Each
+    priority class is served round-robin across targets so one busy channel
+    cannot starve the others, and command replies always go out before
+    matcher output.  With `aggregate` set, short lines waiting for the same
+    target are merged into one PRIVMSG joined by `separator`, as long as
+    the result fits in `budget(target)` bytes.
+
+    Other commands that count against the server's flood limit, such as
+    JOINs, can be queued with enqueue_control().  They are sent before any
+    PRIVMSG, using the same token bucket.
+
+    If the connection is lost while sending, the line being sent is
+    dropped and flushing stops until resume() is called, e.g. once the bot
+    has reconnected.
+
+    All methods must be called from the thread that owns the connection.
+    '''
+
+    def __init__(self, send, rate=0.5, burst=5, max_per_target=20,
+            aggregate=False, separator=' | ', budget=lambda target: 400,
+            clock=time.monotonic):
+        self._send = send
+        self._bucket = TokenBucket(rate, burst, clock=clock)
+        self._queues = [
+                collections.OrderedDict(),
+                collections.OrderedDict()
+        ]
+        self._control = collections.deque()
+        self._max_per_target = max_per_target
+        self._aggregate = aggregate
+        self._separator = separator
+        self._separator_size = len(separator.encode('utf-8'))
+        self._budget = budget
+        self.depth = 0
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+        self.paused = False
+
+    def enqueue(self, target, message, priority=PRIORITY_COMMAND, size=None):
+        '''
+        Queue a line for target.  size is the encoded length of the line,
+        if the caller already knows it.
+
+        Returns False if the line was dropped because the target already has
+        max_per_target lines waiting.
+        '''
+
+        if size is None:
+            size = len(message.encode('utf-8'))
+
+        queue = self._queues[priority].get(target)
+        if queue is None:
+            queue = self._queues[priority][target] = collections.deque()
+        elif len(queue) >= self._max_per_target:
+            self.dropped += 1
+            log.warning('Outbound queue for %s is full; dropping line', target)
+            return False
+
+        queue.append((message, size))
+        self.depth += 1
+        return True
+
+    def enqueue_control(self, send):
+        '''
+        Queue send(), a function that writes one line to the server
+        '''
+
+        self._control.append(send)
+
+    def _next(self):
+        for queues in self._queues:
+            if not queues:
+                continue
+
+            # Take one line from the target at the front, then move it to
+            # the back so targets take turns
+            target, queue = queues.popitem(last=False)
+            line, size = queue.popleft()
+            self.depth -= 1
+
+            if self._aggregate and queue:
+                budget = self._budget(target)
+                parts = [line]
+                while queue and size + self._separator_size + \
+                        queue[0][1] <= budget:
+                    next_line, next_size = queue.popleft()
+                    parts.append(next_line)
+                    size += self._separator_size + next_size
+                    self.depth -= 1
+                    self.merged += 1
+                line = self._separator.join(parts)
+
+            if queue:
+                queues[target] = queue
+
+            return target, line
+
+        return None
+
+    def flush(self):
+        '''
+        Send as many queued lines as the token bucket allows.
+        '''
+
+        while not self.paused and (self._control or self.depth > 0) and \
+                self._bucket.take():
+            try:
+                if self._control:
+                    self._control.popleft()()
+                else:
+                    target, line = self._next()
+                    self._send(target, line)
+            except irc.client.ServerNotConnectedError:
+                self.dropped += 1
+                self.pause()
+                log.warning('Not connected; holding %d queued line(s)',
+                        self.depth + len(self._control))
+                return
+
+            self.sent += 1
+
+    def pause(self):
+        '''
+        Stop sending until resume() is called
+        '''
+
+        self.paused = True
+
+    def resume(self):
+        '''
+        Start sending again, e.g. after reconnecting
+        '''
+
+        self.paused = False
+        self.flush()
+
+    def clear(self):
+        '''
+        Drop everything that is queued, e.g. after a disconnect.
+        '''
+
+        self.dropped += self.depth
+        self.depth = 0
+        self._control.clear()
+        for queues in self._queues:
+            queues.clear()
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'sent': self.sent,
+            'merged': self.merged,
+            'dropped': self.dropped
+        }
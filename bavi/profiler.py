@@ -0,0 +1,225 @@
+import collections
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+log = logging.getLogger('bavi.profiler')
+
+# Seconds between samples
+DEFAULT_INTERVAL = 0.01
+
+# Maximum number of frames recorded per stack
+MAX_DEPTH = 128
+
+# Handler currently running on each thread, by thread ident.  Maintained by
+# the bot around every handler call so samples can be attributed to the
+# command or matcher that caused them.
+_running = {}
+
+def enter_handler(label):
+    '''
+    Mark the current thread as running the handler identified by label.
+    Returns a token to pass to leave_handler().
+    '''
+
+    ident = threading.get_ident()
+    previous = _running.get(ident)
+    _running[ident] = label
+    return previous
+
+def leave_handler(token):
+    ident = threading.get_ident()
+    if token is None:
+        _running.pop(ident, None)
+    else:
+        _running[ident] = token
+
+class SamplingProfiler:
+    '''
+    Statistical profiler that can be started and stopped in a running
+    process.
+
+    A background thread periodically snapshots the stack of every other
+    thread with sys._current_frames().  Identical stacks are counted rather
+    than stored, and each stack is rooted at the handler that was running
+    on that thread (or the thread's name), so the output shows which
+    command or matcher the time was spent in.
+    '''
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._samples = collections.Counter()
+        self._started = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, interval=None):
+        with self._lock:
+            if self._thread is not None:
+                raise RuntimeError('Profiler is already running')
+
+            if interval is not None:
+                self.interval = interval
+
+            self._samples = collections.Counter()
+            self._stop.clear()
+            self._started = time.time()
+            self._thread = threading.Thread(
+                    target=self._run,
+                    name='bavi-profiler',
+                    daemon=True
+            )
+            self._thread.start()
+
+        log.info('Profiler started (interval %gs)', self.interval)
+
+    def stop(self):
+        '''
+        Stop sampling.  Returns a Counter mapping stacks (tuples of frame
+        names, outermost first) to sample counts.
+        '''
+
+        with self._lock:
+            if self._thread is None:
+                raise RuntimeError('Profiler is not running')
+
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+        log.info('Profiler stopped after %d samples', self.sample_count())
+        return self._samples
+
+    def sample_count(self):
+        return sum(self._samples.values())
+
+    def _run(self):
+        me = threading.get_ident()
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+
+                root = _running.get(ident)
+                if root is None:
+                    if ident not in names:
+                        names = dict(
+                            (t.ident, t.name) for t in threading.enumerate()
+                        )
+                    root = names.get(ident, str(ident))
+
+                self._samples[self._stack(root, frame)] += 1
+
+    def _stack(self, root, frame):
+        stack = []
+        while frame is not None and len(stack) < MAX_DEPTH:
+            code = frame.f_code
+            stack.append('{} ({}:{})'.format(
+                code.co_name,
+                os.path.basename(code.co_filename),
+                code.co_firstlineno
+            ))
+            frame = frame.f_back
+
+        stack.append(root)
+        stack.reverse()
+        return tuple(stack)
+
+    def dump(self, samples, directory, fmt='collapsed'):
+        '''
+        Write samples to a new file in directory and return its path.
+
+        fmt is "collapsed" (one "frame;frame;frame count" line per stack, as
+        read by flamegraph.pl and most flame graph tools) or "speedscope".
+        '''
+
+        if fmt not in { 'collapsed', 'speedscope' }:
+            raise ValueError('Unknown profile format: {}'.format(fmt))
+
+        started = self._started or time.time()
+        stamp = '{}.{:03d}'.format(
+                time.strftime('%Y%m%d-%H%M%S', time.localtime(started)),
+                int(started % 1 * 1000)
+        )
+        ext = 'txt' if fmt == 'collapsed' else 'speedscope.json'
+
+        # Never overwrite an earlier profile, even one started in the same
+        # millisecond
+        for n in itertools.count():
+            path = os.path.join(directory, 'bavi-profile-{}{}.{}'.format(
+                stamp,
+                '-{}'.format(n) if n else '',
+                ext
+            ))
+            try:
+                f = open(path, 'x', encoding='utf-8')
+            except FileExistsError:
+                continue
+            break
+
+        with f:
+            if fmt == 'collapsed':
+                for stack, count in samples.most_common():
+                    f.write('{} {}\n'.format(
+                        ';'.join(name.replace(';', ':') for name in stack),
+                        count
+                    ))
+            else:
+                json.dump(self._speedscope(samples, stamp), f)
+
+        log.info('Wrote profile to %s', path)
+        return path
+
+    def _speedscope(self, samples, name):
+        frames = []
+        index = {}
+        stacks = []
+        weights = []
+
+        for stack, count in samples.most_common():
+            ids = []
+            for frame in stack:
+                if frame not in index:
+                    index[frame] = len(frames)
+                    frames.append({ 'name': frame })
+                ids.append(index[frame])
+            stacks.append(ids)
+            weights.append(count * self.interval)
+
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'shared': { 'frames': frames },
+            'profiles': [{
+                'type': 'sampled',
+                'name': 'bavi ' + name,
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': sum(weights),
+                'samples': stacks,
+                'weights': weights
+            }],
+            'exporter': 'bavi'
+        }
+
+    def toggle(self, directory, fmt='collapsed'):
+        '''
+        Start the profiler if it is stopped; otherwise stop it and write the
+        profile.  Returns the path written, or None if it was started.
+        '''
+
+        if not self.running:
+            self.start()
+            return None
+
+        return self.dump(self.stop(), directory, fmt)
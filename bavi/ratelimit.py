@@ -0,0 +1,199 @@
+import logging
+import time
+
+log = logging.getLogger('bavi.ratelimit')
+
+# Idle keys are swept after this many calls to hit()
+SWEEP_INTERVAL = 1024
+
+def parse_budget(value):
+    '''
+    Parse a budget of the form "count/seconds", e.g. "5/60"
+    '''
+
+    try:
+        count, seconds = value.split('/', 1)
+        count, seconds = int(count), float(seconds)
+    except ValueError:
+        raise ValueError('Invalid rate limit "{}"; expected count/seconds'
+                .format(value))
+
+    if count < 1 or seconds <= 0:
+        raise ValueError('Invalid rate limit "{}"'.format(value))
+
+    return count, seconds
+
+class Window:
+    __slots__ = ('start', 'current', 'previous')
+
+    def __init__(self, start):
+        self.start = start
+        self.current = 0
+        self.previous = 0
+
+class SlidingWindowLimiter:
+    '''
+    Allow at most `limit` events per `period` seconds for each key.
+
+    Each key only stores counts for the current and previous fixed windows;
+    the sliding count is estimated by weighting the previous window by how
+    much of it still overlaps the sliding window.  Keys that have been idle
+    for two periods are expired periodically.
+    '''
+
+    def __init__(self, limit, period, clock=time.monotonic):
+        self.limit = limit
+        self.period = period
+        self._clock = clock
+        self._windows = {}
+        self._calls = 0
+
+    def __len__(self):
+        return len(self._windows)
+
+    def _window(self, key, now):
+        window = self._windows.get(key)
+        if window is None:
+            window = self._windows[key] = Window(now)
+            return window
+
+        elapsed = now - window.start
+        if elapsed >= self.period:
+            periods = int(elapsed // self.period)
+            window.previous = window.current if periods == 1 else 0
+            window.current = 0
+            window.start += periods * self.period
+
+        return window
+
+    def _estimate(self, window, now):
+        overlap = 1 - (now - window.start) / self.period
+        return window.previous * overlap + window.current
+
+    def check(self, key):
+        '''
+        Return True if one more event for key would be within the limit
+        '''
+
+        now = self._clock()
+        window = self._windows.get(key)
+        if window is None:
+            return True
+
+        return self._estimate(self._window(key, now), now) + 1 <= self.limit
+
+    def hit(self, key):
+        '''
+        Record an event for key
+        '''
+
+        now = self._clock()
+        self._window(key, now).current += 1
+
+        self._calls += 1
+        if self._calls % SWEEP_INTERVAL == 0:
+            self.sweep(now)
+
+    def sweep(self, now=None):
+        if now is None:
+            now = self._clock()
+
+        idle = [
+            key for key, window in self._windows.items()
+            if now - window.start >= 2 * self.period
+        ]
+        for key in idle:
+            del self._windows[key]
+
+class DispatchLimiter:
+    '''
+    Per-nick, per-channel and per-handler budgets for triggering handlers.
+
+    Configured by the [ratelimit] section:
+
+        PerNick = 10/60       calls by one nick, in any channel
+        PerChannel = 30/60    calls in one channel
+        PerHandler = 5/60     calls of one handler by one nick
+        Notice = False        tell the user when a call is rejected
+
+    Handlers are identified by the module that registered them and the
+    command name, or the function name for a matcher, e.g. "url.title"
+    and "url.title_command".  Budgets for individual handlers can be set
+    in a [ratelimit:handlers] section, e.g. `url.title = 3/60`.
+    '''
+
+    def __init__(self, config, clock=time.monotonic):
+        self._clock = clock
+        self.nick = self._limiter(config, 'PerNick')
+        self.channel = self._limiter(config, 'PerChannel')
+        self.handler = self._limiter(config, 'PerHandler')
+        self.notice = config.getboolean('ratelimit', 'Notice', fallback=False)
+        self.rejected = 0
+
+        self.handlers = {}
+        if config.has_section('ratelimit:handlers'):
+            for name, value in config.items('ratelimit:handlers'):
+                self.handlers[name] = SlidingWindowLimiter(
+                        *parse_budget(value),
+                        clock=clock
+                )
+
+        self._noticed = None
+        if self.notice:
+            period = max(
+                [l.period for l in self._limiters() if l is not None] or [60]
+            )
+            self._noticed = SlidingWindowLimiter(1, period, clock=clock)
+
+    def _limiter(self, config, option):
+        value = config.get('ratelimit', option, fallback=None)
+        if not value:
+            return None
+
+        return SlidingWindowLimiter(*parse_budget(value), clock=self._clock)
+
+    def _limiters(self):
+        return [self.nick, self.channel, self.handler] + \
+                list(self.handlers.values())
+
+    def allow(self, nick, channel, handler_name):
+        '''
+        Check and record one handler call.  Returns False, without recording
+        anything, if any budget would be exceeded.  handler_name is None for
+        a call that reached no handler, e.g. an unknown command, which only
+        counts against the nick and channel budgets.
+        '''
+
+        checks = []
+        if self.nick is not None:
+            checks.append((self.nick, nick))
+        if self.channel is not None:
+            checks.append((self.channel, channel))
+        if handler_name is None:
+            pass
+        elif handler_name in self.handlers:
+            checks.append((self.handlers[handler_name], nick))
+        elif self.handler is not None:
+            checks.append((self.handler, (nick, handler_name)))
+
+        for limiter, key in checks:
+            if not limiter.check(key):
+                self.rejected += 1
+                return False
+
+        for limiter, key in checks:
+            limiter.hit(key)
+
+        return True
+
+    def should_notice(self, nick):
+        '''
+        Return True if a rejected nick should be told about it.  Each nick
+        is told at most once per period.
+        '''
+
+        if self._noticed is None or not self._noticed.check(nick):
+            return False
+
+        self._noticed.hit(nick)
+        return True
@@ -0,0 +1,88 @@
+import irc.bot
+import logging
+import random
+
+log = logging.getLogger('bavi.reconnect')
+
+# Longest JOIN line, not counting the trailing CRLF
+MAX_LINE_BYTES = 510
+
+class Backoff:
+    '''
+    Exponential backoff with jitter for reconnect attempts.
+
+    The n-th delay is picked uniformly between min_interval and
+    min(max_interval, min_interval * 2**n), so the first retry is quick and
+    bots that lost their connections at the same moment (say, in a
+    netsplit) do not all come back at once.  reset() starts over, once a
+    connection has been registered.
+    '''
+
+    def __init__(self, min_interval=2, max_interval=300, rng=random.random):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._rng = rng
+        self.attempts = 0
+
+    def next(self):
+        cap = min(
+                self.max_interval,
+                self.min_interval * 2 ** min(self.attempts, 32)
+        )
+        self.attempts += 1
+        return self.min_interval + (cap - self.min_interval) * self._rng()
+
+    def reset(self):
+        self.attempts = 0
+
+class BackoffReconnect(irc.bot.ReconnectStrategy):
+    '''
+    SingleServerIRCBot reconnect strategy using a Backoff.
+
+    Unlike irc.bot.ExponentialBackoff, the delays start over after a
+    successful connection instead of growing for the life of the process,
+    and each bot gets its own strategy.
+    '''
+
+    def __init__(self, backoff):
+        self.backoff = backoff
+        self.bot = None
+        self._scheduled = False
+
+    def run(self, bot):
+        self.bot = bot
+        if self._scheduled:
+            return
+
+        delay = self.backoff.next()
+        log.info('Reconnecting in %.1f seconds', delay)
+        bot.reactor.scheduler.execute_after(delay, self.check)
+        self._scheduled = True
+
+    def check(self):
+        self._scheduled = False
+        if not self.bot.connection.is_connected():
+            # Schedule the next attempt first: a failed connect does not
+            # cause another disconnect event
+            self.run(self.bot)
+            self.bot.jump_server()
+
+def join_batch(channels, max_targets=None, max_bytes=MAX_LINE_BYTES):
+    '''
+    Take channels from the front of the deque `channels` for one JOIN
+    line, at most max_targets of them (None for no limit) and no more than
+    fit in max_bytes.  Returns the JOIN parameter, e.g. "#a,#b".
+    '''
+
+    batch = [channels.popleft()]
+    size = len('JOIN ') + len(batch[0].encode('utf-8'))
+
+    while channels and (max_targets is None or len(batch) < max_targets):
+        channel_size = len(channels[0].encode('utf-8')) + 1
+        if size + channel_size > max_bytes:
+            break
+
+        batch.append(channels.popleft())
+        size += channel_size
+
+    return ','.join(batch)
@@ -0,0 +1,189 @@
+import contextlib
+import re
+
+from .commands import CommandTrie
+from .matcher import MatcherEngine
+
+class Registry:
+    '''
+    Commands and matchers registered by modules.
+
+    A registry can be shared by several bots (one per IRC network) so that
+    modules are only loaded and registered once per process.
+
+    Everything registered inside a loading() block is remembered as
+    belonging to that module, so it can be removed again by unregister().
+    When the module registers again, e.g. after a reload, its matchers take
+    the places of the ones unregister() removed, in the same order, so
+    matcher priority does not change.
+    '''
+
+    def __init__(self):
+        self.commands = CommandTrie()
+        self.matchers = MatcherEngine()
+        self.limits = {}
+        self.deadlines = {}
+        # Handler -> name of the module that registered it
+        self.owners = {}
+        self.listeners = []
+        self.shutdown_hooks = []
+        # The Sandbox running [sandbox] Modules, if any
+        self.sandbox = None
+
+        # Module name -> (method, args, kwargs) of each registration it made
+        self._owned = {}
+        # Module name -> MatcherEngine key of each matcher it registered, in
+        # the order they were registered
+        self._matcher_keys = {}
+        self._loading = None
+
+    @property
+    def modules(self):
+        '''
+        Names of the modules that have been loaded
+        '''
+
+        return sorted(self._owned)
+
+    @contextlib.contextmanager
+    def loading(self, module):
+        '''
+        Record registrations made inside the block as belonging to module
+        '''
+
+        self._owned.setdefault(module, [])
+        self._loading = module
+        try:
+            yield
+        finally:
+            self._loading = None
+
+    def registrations(self, module):
+        '''
+        What module has registered, as (method, args, kwargs) tuples
+        '''
+
+        return list(self._owned.get(module, []))
+
+    def _record(self, method, *args, **kwargs):
+        if self._loading is not None:
+            self._owned[self._loading].append((method, args, kwargs))
+            if method in { 'add_command', 'add_matcher' }:
+                self.owners[args[1]] = self._loading
+
+    def unregister(self, module):
+        '''
+        Remove everything module registered.  Returns the removed
+        registrations, which can be passed to restore().
+        '''
+
+        registrations = self._owned.pop(module, [])
+        keys = []
+        for method, args, kwargs in registrations:
+            if method == 'add_command':
+                cmd, handler = args
+                for trigger in [cmd] + kwargs['aliases']:
+                    if self.commands.get(trigger) is handler:
+                        del self.commands[trigger]
+            elif method == 'add_matcher':
+                regex, handler = args
+                keys.append(self.matchers.remove(regex, handler))
+            elif method == 'add_listener':
+                handler, = args
+                self.listeners.remove(handler)
+            elif method == 'add_shutdown_hook':
+                handler, = args
+                self.shutdown_hooks.remove(handler)
+
+            self.limits.pop(handler, None)
+            self.deadlines.pop(handler, None)
+            self.owners.pop(handler, None)
+
+        # Keep the keys of matchers that were not registered again since
+        # last time, e.g. if the module's init() failed halfway
+        old_keys = self._matcher_keys.get(module, [])
+        self._matcher_keys[module] = keys + old_keys[len(keys):]
+
+        return registrations
+
+    def _matcher_key(self):
+        '''
+        The key the loading module's next matcher had before it was
+        unregistered, or None
+        '''
+
+        if self._loading is None:
+            return None
+
+        keys = self._matcher_keys.get(self._loading, [])
+        index = sum(
+            1 for method, args, kwargs in self._owned[self._loading]
+            if method == 'add_matcher'
+        )
+        return keys[index] if index < len(keys) else None
+
+    def restore(self, module, registrations):
+        '''
+        Register again what unregister() removed
+        '''
+
+        with self.loading(module):
+            for method, args, kwargs in registrations:
+                getattr(self, method)(*args, **kwargs)
+
+    def add_command(self, cmd, handler, aliases=[], max_concurrency=None,
+            deadline=None):
+        for trigger in [cmd] + aliases:
+            if trigger in self.commands:
+                raise RuntimeError('Command "{}" is already registered'.format(
+                    trigger
+                ))
+
+        for trigger in [cmd] + aliases:
+            self.commands[trigger] = handler
+
+        if max_concurrency is not None:
+            self.limits[handler] = max_concurrency
+
+        if deadline is not None:
+            self.deadlines[handler] = deadline
+
+        self._record(
+                'add_command',
+                cmd,
+                handler,
+                aliases=list(aliases),
+                max_concurrency=max_concurrency,
+                deadline=deadline
+        )
+
+    def add_matcher(self, regex, handler, priority='low',
+            max_concurrency=None, deadline=None):
+        if type(regex) != type(re.compile('')):
+            raise TypeError('regex argument must be a compiled regex')
+
+        self.matchers.add(regex, handler, priority=priority,
+                key=self._matcher_key())
+
+        if max_concurrency is not None:
+            self.limits[handler] = max_concurrency
+
+        if deadline is not None:
+            self.deadlines[handler] = deadline
+
+        self._record(
+                'add_matcher',
+                regex,
+                handler,
+                priority=priority,
+                max_concurrency=max_concurrency,
+                deadline=deadline
+        )
+
+    def add_listener(self, handler):
+        self.listeners.append(handler)
+        self._record('add_listener', handler)
+
+    def add_shutdown_hook(self, fn):
+        self.shutdown_hooks.append(fn)
+        self._record('add_shutdown_hook', fn)
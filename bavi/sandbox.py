@@ -0,0 +1,473 @@
+import asyncio
+import configparser
+import fnmatch
+import importlib
+import inspect
+import irc.strings
+import logging
+import multiprocessing
+import queue
+import re
+import threading
+import time
+
+from .manifest import describe
+from .matcher import required_literal
+from .reconnect import Backoff
+from .registry import Registry
+
+log = logging.getLogger('bavi.sandbox')
+
+# How long to wait for a new worker process to load its modules
+START_TIMEOUT = 30
+
+# How often a waiting call checks for timeouts (and lets the watchdog
+# interrupt it)
+POLL_INTERVAL = 0.1
+
+class SandboxError(Exception):
+    '''
+    A sandboxed handler could not be run
+    '''
+
+class SandboxCrashed(SandboxError):
+    '''
+    The worker process running a handler died
+    '''
+
+class SandboxTimeout(SandboxError):
+    '''
+    A handler ran past [sandbox] Timeout and its worker process was killed
+    '''
+
+_remote_errors = {}
+
+def _remote_error(name, message):
+    '''
+    An exception raised in a worker process, re-created with the same class
+    name so the bot reports it like one raised in-process
+    '''
+
+    cls = _remote_errors.get(name)
+    if cls is None:
+        cls = _remote_errors[name] = type(name, (SandboxError,), {})
+    return cls(message)
+
+class Sandbox:
+    '''
+    Runs the handlers of some modules in a pool of worker processes.
+
+    The sandboxed modules are never imported by the bot.  Each worker
+    process imports them and calls their init() with a SandboxBot, and
+    reports what they registered.  The bot registers a SandboxHandler for
+    each of those handlers.  Calling one sends the call to an idle worker
+    over a pipe, as a pickled tuple, and blocks until the worker is done.
+    Meanwhile it relays the say() and reply_to() calls the handler makes.
+    Sandboxed modules are only loaded with a [workers] pool (see
+    load_sandbox()), so the calling thread is never the connection's.
+
+    A handler that holds the GIL or crashes the interpreter only takes its
+    own process down.  Dead workers are replaced in the background.  A call
+    running longer than `timeout` has its worker killed.
+
+    Sandboxed modules can only register commands and matchers, and have no
+    access to the bot's database or connection.
+    '''
+
+    def __init__(self, config, modules, processes=2, timeout=60,
+            context='spawn'):
+        self.config = config
+        self.modules = modules
+        self._processes = processes
+        self._timeout = timeout
+        self._context = multiprocessing.get_context(context)
+
+        self._idle = queue.Queue()
+        self._workers = set()
+        self._lock = threading.Lock()
+        self._stopping = False
+        self.restarts = 0
+        self.crashes = 0
+
+    def start(self):
+        '''
+        Start the worker processes.  Returns what the modules registered,
+        as a dict of module name to (manifest cache entry, handler names),
+        or raises SandboxError if the first worker failed to start.
+        '''
+
+        self._stopping = False
+        worker = self._spawn()
+        registrations = worker.registrations
+        self._idle.put(worker)
+
+        for i in range(self._processes - 1):
+            self._replace()
+
+        return registrations
+
+    def stop(self):
+        '''
+        Stop the idle worker processes.  Workers in the middle of a call
+        are stopped once it is done (see call()), so that handlers which
+        are already running can finish.
+        '''
+
+        with self._lock:
+            self._stopping = True
+            self._workers.clear()
+
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            worker.kill()
+
+    def _spawn(self):
+        parent, child = self._context.Pipe()
+        process = self._context.Process(
+                target=_worker_main,
+                args=(
+                    child,
+                    self.modules,
+                    _config_dict(self.config),
+                    logging.getLogger().getEffectiveLevel()
+                ),
+                name='bavi-sandbox',
+                daemon=True
+        )
+        process.start()
+        child.close()
+
+        worker = _Worker(process, parent)
+        try:
+            if not parent.poll(START_TIMEOUT):
+                raise SandboxError('Sandbox worker did not start')
+            kind, registrations = parent.recv()
+        except (EOFError, OSError, SandboxError) as e:
+            worker.kill()
+            raise SandboxError('Sandbox worker failed to start: {}'.format(
+                e or 'exited with code {}'.format(process.exitcode)
+            ))
+
+        worker.registrations = registrations
+        with self._lock:
+            if self._stopping:
+                worker.kill()
+                raise SandboxError('Sandbox is stopping')
+            self._workers.add(worker)
+
+        log.info('Started sandbox worker %d', process.pid)
+        return worker
+
+    def _replace(self, dead=None):
+        '''
+        Start a new worker in the background, retrying with backoff
+        '''
+
+        if dead is not None:
+            with self._lock:
+                self._workers.discard(dead)
+            self.restarts += 1
+
+        def run():
+            backoff = Backoff(min_interval=1, max_interval=60)
+            while not self._stopping:
+                try:
+                    self._idle.put(self._spawn())
+                    return
+                except SandboxError as e:
+                    if self._stopping:
+                        return
+                    delay = backoff.next()
+                    log.error('%s; retrying in %.1fs', e, delay)
+                    time.sleep(delay)
+
+        threading.Thread(
+                target=run,
+                name='bavi-sandbox-start',
+                daemon=True
+        ).start()
+
+    def _acquire(self, deadline):
+        while True:
+            if self._stopping:
+                raise SandboxError('Sandbox was stopped')
+
+            try:
+                worker = self._idle.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if time.monotonic() >= deadline:
+                    raise SandboxTimeout('No sandbox worker became free')
+                continue
+
+            if worker.alive:
+                return worker
+            worker.kill()
+            self._replace(worker)
+
+    def call(self, bot, module, index, source, target, message, kwargs):
+        '''
+        Run handler `index` of `module` in a worker process, relaying its
+        output to bot.  Raises what the handler raised, as an exception of
+        the same name.
+        '''
+
+        deadline = time.monotonic() + self._timeout
+        worker = self._acquire(deadline)
+
+        kwargs = dict(kwargs)
+        match = kwargs.pop('match', None)
+        pattern = None
+        if match is not None:
+            pattern = (match.re.pattern, match.re.flags)
+
+        healthy = False
+        try:
+            worker.conn.send((
+                'call',
+                module,
+                index,
+                bot.network,
+                source,
+                target,
+                message,
+                kwargs,
+                pattern
+            ))
+            self._relay(bot, worker, deadline)
+            healthy = True
+        except (EOFError, OSError):
+            self.crashes += 1
+            worker.kill()
+            raise SandboxCrashed(
+                    'Sandbox worker exited with code {}'.format(
+                        worker.process.exitcode
+                    )
+            )
+        except SandboxError as e:
+            # Raised by the handler; the worker is fine
+            healthy = not isinstance(e, SandboxTimeout)
+            raise
+        finally:
+            with self._lock:
+                stopping = self._stopping
+                if healthy and not stopping:
+                    self._idle.put(worker)
+
+            # Killed, or interrupted by the watchdog partway through the
+            # call so its pipe may still hold output for it, or stop() was
+            # called while it was busy
+            if not healthy or stopping:
+                worker.kill()
+            if not healthy and not stopping:
+                self._replace(worker)
+
+    def _relay(self, bot, worker, deadline):
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                log.warning('Killing sandbox worker %d after %gs',
+                        worker.process.pid, self._timeout)
+                worker.kill()
+                raise SandboxTimeout('Timed out after {:g}s'.format(
+                    self._timeout
+                ))
+
+            if not worker.conn.poll(min(remaining, POLL_INTERVAL)):
+                continue
+
+            reply = worker.conn.recv()
+            kind = reply[0]
+            if kind == 'say':
+                bot.say(reply[1], reply[2])
+            elif kind == 'reply_to':
+                bot.reply_to(reply[1], reply[2], reply[3])
+            elif kind == 'error':
+                raise _remote_error(reply[1], reply[2])
+            elif kind == 'done':
+                return
+
+class SandboxHandler:
+    '''
+    Stands in for a sandboxed module's handler in the bot's registry
+    '''
+
+    def __init__(self, sandbox, module, index, name):
+        self.sandbox = sandbox
+        self.module = module
+        self.index = index
+        self.__name__ = name
+
+    def __call__(self, bot, source, target, message, **kwargs):
+        self.sandbox.call(
+                bot,
+                self.module,
+                self.index,
+                source,
+                target,
+                message,
+                kwargs
+        )
+
+class _Worker:
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.registrations = None
+
+    @property
+    def alive(self):
+        return self.process.is_alive()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(1)
+        self.conn.close()
+
+def _config_dict(config):
+    return {
+        section: dict(config.items(section, raw=True))
+        for section in config.sections()
+    }
+
+class SandboxBot:
+    '''
+    The `bot` passed to sandboxed modules, in the worker process.  Handlers
+    can use say(), reply_to(), is_admin(), config and network as usual;
+    what they send is passed on to the real bot.
+    '''
+
+    def __init__(self, config, conn):
+        self.config = config
+        self.network = None
+        self._conn = conn
+        self._registry = Registry()
+        self._admins = [
+            irc.strings.lower(mask.strip())
+            for mask in config.get('bavi', 'Admins', fallback='').split(',')
+            if mask.strip()
+        ]
+
+    def __getattr__(self, name):
+        raise AttributeError(
+                'bot.{} is not available to sandboxed modules'.format(name)
+        )
+
+    def say(self, target, message):
+        self._conn.send(('say', target, message))
+
+    def reply_to(self, source, target, message):
+        self._conn.send(('reply_to', source, target, message))
+
+    def is_admin(self, source):
+        source = irc.strings.lower(str(source))
+        return any(fnmatch.fnmatchcase(source, mask) for mask in self._admins)
+
+    def call_from_thread(self, fn):
+        fn()
+
+    def add_command(self, cmd, handler, aliases=[], max_concurrency=None,
+            deadline=None):
+        self._registry.add_command(
+                cmd,
+                handler,
+                aliases=aliases,
+                max_concurrency=max_concurrency,
+                deadline=deadline
+        )
+
+    def add_matcher(self, regex, handler, priority='low',
+            max_concurrency=None, deadline=None):
+        self._registry.add_matcher(
+                regex,
+                handler,
+                priority=priority,
+                max_concurrency=max_concurrency,
+                deadline=deadline
+        )
+
+    def add_listener(self, handler):
+        self._registry.add_listener(handler)
+
+    def add_shutdown_hook(self, fn):
+        self._registry.add_shutdown_hook(fn)
+
+def _handlers(registrations):
+    # In the order manifest.describe() numbers them
+    handlers = []
+    for method, args, kwargs in registrations:
+        if method in { 'add_command', 'add_matcher' } and \
+                not any(args[1] is handler for handler in handlers):
+            handlers.append(args[1])
+    return handlers
+
+def _worker_main(conn, modules, config_dict, level):
+    logging.basicConfig(
+            level=level,
+            format='%(asctime)-15s [%(levelname)s] sandbox %(process)d '
+                '%(name)s: %(message)s'
+    )
+
+    config = configparser.ConfigParser()
+    config.read_dict(config_dict)
+    bot = SandboxBot(config, conn)
+
+    handlers = {}
+    registrations = {}
+    for name, import_name in modules:
+        try:
+            module = importlib.import_module(import_name)
+            with bot._registry.loading(name):
+                module.init(bot)
+        except Exception:
+            log.exception('Failed to load module "%s"', name)
+            bot._registry.unregister(name)
+            continue
+
+        recorded = bot._registry.registrations(name)
+        entry = describe(recorded, required_literal)
+        if entry is None:
+            log.error('Module "%s" registers listeners or shutdown hooks, '
+                    'which cannot run in the sandbox', name)
+            continue
+
+        handlers[name] = _handlers(recorded)
+        registrations[name] = (
+                entry,
+                [getattr(h, '__name__', repr(h)) for h in handlers[name]]
+        )
+
+    conn.send(('ready', registrations))
+
+    while True:
+        try:
+            call = conn.recv()
+        except EOFError:
+            return
+
+        (kind, module, index, network, source, target, message, kwargs,
+                pattern) = call
+        bot.network = network
+        if pattern is not None:
+            kwargs['match'] = re.compile(*pattern).search(message)
+
+        try:
+            result = handlers[module][index](
+                    bot,
+                    source,
+                    target,
+                    message,
+                    **kwargs
+            )
+            if inspect.isawaitable(result):
+                async def wait():
+                    await result
+                asyncio.run(wait())
+        except Exception as e:
+            log.exception('Sandboxed handler failed')
+            conn.send(('error', type(e).__name__, str(e)))
+        else:
+            conn.send(('done',))
@@ -0,0 +1,88 @@
+import logging
+import time
+
+log = logging.getLogger('bavi.startup')
+
+# Modules listed by name in the report, slowest first
+SLOWEST_MODULES = 3
+
+class StartupReport:
+    '''
+    Times the phases of startup, from the first import to the moment every
+    connection has been welcomed by its server, and logs a one-line
+    breakdown, e.g.
+
+      Started in 612ms: import 201ms, setup 12ms, db 3ms, modules 15ms
+      (url 9ms, tz 4ms, history 1ms), connect 381ms
+    '''
+
+    def __init__(self, started=None, clock=time.perf_counter):
+        self._clock = clock
+        self.started = clock() if started is None else started
+        self.phases = []
+        self.modules = {}
+        self._mark = self.started
+        self._waiting = set()
+        self.done = False
+
+    def mark(self, phase):
+        '''
+        End a phase that ran since the previous mark (or since `started`)
+        '''
+
+        now = self._clock()
+        self.phases.append((phase, now - self._mark))
+        self._mark = now
+
+    def add_modules(self, timings):
+        '''
+        Record per-module (import seconds, init seconds) from
+        load_modules()
+        '''
+
+        self.modules.update(timings)
+
+    def wait_for_connect(self, bots):
+        '''
+        Finish the report with a "connect" phase, lasting from the previous
+        mark until every bot has been welcomed by its server
+        '''
+
+        self._waiting = set(bots)
+        for bot in bots:
+            bot.add_connect_hook(self._connected)
+
+    def _connected(self, bot):
+        if self.done or bot not in self._waiting:
+            return
+
+        self._waiting.discard(bot)
+        if not self._waiting:
+            self.mark('connect')
+            self.done = True
+            log.info('%s', self.format())
+
+    @property
+    def total(self):
+        return self._mark - self.started
+
+    def format(self):
+        parts = []
+        for phase, seconds in self.phases:
+            part = '{} {}'.format(phase, _ms(seconds))
+            if phase == 'modules' and self.modules:
+                slowest = sorted(
+                        self.modules.items(),
+                        key=lambda item: sum(item[1]),
+                        reverse=True
+                )[:SLOWEST_MODULES]
+                part += ' ({})'.format(', '.join(
+                    '{} {}'.format(name, _ms(sum(times)))
+                    for name, times in slowest
+                ))
+            parts.append(part)
+
+        return 'Started in {}: {}'.format(_ms(self.total), ', '.join(parts))
+
+def _ms(seconds):
+    return '{:.0f}ms'.format(seconds * 1000)
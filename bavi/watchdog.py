@@ -0,0 +1,228 @@
+import collections
+import ctypes
+import logging
+import threading
+import time
+
+log = logging.getLogger('bavi.watchdog')
+
+class HandlerTimeout(BaseException):
+    '''
+    Raised inside a handler that ran past its deadline.
+
+    Like KeyboardInterrupt it derives from BaseException, so handlers that
+    catch Exception do not swallow it by accident.
+    '''
+
+def _set_async_exc(ident, exc):
+    if not hasattr(ctypes, 'pythonapi'):
+        return False
+
+    return ctypes.pythonapi.PyThreadState_SetAsyncExc(
+            ctypes.c_ulong(ident),
+            exc
+    ) == 1
+
+class _Call:
+    __slots__ = ('label', 'ident', 'deadline', 'on_overrun', 'interrupt',
+            'overrun', 'interrupted')
+
+    def __init__(self, label, ident, deadline, on_overrun, interrupt):
+        self.label = label
+        self.ident = ident
+        self.deadline = deadline
+        self.on_overrun = on_overrun
+        self.interrupt = interrupt
+        self.overrun = False
+        self.interrupted = False
+
+class Watchdog:
+    '''
+    Detects handlers that run past their deadline.
+
+    watch() and done() bracket a handler call.  If done() has not been
+    called by the deadline, a background thread calls the on_overrun
+    callback and, with `interrupt` set, raises HandlerTimeout in the
+    handler's thread.  That stops handlers stuck in Python code; a call
+    blocked in C (a socket read, a regex match) is only stopped once it
+    returns.
+
+    The exception can be raised anywhere in the thread, e.g. inside a
+    `with lock:` block, so only interrupt threads that do nothing but run
+    handlers (see watch()), never the connection's thread.
+
+    Every overrun counts as a strike against the handler's label.  A label
+    with `strikes` overruns within `window` seconds is disabled for
+    `disable_for` seconds.
+    '''
+
+    def __init__(self, strikes=3, window=600, disable_for=900,
+            interrupt=True, clock=time.monotonic):
+        self._strikes = strikes
+        self._window = window
+        self._disable_for = disable_for
+        self._interrupt = interrupt
+        self._clock = clock
+
+        self._cond = threading.Condition(threading.Lock())
+        self._calls = set()
+        self._history = collections.defaultdict(collections.deque)
+        self._disabled = {}
+        self._thread = None
+        self._stopping = False
+        # When the watchdog thread will next wake up by itself (None: not
+        # until notified), so watch() only has to wake it for an earlier
+        # deadline
+        self._wake_at = None
+        self.overruns = 0
+
+    def watch(self, label, deadline, on_overrun=None, interrupt=True):
+        '''
+        Start watching a call made from the current thread.  With
+        interrupt false, an overrun is reported but the call is left to
+        finish.  Returns a token for done(), or None if deadline is None
+        or 0.
+        '''
+
+        if not deadline:
+            return None
+
+        call = _Call(
+                label,
+                threading.get_ident(),
+                self._clock() + deadline,
+                on_overrun,
+                interrupt
+        )
+
+        with self._cond:
+            if self._thread is None and not self._stopping:
+                self._thread = threading.Thread(
+                        target=self._run,
+                        name='bavi-watchdog',
+                        daemon=True
+                )
+                self._thread.start()
+
+            self._calls.add(call)
+            if self._wake_at is None or call.deadline < self._wake_at:
+                self._wake_at = call.deadline
+                self._cond.notify()
+
+        return call
+
+    def done(self, call):
+        '''
+        Stop watching a call.  Must be called from the thread that called
+        watch().  Returns True if the call overran its deadline.
+        '''
+
+        if call is None:
+            return False
+
+        with self._cond:
+            self._calls.discard(call)
+            if call.interrupted:
+                # Cancel the HandlerTimeout if it has not been raised yet,
+                # so it cannot escape into the caller
+                _set_async_exc(call.ident, None)
+                call.interrupted = False
+
+        return call.overrun
+
+    def strike(self, label):
+        '''
+        Record an overrun by label, e.g. a coroutine handler that timed
+        out.  Returns True if label is now disabled.
+        '''
+
+        now = self._clock()
+        with self._cond:
+            self.overruns += 1
+            history = self._history[label]
+            history.append(now)
+            while history and history[0] <= now - self._window:
+                history.popleft()
+
+            if self._strikes and len(history) >= self._strikes:
+                history.clear()
+                self._disabled[label] = now + self._disable_for
+                log.warning(
+                        'Disabling %s for %ds after repeated timeouts',
+                        label,
+                        self._disable_for
+                )
+                return True
+
+        return False
+
+    def disabled(self, label):
+        '''
+        Seconds until label is enabled again, or 0 if it is enabled
+        '''
+
+        until = self._disabled.get(label)
+        if until is None:
+            return 0
+
+        remaining = until - self._clock()
+        if remaining <= 0:
+            with self._cond:
+                self._disabled.pop(label, None)
+            return 0
+
+        return remaining
+
+    def disabled_count(self):
+        return sum(1 for label in list(self._disabled) if self.disabled(label))
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+            thread = self._thread
+
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        while True:
+            overrun = []
+            with self._cond:
+                if self._stopping:
+                    return
+
+                now = self._clock()
+                timeout = None
+                for call in self._calls:
+                    if call.overrun:
+                        continue
+                    if call.deadline <= now:
+                        call.overrun = True
+                        overrun.append(call)
+                    elif timeout is None or call.deadline - now < timeout:
+                        timeout = call.deadline - now
+
+                if not overrun:
+                    self._wake_at = None if timeout is None else now + timeout
+                    self._cond.wait(timeout)
+                    continue
+
+            for call in overrun:
+                log.warning('%s overran its deadline', call.label)
+                disabled = self.strike(call.label)
+                if call.on_overrun is not None:
+                    try:
+                        call.on_overrun(disabled)
+                    except Exception:
+                        log.exception('Overrun callback for %s failed',
+                                call.label)
+
+                if self._interrupt and call.interrupt:
+                    with self._cond:
+                        # Only if the call has not finished in the meantime
+                        if call in self._calls:
+                            call.interrupted = _set_async_exc(
+                                call.ident,
+                                ctypes.py_object(HandlerTimeout)
+                            )
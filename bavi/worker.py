@@ -0,0 +1,184 @@
+import collections
+import concurrent.futures
+import logging
+import threading
+
+log = logging.getLogger('bavi.worker')
+
+class Job:
+    __slots__ = ('channel', 'handler', 'fn', 'outputs', 'done', 'abandoned')
+
+    def __init__(self, channel, handler, fn):
+        self.channel = channel
+        self.handler = handler
+        self.fn = fn
+        self.outputs = []
+        self.done = False
+        self.abandoned = False
+
+class HandlerPool:
+    '''
+    Bounded thread pool for running command and matcher handlers off of the
+    IRC reactor thread.
+
+    Handlers never touch the connection directly from a worker thread.
+    Anything a job wants to send is recorded with emit() and later replayed
+    on the reactor thread by drain().  Output is released per channel in the
+    order the jobs were submitted, so a slow handler holds back the replies
+    of later handlers in the same channel but not in other channels.
+    '''
+
+    def __init__(self, threads=4, max_pending=64, wakeup=None):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=threads
+        )
+        self._max_pending = max_pending
+        self.wakeup = wakeup
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pending = 0
+        self._running = collections.Counter()
+        self._waiting = collections.defaultdict(collections.deque)
+        self._channels = collections.OrderedDict()
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def submit(self, channel, handler, fn, limit=None):
+        '''
+        Queue fn to run on a worker thread.
+
+        At most `limit` jobs for the same handler run at once; the rest wait
+        for a free slot.  Returns False if the pool is already holding
+        max_pending jobs and the job was rejected.
+        '''
+
+        job = Job(channel, handler, fn)
+
+        with self._lock:
+            if self._pending >= self._max_pending:
+                return False
+
+            self._pending += 1
+            if channel not in self._channels:
+                self._channels[channel] = collections.deque()
+            self._channels[channel].append(job)
+
+            if limit is None or self._running[handler] < limit:
+                self._start(job)
+            else:
+                self._waiting[handler].append(job)
+
+        return True
+
+    def _start(self, job):
+        # Must be called with self._lock held
+        self._running[job.handler] += 1
+        self._executor.submit(self._run, job)
+
+    def _run(self, job):
+        self._local.job = job
+        try:
+            job.fn()
+        except BaseException:
+            log.exception('Uncaught exception in worker job')
+        finally:
+            self._local.job = None
+            with self._lock:
+                job.done = True
+                self._pending -= 1
+                self._running[job.handler] -= 1
+                waiting = self._waiting.get(job.handler)
+                if waiting:
+                    self._start(waiting.popleft())
+                    if not waiting:
+                        del self._waiting[job.handler]
+                elif self._running[job.handler] == 0:
+                    del self._running[job.handler]
+
+            self._notify()
+
+    def _notify(self):
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def current_job(self):
+        '''
+        The job running on the current thread, or None
+        '''
+
+        return getattr(self._local, 'job', None)
+
+    def abandon(self, job):
+        '''
+        Give up on a job that is taking too long: discard its output, now
+        and later, so it no longer holds back output from later jobs in the
+        same channel.  The worker thread stays busy until the job returns.
+        '''
+
+        with self._lock:
+            if job.done or job.abandoned:
+                return
+
+            job.abandoned = True
+            job.outputs = []
+            jobs = self._channels.get(job.channel)
+            if jobs is not None:
+                jobs.remove(job)
+                if not jobs:
+                    del self._channels[job.channel]
+
+        self._notify()
+
+    def emit(self, fn):
+        '''
+        Record fn to be called on the reactor thread on behalf of the job
+        running in the current thread.
+
+        Returns False if the current thread is not running a job, in which
+        case the caller should perform the action itself.
+        '''
+
+        job = getattr(self._local, 'job', None)
+        if job is None:
+            return False
+
+        with self._lock:
+            if job.abandoned:
+                return True
+            job.outputs.append(fn)
+
+        self._notify()
+        return True
+
+    def drain(self):
+        '''
+        Run all output that is ready to be released.  Must be called from
+        the reactor thread.
+        '''
+
+        ready = []
+        with self._lock:
+            for channel in list(self._channels):
+                jobs = self._channels[channel]
+                while jobs:
+                    head = jobs[0]
+                    ready.extend(head.outputs)
+                    head.outputs = []
+                    if not head.done:
+                        break
+                    jobs.popleft()
+
+                if not jobs:
+                    del self._channels[channel]
+
+        for fn in ready:
+            try:
+                fn()
+            except BaseException:
+                log.exception('Failed to deliver worker output')
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+        self.drain()
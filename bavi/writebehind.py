@@ -0,0 +1,132 @@
+import logging
+import threading
+import time
+
+from .metrics import Histogram
+
+log = logging.getLogger('bavi.writebehind')
+
+class QueueFull(Exception):
+    '''
+    A write-behind queue stayed full for longer than its timeout
+    '''
+
+class WriteBehind:
+    '''
+    Writes a module's state to the database in the background, so a
+    handler can reply without waiting for SQLite.
+
+    put() hands a write to the database's writer thread (see
+    Database.submit()) and returns at once.  Until the write has been
+    committed, read() returns the value it is writing, so the module sees
+    its own writes.  Once it has been committed (or has failed), reads go
+    to the database again.
+
+    At most `max_pending` writes are waiting at a time.  put() blocks
+    while the queue is full, for up to `timeout` seconds, then raises
+    QueueFull.  Pending writes are committed by Database.close() at
+    shutdown, after the handlers that made them have finished.
+    '''
+
+    def __init__(self, db, name, max_pending=1000, timeout=5.0,
+            clock=time.monotonic):
+        self.db = db
+        self.name = name
+        self._timeout = timeout
+        self._clock = clock
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+        # Key -> (sequence number, value) of the latest pending write
+        self._overlay = {}
+        # Sequence number -> time queued, oldest first
+        self._pending = {}
+        self._seq = 0
+
+        self.lag = Histogram()
+        self.written = 0
+        self.failed = 0
+        self.rejected = 0
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def oldest(self):
+        '''
+        Seconds the oldest pending write has been waiting, or 0
+        '''
+
+        with self._lock:
+            for queued in self._pending.values():
+                return self._clock() - queued
+        return 0
+
+    def put(self, key, value, fn, *args):
+        '''
+        Queue fn(conn, *args) to be run by the database's writer, and have
+        read(key) return value until it has been committed
+        '''
+
+        if not self._slots.acquire(timeout=self._timeout):
+            self.rejected += 1
+            raise QueueFull('{} write-behind queue is full'.format(self.name))
+
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            self._overlay[key] = (seq, value)
+            self._pending[seq] = self._clock()
+
+        try:
+            future = self.db.submit(fn, *args)
+        except BaseException:
+            self._finish(key, seq)
+            raise
+
+        future.add_done_callback(lambda future: self._done(key, seq, future))
+
+    def read(self, key, load, *args):
+        '''
+        The value of the pending write to key, if there is one, or else
+        load(*args)
+        '''
+
+        with self._lock:
+            entry = self._overlay.get(key)
+        if entry is not None:
+            return entry[1]
+        return load(*args)
+
+    def flush(self, timeout=None):
+        '''
+        Wait until every write queued so far has been committed.  Returns
+        False if some were still pending after timeout seconds.
+        '''
+
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._pending, timeout)
+
+    def _done(self, key, seq, future):
+        self._finish(key, seq, record_lag=True)
+
+        e = future.exception()
+        if e is None:
+            self.written += 1
+        else:
+            self.failed += 1
+            log.error('%s write-behind failed', self.name, exc_info=e)
+
+    def _finish(self, key, seq, record_lag=False):
+        with self._idle:
+            entry = self._overlay.get(key)
+            if entry is not None and entry[0] == seq:
+                del self._overlay[key]
+            queued = self._pending.pop(seq)
+            # Recorded before flush() can return
+            if record_lag:
+                self.lag.observe(self._clock() - queued)
+            if not self._pending:
+                self._idle.notify_all()
+        self._slots.release()
@@ -0,0 +1,165 @@
+'''
+Compares channel state tracking with irc.bot's per-channel dicts against
+bavi.channels.ChannelStore: memory held after joining channels full of
+users, and time spent handling the NAMES replies.
+
+Users are spread over the channels so that each one is in --overlap of
+them, as on a network where people sit in several channels.
+
+    python3 -m bench.channels --users 50000 --channels 20 --overlap 3
+'''
+
+import argparse
+import gc
+import random
+import sys
+import time
+import tracemalloc
+import types
+
+import irc.bot
+import irc.dict
+from irc.client import Event, NickMask
+
+from bavi.channels import ChannelStore
+
+NICK = 'BenchBot'
+
+# Nicks per 353 line, about what servers send
+NAMES_PER_LINE = 40
+
+class FakeConnection:
+    def __init__(self):
+        self.features = types.SimpleNamespace(prefix={ '@': 'o', '+': 'v' })
+
+    def get_nickname(self):
+        return NICK
+
+def memberships(users, channels, overlap, seed=0):
+    '''
+    Return {channel: [nick, ...]} with each of `users` nicks in `overlap`
+    random channels, some of them with a mode prefix
+    '''
+
+    rng = random.Random(seed)
+    names = ['#chan{}'.format(i) for i in range(channels)]
+    members = { name: [] for name in names }
+    for i in range(users):
+        nick = 'user{}'.format(i)
+        for name in rng.sample(names, min(channels, overlap)):
+            prefix = rng.choice(['@', '+'] + [''] * 48)
+            members[name].append(prefix + nick)
+    return members
+
+def make_events(members):
+    events = []
+    for name, nicks in members.items():
+        events.append(Event('join', NickMask(NICK + '!bot@host'), name))
+        for i in range(0, len(nicks), NAMES_PER_LINE):
+            events.append(Event('namreply', 'server', NICK, [
+                '=', name, ' '.join(nicks[i:i + NAMES_PER_LINE])
+            ]))
+        events.append(Event('endofnames', 'server', NICK, [name, '']))
+    return events
+
+def full_store(connection):
+    '''
+    irc.bot's tracking, run against a stand-in for the bot
+    '''
+
+    bot = types.SimpleNamespace(
+            channels=irc.dict.IRCDict(),
+            connection=connection
+    )
+    handlers = {
+        'join': irc.bot.SingleServerIRCBot._on_join,
+        'namreply': irc.bot.SingleServerIRCBot._on_namreply
+    }
+
+    def handle(event):
+        handler = handlers.get(event.type)
+        if handler is not None:
+            handler(bot, connection, event)
+
+    return bot.channels, handle
+
+def compact_store(connection):
+    store = ChannelStore()
+
+    def handle(event):
+        getattr(store, '_on_' + event.type)(connection, event)
+
+    return store, handle
+
+def measure(make_store, events):
+    '''
+    Returns (seconds to handle events, bytes held by the store afterwards).
+    Memory is measured in a second pass, as tracemalloc slows everything
+    down.
+    '''
+
+    store, handle = make_store(FakeConnection())
+    start = time.perf_counter()
+    for event in events:
+        handle(event)
+    elapsed = time.perf_counter() - start
+    del store, handle
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        store, handle = make_store(FakeConnection())
+        for event in events:
+            handle(event)
+        gc.collect()
+        held, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return elapsed, held
+
+def run(users, channels, overlap, seed=0):
+    members = memberships(users, channels, overlap, seed=seed)
+    events = make_events(members)
+
+    results = {
+        'users': users,
+        'channels': channels,
+        'memberships': sum(len(nicks) for nicks in members.values())
+    }
+    stores = (('full', full_store), ('compact', compact_store))
+    for name, make_store in stores:
+        elapsed, held = measure(make_store, events)
+        results[name] = { 'seconds': elapsed, 'bytes': held }
+
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='Benchmark channel member tracking'
+    )
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--overlap', type=int, default=3,
+            help='channels each user is in')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    results = run(args.users, args.channels, args.overlap, seed=args.seed)
+
+    print('{} users, {} channels, {} memberships'.format(
+        results['users'],
+        results['channels'],
+        results['memberships']
+    ))
+    for name in ('full', 'compact'):
+        print('{:8} {:8.1f}ms {:10.1f} bytes/membership'.format(
+            name,
+            results[name]['seconds'] * 1000,
+            results[name]['bytes'] / results['memberships']
+        ))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
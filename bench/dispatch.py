@@ -0,0 +1,429 @@
+'''
+Replays a corpus of channel messages through Bot.on_pubmsg and reports
+throughput, per-message latency and memory allocated per message.
+
+The bot loads the bundled random, tz and url modules against a fake
+connection and an in-memory database; the url module's page fetch is
+replaced with a canned title so no network access happens.
+
+    python3 -m bench.dispatch --messages 20000 --output results.json
+    python3 -m bench.dispatch --compare results.json
+
+A recorded corpus has one message per line as
+"nick!user@host<TAB>#channel<TAB>message".
+'''
+
+import argparse
+import configparser
+import gc
+import json
+import logging
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+from irc.client import Event, NickMask
+
+import bavi.bot
+import bavi.modules.random
+import bavi.modules.tz
+import bavi.modules.url
+
+NICK = 'BenchBot'
+CHANNELS = ('#bench', '#bench2', '#bench3')
+
+# Default share of each kind of line in a synthetic corpus
+DEFAULT_MIX = {
+    'commands': 0.15,
+    'addressed': 0.05,
+    'urls': 0.10,
+    'chatter': 0.70
+}
+
+# Results checked by --compare; latency_max_seconds is left out as it is
+# mostly noise.  Only messages_per_second improves by going up.
+COMPARED = (
+    'messages_per_second',
+    'latency_p50_seconds',
+    'latency_p99_seconds',
+    'bytes_allocated_per_message',
+    'blocks_retained_per_message'
+)
+HIGHER_IS_BETTER = { 'messages_per_second' }
+
+WORDS = (
+    'the a of to and in is it you that he was for on are with as his they '
+    'be at one have this from or had by word but what some we can out other '
+    'were all there when up use your how said an each she which do their '
+    'time if will way about many then them write would like so these her '
+    'long make thing see him two has look more day could go come did number '
+    'sound no most people my over know water than call first who may down '
+    'side been now find any new work part take get place made live where '
+    'after back little only round man year came show every good me give our'
+).split()
+
+COMMANDS = (
+    'choose tea, coffee, water',
+    'pick red|green|blue',
+    'choose one',
+    'time',
+    'time someone',
+    'settz Europe/Berlin',
+    'settz Not/AZone',
+    'ti',
+    'nosuchcommand foo',
+)
+
+URLS = (
+    'https://example.com/',
+    'https://www.example.org/some/path?query=1',
+    'http://news.example.net/2020/01/article.html',
+    'https://example.com/image.png',
+    'http://93.184.216.34/index.html',
+)
+
+class FakeConnection:
+    '''
+    Stands in for irc.client.ServerConnection, counting what is sent
+    '''
+
+    def __init__(self):
+        self.sent = 0
+
+    def get_nickname(self):
+        return NICK
+
+    def privmsg(self, target, message):
+        self.sent += 1
+
+    def notice(self, target, message):
+        self.sent += 1
+
+def chatter(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 20)))
+
+def synthetic_corpus(count, seed=0, mix=DEFAULT_MIX):
+    '''
+    Return a list of (source, target, message) tuples mixing commands,
+    lines addressed to the bot, lines containing URLs and plain chatter in
+    the proportions given by mix.
+    '''
+
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    nicks = ['user{}'.format(i) for i in range(50)]
+
+    corpus = []
+    for kind in rng.choices(kinds, weights, k=count):
+        nick = rng.choice(nicks)
+        source = '{0}!{0}@host{1}.example'.format(nick, len(nick))
+        target = rng.choice(CHANNELS)
+
+        if kind == 'commands':
+            message = '.' + rng.choice(COMMANDS)
+        elif kind == 'addressed':
+            message = '{}: {}'.format(NICK, rng.choice(COMMANDS))
+        elif kind == 'urls':
+            words = chatter(rng).split()
+            words.insert(rng.randint(0, len(words)), rng.choice(URLS))
+            message = ' '.join(words)
+        elif kind == 'chatter':
+            message = chatter(rng)
+        else:
+            raise ValueError('Unknown corpus line kind: {}'.format(kind))
+
+        corpus.append((source, target, message))
+
+    return corpus
+
+def load_corpus(path):
+    corpus = []
+    with open(path, encoding='utf-8') as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.rstrip('\r\n')
+            if not line or line.startswith('#'):
+                continue
+
+            parts = line.split('\t', 2)
+            if len(parts) != 3:
+                raise ValueError('{}:{}: expected 3 tab-separated '
+                        'fields'.format(path, lineno))
+            corpus.append(tuple(parts))
+
+    return corpus
+
+def parse_mix(spec):
+    mix = {}
+    for item in spec.split(','):
+        kind, _, share = item.partition('=')
+        if kind.strip() not in DEFAULT_MIX:
+            raise ValueError('Unknown corpus line kind: {}'.format(kind))
+        mix[kind.strip()] = float(share)
+    return mix
+
+def make_bot(threads=0):
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'irc': { 'Nickname': NICK },
+        'sqlite3': { 'Filename': ':memory:' },
+        # Never hold lines back, so output cost is part of the measurement
+        'outbound': { 'Rate': '1000000', 'Burst': '1000000' },
+        'workers': { 'Threads': str(threads) }
+    })
+
+    bot = bavi.bot.Bot(config)
+    bot.connection = FakeConnection()
+    bot.channels = set(CHANNELS)
+    bot.init_db()
+
+    for module in (bavi.modules.random, bavi.modules.tz, bavi.modules.url):
+        module.init(bot)
+
+    return bot
+
+def make_events(corpus):
+    return [
+        Event('pubmsg', NickMask(source), target, [message])
+        for source, target, message in corpus
+    ]
+
+def classify(bot, event):
+    '''
+    Return how the bot will treat event: "command", "matcher" or "ignored"
+    '''
+
+    msg = event.arguments[0].strip()
+    if bot._parse_command(msg) is not None:
+        return 'command'
+    if bot._registry.matchers.match(msg) is not None:
+        return 'matcher'
+    return 'ignored'
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, int(q * len(ordered)))
+    return ordered[index]
+
+def time_pass(bot, events):
+    '''
+    Dispatch every event once, returning (elapsed, latencies)
+    '''
+
+    clock = time.perf_counter
+    latencies = []
+    append = latencies.append
+    on_pubmsg = bot.on_pubmsg
+
+    start = clock()
+    for event in events:
+        t = clock()
+        on_pubmsg(None, event)
+        append(clock() - t)
+    elapsed = clock() - start
+
+    return elapsed, latencies
+
+def allocation_pass(bot, events):
+    '''
+    Dispatch every event under tracemalloc.  Returns the mean number of
+    bytes allocated while handling a message (the peak above the starting
+    point, so short-lived objects count) and the mean number of memory
+    blocks still alive afterwards.
+    '''
+
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    try:
+        total = 0
+        for event in events:
+            _reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            bot.on_pubmsg(None, event)
+            _, peak = tracemalloc.get_traced_memory()
+            total += peak - before
+    finally:
+        tracemalloc.stop()
+    gc.collect()
+
+    return (
+        total / len(events),
+        (sys.getallocatedblocks() - blocks) / len(events)
+    )
+
+def _reset_peak():
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    else:
+        # Python < 3.9: restarting clears the traces, so the peak starts
+        # from zero again
+        tracemalloc.stop()
+        tracemalloc.start()
+
+def run(corpus, repeat=3, warmup=1000, threads=0):
+    '''
+    Benchmark dispatch of corpus and return the results as a dict
+    '''
+
+    if not corpus:
+        raise ValueError('Corpus is empty')
+
+    with mock.patch.object(
+            bavi.modules.url,
+            'get_http_title',
+            return_value='Example Domain'):
+        bot = make_bot(threads)
+        events = make_events(corpus)
+
+        # Fill caches (command resolution, matcher gate, encoder budgets)
+        for event in events[:warmup]:
+            bot.on_pubmsg(None, event)
+
+        kinds = [classify(bot, event) for event in events]
+        passes = [time_pass(bot, events) for _ in range(repeat)]
+        elapsed, latencies = min(passes, key=lambda p: p[0])
+        bytes_per_message, blocks_per_message = allocation_pass(bot, events)
+
+        if bot._pool is not None:
+            bot._pool.shutdown()
+
+    by_kind = {}
+    for kind, latency in zip(kinds, latencies):
+        by_kind.setdefault(kind, []).append(latency)
+    for kind, values in by_kind.items():
+        values.sort()
+        by_kind[kind] = {
+            'messages': len(values),
+            'p50_seconds': percentile(values, 0.5),
+            'p99_seconds': percentile(values, 0.99)
+        }
+
+    handlers = dict(
+        (label, { 'calls': stats.calls, 'errors': stats.errors })
+        for label, stats in bot.metrics.handler_stats()
+    )
+    latencies.sort()
+
+    return {
+        'messages': len(events),
+        'repeat': repeat,
+        'messages_per_second': len(events) / elapsed,
+        'latency_p50_seconds': percentile(latencies, 0.5),
+        'latency_p99_seconds': percentile(latencies, 0.99),
+        'latency_max_seconds': latencies[-1],
+        'bytes_allocated_per_message': bytes_per_message,
+        'blocks_retained_per_message': blocks_per_message,
+        'latency_by_kind': by_kind,
+        'lines_sent': bot.connection.sent,
+        'handlers': handlers
+    }
+
+def compare(baseline, results, threshold):
+    '''
+    Compare the COMPARED numbers in results against baseline.  Returns
+    a list of (metric, old, new, change, regressed) tuples, where change is
+    the relative difference and regressed is True if the metric got worse
+    by more than threshold.
+    '''
+
+    rows = []
+    for metric in COMPARED:
+        old = baseline.get(metric)
+        new = results.get(metric)
+        if not old or new is None:
+            continue
+
+        change = (new - old) / abs(old)
+        if metric in HIGHER_IS_BETTER:
+            regressed = change < -threshold
+        else:
+            regressed = change > threshold
+        rows.append((metric, old, new, change, regressed))
+
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='Benchmark message dispatch by replaying a corpus'
+    )
+    parser.add_argument('--corpus', help='recorded corpus (TSV)')
+    parser.add_argument('--messages', type=int, default=20000,
+            help='size of the synthetic corpus')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mix',
+            help='synthetic corpus mix, e.g. commands=0.2,chatter=0.8')
+    parser.add_argument('--repeat', type=int, default=3,
+            help='timed passes over the corpus; the fastest is reported')
+    parser.add_argument('--warmup', type=int, default=1000)
+    parser.add_argument('--threads', type=int, default=0,
+            help='worker threads; latency then covers only submission')
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+            help='relative change counted as a regression')
+    args = parser.parse_args(argv)
+
+    # Handlers log failures (e.g. .settz with a bad zone) on purpose
+    logging.disable(logging.CRITICAL)
+
+    if args.corpus:
+        corpus = load_corpus(args.corpus)
+        source = { 'file': args.corpus }
+    else:
+        mix = parse_mix(args.mix) if args.mix else DEFAULT_MIX
+        corpus = synthetic_corpus(args.messages, seed=args.seed, mix=mix)
+        source = { 'synthetic': mix, 'seed': args.seed }
+
+    results = run(
+            corpus,
+            repeat=args.repeat,
+            warmup=args.warmup,
+            threads=args.threads
+    )
+    results['corpus'] = source
+    results['python'] = platform.python_version()
+    results['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+
+    print('{} messages: {:.0f} msg/s, p50 {:.1f}us, p99 {:.1f}us, '
+          '{:.0f} bytes/msg allocated'.format(
+              results['messages'],
+              results['messages_per_second'],
+              results['latency_p50_seconds'] * 1e6,
+              results['latency_p99_seconds'] * 1e6,
+              results['bytes_allocated_per_message']
+          ))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        regressed = False
+        for metric, old, new, change, worse in compare(
+                baseline,
+                results,
+                args.threshold):
+            print('{:32} {:>14.6g} {:>14.6g} {:>+8.1%}{}'.format(
+                metric,
+                old,
+                new,
+                change,
+                '  REGRESSION' if worse else ''
+            ))
+            regressed = regressed or worse
+
+        if regressed:
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+import asyncio
+import unittest
+from unittest.mock import MagicMock
+
+from irc.client import Event, NickMask
+
+import bavi.aio
+
+class Dummy:
+    pass
+
+class AioBotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.bot = bavi.aio.AioBot(None)
+        self.bot.connection = Dummy()
+        self.bot.connection.get_nickname = lambda: 'TestBot'
+        self.bot.connection.privmsg = MagicMock()
+        self.bot.channels = { '#test' }
+
+    def tearDown(self):
+        self.loop.close()
+
+    def pubmsg(self, message):
+        async def run():
+            self.bot.on_pubmsg(
+                    None,
+                    Event(
+                        'pubmsg',
+                        NickMask('user!ident@host'),
+                        '#test',
+                        [message]
+                    )
+            )
+            # Let scheduled handler tasks run
+            for _ in range(5):
+                await asyncio.sleep(0)
+
+        self.loop.run_until_complete(run())
+
+    def test_async_command_works(self):
+        async def handler(bot, source, target, message, **kwargs):
+            await asyncio.sleep(0)
+            bot.say(target, 'This is an example')
+
+        self.bot.add_command('example', handler)
+        self.pubmsg('.example')
+
+        self.bot.connection.privmsg.assert_called_with(
+                '#test',
+                'This is an example'
+        )
+
+    def test_async_commands_run_concurrently(self):
+        started = []
+        release = asyncio.Event()
+
+        async def handler(bot, source, target, message, **kwargs):
+            started.append(message)
+            await release.wait()
+
+        self.bot.add_command('example', handler)
+        self.pubmsg('.example 1')
+        self.pubmsg('.example 2')
+
+        self.assertEqual(started, ['1', '2'])
+        release.set()
+
+    def test_async_command_failure_replies_with_error(self):
+        async def handler(bot, source, target, message, **kwargs):
+            await asyncio.sleep(0)
+            raise KeyError('frobulator')
+
+        self.bot.add_command('example', handler)
+        self.pubmsg('.example')
+
+        self.bot.connection.privmsg.assert_called_with(
+                '#test',
+                "KeyError: 'frobulator'"
+        )
+
+    def test_sync_matcher_works(self):
+        import re
+
+        def handler(bot, source, target, message, match):
+            bot.say(target, 'Matched {}'.format(match.group(1)))
+
+        self.bot.add_matcher(re.compile(r'matchme:([0-9]+)'), handler)
+        self.pubmsg('this is an matchme:123 example')
+
+        self.bot.connection.privmsg.assert_called_with(
+                '#test',
+                'Matched 123'
+        )
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import tracemalloc
+import types
+import unittest
+from unittest import mock
+
+from bench import channels, dispatch
+
+class DispatchBenchTestCase(unittest.TestCase):
+    def test_synthetic_corpus_is_deterministic(self):
+        a = dispatch.synthetic_corpus(100, seed=1)
+        b = dispatch.synthetic_corpus(100, seed=1)
+
+        assert a == b
+        assert len(a) == 100
+
+    def test_synthetic_corpus_mix(self):
+        corpus = dispatch.synthetic_corpus(50, mix={ 'commands': 1 })
+
+        assert all(message.startswith('.') for _, _, message in corpus)
+
+    def test_load_corpus(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'corpus.tsv')
+            with open(path, 'w') as f:
+                f.write('# comment\n')
+                f.write('a!b@c\t#test\thello world\n')
+                f.write('\n')
+
+            corpus = dispatch.load_corpus(path)
+
+        assert corpus == [('a!b@c', '#test', 'hello world')]
+
+    def test_run(self):
+        corpus = dispatch.synthetic_corpus(200)
+        results = dispatch.run(corpus, repeat=1, warmup=10)
+
+        assert results['messages'] == 200
+        assert results['messages_per_second'] > 0
+        assert results['latency_p50_seconds'] <= results['latency_p99_seconds']
+        assert results['lines_sent'] > 0
+        assert 'command:choose' in results['handlers']
+        assert 'matcher:title_command' in results['handlers']
+
+    def test_run_without_reset_peak(self):
+        # tracemalloc.reset_peak() is new in Python 3.9
+        old_tracemalloc = types.SimpleNamespace(
+                start=tracemalloc.start,
+                stop=tracemalloc.stop,
+                get_traced_memory=tracemalloc.get_traced_memory
+        )
+        corpus = dispatch.synthetic_corpus(50)
+
+        with mock.patch.object(dispatch, 'tracemalloc', old_tracemalloc):
+            results = dispatch.run(corpus, repeat=1, warmup=10)
+
+        assert results['messages'] == 50
+        assert not tracemalloc.is_tracing()
+
+    def test_compare(self):
+        baseline = {
+            'messages_per_second': 1000.0,
+            'latency_p99_seconds': 0.001
+        }
+        results = {
+            'messages_per_second': 800.0,
+            'latency_p99_seconds': 0.0009
+        }
+
+        rows = dict(
+            (metric, regressed)
+            for metric, old, new, change, regressed
+            in dispatch.compare(baseline, results, 0.1)
+        )
+
+        assert rows == {
+            'messages_per_second': True,
+            'latency_p99_seconds': False
+        }
+
+class ChannelsBenchTestCase(unittest.TestCase):
+    def test_memberships(self):
+        members = channels.memberships(100, 5, 2)
+
+        assert sum(len(nicks) for nicks in members.values()) == 200
+
+    def test_run(self):
+        results = channels.run(300, 4, 2)
+
+        assert results['memberships'] == 600
+        assert results['compact']['bytes'] < results['full']['bytes']
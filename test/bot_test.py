@@ -53,6 +53,25 @@ class BotTestCase(unittest.TestCase):
                 'This is a second example'
         )
 
+    def test_async_command_works(self):
+        async def handler(bot, source, target, message, **kwargs):
+            bot.say(target, 'This is an example')
+
+        self.bot.add_command('example', handler)
+        self.bot.on_pubmsg(
+                None,
+                Event(
+                    'pubmsg',
+                    NickMask('user!ident@host'),
+                    '#test',
+                    ['.example']
+                )
+        )
+        self.bot.connection.privmsg.assert_called_with(
+                '#test',
+                'This is an example'
+        )
+
     def test_command_alias_works(self):
         def handler(bot, source, target, message, **kwargs):
             bot.say(target, 'This is an example')
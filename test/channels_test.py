@@ -0,0 +1,149 @@
+import unittest
+from unittest.mock import MagicMock
+
+from irc.client import Event, NickMask
+
+from bavi.channels import ChannelStore, NickTable
+
+def mask(nick):
+    return NickMask('{0}!{0}@host'.format(nick))
+
+class NickTableTestCase(unittest.TestCase):
+    def test_ids_are_shared_and_reused(self):
+        nicks = NickTable()
+        a = nicks.acquire('Alice')
+        assert nicks.acquire('alice') == a
+        b = nicks.acquire('Bob')
+
+        nicks.release(a)
+        assert nicks.id('ALICE') == a
+        nicks.release(a)
+        assert nicks.id('Alice') is None
+        assert len(nicks) == 1
+
+        assert nicks.acquire('Carol') == a
+        assert nicks.nick(a) == 'Carol'
+        assert nicks.nick(b) == 'Bob'
+
+    def test_rename(self):
+        nicks = NickTable()
+        id = nicks.acquire('Alice')
+
+        nicks.rename('alice', 'Alicia')
+
+        assert 'Alice' not in nicks
+        assert nicks.id('alicia') == id
+        assert nicks.nick(id) == 'Alicia'
+
+class ChannelStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.conn = MagicMock()
+        self.conn.get_nickname.return_value = 'TestBot'
+        self.conn.features.prefix = { '@': 'o', '+': 'v' }
+        self.store = ChannelStore()
+        self.store.attach(self.conn)
+
+        self.event('join', mask('TestBot'), '#test')
+        self.event('namreply', 'server', 'TestBot', ['=', '#test',
+            '@TestBot +alice bob carol!carol@host'])
+        self.event('endofnames', 'server', 'TestBot', ['#test',
+            'End of /NAMES list.'])
+
+    def event(self, type, source, target, arguments=[]):
+        handler = getattr(self.store, '_on_' + type)
+        handler(self.conn, Event(type, source, target, arguments))
+
+    def test_attach_replaces_bot_handlers(self):
+        conn = MagicMock()
+        bot = MagicMock()
+
+        ChannelStore().attach(conn, bot)
+
+        conn.remove_global_handler.assert_any_call('join', bot._on_join)
+        self.assertEqual(
+                conn.add_global_handler.call_count,
+                len(ChannelStore.EVENTS)
+        )
+
+    def test_names(self):
+        channel = self.store['#TEST']
+
+        self.assertEqual(
+                sorted(channel.users()),
+                ['TestBot', 'alice', 'bob', 'carol']
+        )
+        assert channel.is_oper('testbot')
+        assert channel.is_voiced('Alice')
+        assert not channel.is_oper('bob')
+        self.assertEqual(channel.voiced(), ['alice'])
+
+    def test_names_before_end_of_list(self):
+        self.event('namreply', 'server', 'TestBot', ['=', '#test', 'dave'])
+
+        assert self.store['#test'].has_user('dave')
+        self.event('join', mask('dave'), '#test')
+        self.event('endofnames', 'server', 'TestBot', ['#test', ''])
+        assert len(self.store['#test']) == 5
+        assert len(self.store.nicks) == 5
+
+    def test_join_part_kick_quit(self):
+        self.event('join', mask('TestBot'), '#other')
+        self.event('join', mask('alice'), '#other')
+        self.event('join', mask('dave'), '#test')
+        assert self.store['#test'].has_user('dave')
+        assert len(self.store.nicks) == 5
+        self.assertEqual(self.store.memberships, 7)
+
+        self.event('part', mask('bob'), '#test')
+        self.event('kick', mask('TestBot'), '#test', ['carol', 'bye'])
+        assert not self.store['#test'].has_user('bob')
+        assert not self.store['#test'].has_user('carol')
+        assert 'bob' not in self.store.nicks
+
+        self.event('quit', mask('alice'), None, ['gone'])
+        assert not self.store['#test'].has_user('alice')
+        assert not self.store['#other'].has_user('alice')
+        assert 'alice' not in self.store.nicks
+        assert self.store['#test'].voiced() == []
+
+    def test_nick_changes_once_for_all_channels(self):
+        self.event('join', mask('TestBot'), '#other')
+        self.event('join', mask('alice'), '#other')
+
+        self.event('nick', mask('alice'), 'Alicia')
+
+        for name in ['#test', '#other']:
+            assert self.store[name].has_user('alicia')
+            assert not self.store[name].has_user('alice')
+        assert self.store['#test'].is_voiced('Alicia')
+        assert 'Alicia' in self.store['#other'].users()
+
+    def test_mode(self):
+        self.event('mode', mask('TestBot'), '#test', ['+o-v+l', 'bob',
+            'alice', '50'])
+
+        channel = self.store['#test']
+        assert channel.is_oper('bob')
+        assert not channel.is_voiced('alice')
+        assert channel.limit() == '50'
+
+    def test_own_part_releases_members(self):
+        self.event('part', mask('TestBot'), '#test')
+
+        assert '#test' not in self.store
+        assert len(self.store.nicks) == 0
+
+    def test_rejoin_starts_over(self):
+        self.event('join', mask('TestBot'), '#test')
+
+        self.assertEqual(self.store['#test'].users(), ['TestBot'])
+        assert len(self.store.nicks) == 1
+
+    def test_clear(self):
+        self.store.clear()
+
+        assert '#test' not in self.store
+        assert len(self.store.nicks) == 0
+
+if __name__ == '__main__':
+    unittest.main()
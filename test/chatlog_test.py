@@ -0,0 +1,158 @@
+import configparser
+import gzip
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from irc.client import Event, NickMask
+
+import bavi.bot
+from bavi.chatlog import ChatLog, safe_name
+
+DAY1 = time.mktime((2020, 3, 1, 23, 59, 30, 0, 0, -1))
+DAY2 = time.mktime((2020, 3, 2, 0, 0, 5, 0, 0, -1))
+
+class ChatLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.directory = self._tmp.name
+        self.now = DAY1
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def chatlog(self, **kwargs):
+        return ChatLog(
+                self.directory,
+                flush_interval=0.01,
+                clock=lambda: self.now,
+                **kwargs
+        )
+
+    def read(self, *path):
+        path = os.path.join(self.directory, *path)
+        if path.endswith('.gz'):
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                return f.read()
+        with open(path, encoding='utf-8') as f:
+            return f.read()
+
+    def test_writes_per_channel_files(self):
+        chatlog = self.chatlog()
+        chatlog.start()
+        chatlog.record('net', '#Test', 'alice', 'hello')
+        chatlog.record('net', '#test', 'bob', 'waves', kind='ACTION')
+        chatlog.record('net', '#other', 'carol', 'hi')
+        chatlog.close()
+
+        assert self.read('net', '#test', '2020-03-01.log') == \
+                '23:59:30 <alice> hello\n23:59:30 * bob waves\n'
+        assert self.read('net', '#other', '2020-03-01.log') == \
+                '23:59:30 <carol> hi\n'
+        assert chatlog.written == 3
+
+    def test_rotates_and_compresses(self):
+        chatlog = self.chatlog()
+        chatlog.start()
+        chatlog.record('net', '#test', 'alice', 'before midnight')
+        self.now = DAY2
+        chatlog.record('net', '#test', 'alice', 'after midnight')
+        chatlog.close()
+
+        path = os.path.join(self.directory, 'net', '#test')
+        assert sorted(os.listdir(path)) == [
+            '2020-03-01.log.gz',
+            '2020-03-02.log'
+        ]
+        assert self.read(path, '2020-03-01.log.gz') == \
+                '23:59:30 <alice> before midnight\n'
+        assert self.read(path, '2020-03-02.log') == \
+                '00:00:05 <alice> after midnight\n'
+
+    def test_rotates_quiet_channels(self):
+        chatlog = self.chatlog()
+        chatlog.start()
+        chatlog.record('net', '#quiet', 'alice', 'good night')
+        time.sleep(0.1)
+        self.now = DAY2
+        time.sleep(0.1)
+        chatlog.close()
+
+        assert os.listdir(os.path.join(self.directory, 'net', '#quiet')) == [
+            '2020-03-01.log.gz'
+        ]
+
+    def test_compresses_stale_logs_on_start(self):
+        path = os.path.join(self.directory, 'net', '#test')
+        os.makedirs(path)
+        with open(os.path.join(path, '2020-02-29.log'), 'w') as f:
+            f.write('12:00:00 <alice> leap day\n')
+
+        chatlog = self.chatlog()
+        chatlog.start()
+        chatlog.close()
+
+        assert os.listdir(path) == ['2020-02-29.log.gz']
+        assert chatlog.compressed == 1
+
+    def test_compresses_evicted_files(self):
+        chatlog = ChatLog(self.directory, flush_interval=60,
+                clock=lambda: self.now)
+        chatlog.start()
+        chatlog.record('net', '#quiet', 'alice', 'good night')
+        self.now = DAY2
+        chatlog.record('net', '#busy', 'bob', 'good morning')
+        with patch('bavi.chatlog.MAX_OPEN_FILES', 1):
+            chatlog.close()
+
+        assert os.listdir(os.path.join(self.directory, 'net', '#quiet')) == [
+            '2020-03-01.log.gz'
+        ]
+        assert os.listdir(os.path.join(self.directory, 'net', '#busy')) == [
+            '2020-03-02.log'
+        ]
+
+    def test_drops_when_full(self):
+        # The writer is not started, so nothing is taken off the queue
+        chatlog = self.chatlog(max_queue=2)
+
+        assert chatlog.record('net', '#test', 'a', '1')
+        assert chatlog.record('net', '#test', 'a', '2')
+        assert not chatlog.record('net', '#test', 'a', '3')
+        assert chatlog.dropped == 1
+        assert chatlog.depth == 2
+
+    def test_safe_name(self):
+        assert safe_name('#a/b') == '#a_b'
+        assert safe_name('..') == '_..'
+
+class BotChatLogTestCase(unittest.TestCase):
+    def test_logs_inbound_and_outbound(self):
+        with tempfile.TemporaryDirectory() as directory:
+            config = configparser.ConfigParser()
+            config.read_dict({ 'chatlog': { 'Directory': directory } })
+            bot = bavi.bot.Bot(config, section='irc:example')
+            bot.connection = MagicMock()
+            bot.connection.get_nickname.return_value = 'TestBot'
+            bot.channels = { '#test' }
+            bot.add_command(
+                    'echo',
+                    lambda bot, source, target, message, **kwargs:
+                        bot.say(target, message)
+            )
+
+            bot.on_pubmsg(None, Event(
+                'pubmsg',
+                NickMask('user!ident@host'),
+                '#test',
+                ['.echo hi']
+            ))
+            bot.shutdown()
+
+            path = os.path.join(directory, 'example', '#test')
+            with open(os.path.join(path, os.listdir(path)[0])) as f:
+                lines = [line.split(' ', 1)[1] for line in f]
+
+        assert lines == ['<user> .echo hi\n', '<TestBot> hi\n']
@@ -0,0 +1,116 @@
+import configparser
+import unittest
+from unittest.mock import MagicMock
+
+from irc.client import Event, NickMask
+
+import bavi.bot
+from bavi.commands import AmbiguousCommand, CommandTrie
+
+class Dummy:
+    pass
+
+def title(*args, **kwargs):
+    pass
+
+def time(*args, **kwargs):
+    pass
+
+def choose(*args, **kwargs):
+    pass
+
+class CommandTrieTestCase(unittest.TestCase):
+    def setUp(self):
+        self.trie = CommandTrie()
+        self.trie['title'] = title
+        self.trie['time'] = time
+        self.trie['choose'] = choose
+        self.trie['choice'] = choose
+
+    def test_exact_match(self):
+        self.assertEqual(self.trie.resolve('time'), ('time', time))
+
+    def test_unambiguous_abbreviation(self):
+        self.assertEqual(self.trie.resolve('tit'), ('title', title))
+
+    def test_ambiguous_abbreviation(self):
+        with self.assertRaises(AmbiguousCommand) as cm:
+            self.trie.resolve('ti')
+
+        self.assertEqual(cm.exception.candidates, ['time', 'title'])
+
+    def test_aliases_of_one_handler_are_not_ambiguous(self):
+        self.assertEqual(self.trie.resolve('ch'), ('choice', choose))
+
+    def test_unknown_command(self):
+        self.assertRaises(KeyError, self.trie.resolve, 'xyz')
+        self.assertRaises(KeyError, self.trie.resolve, '')
+
+    def test_delete_updates_resolution(self):
+        self.assertRaises(AmbiguousCommand, self.trie.resolve, 'ti')
+
+        del self.trie['time']
+        self.assertEqual(self.trie.resolve('ti'), ('title', title))
+        self.assertNotIn('time', self.trie)
+
+        del self.trie['title']
+        self.assertRaises(KeyError, self.trie.resolve, 't')
+
+class CommandFrontEndTestCase(unittest.TestCase):
+    def setUp(self):
+        config = configparser.ConfigParser()
+        config.read_dict({ 'bavi': { 'CommandPrefixes': '. !' } })
+        self.bot = bavi.bot.Bot(config)
+        self.bot.connection = Dummy()
+        self.bot.connection.get_nickname = lambda: 'TestBot'
+        self.bot.connection.privmsg = MagicMock()
+        self.bot.channels = { '#test' }
+
+        self.calls = []
+
+        def handler(bot, source, target, message, command):
+            self.calls.append((command, message))
+
+        def other(bot, source, target, message, command):
+            pass
+
+        self.bot.add_command('title', handler)
+        self.bot.add_command('time', other)
+
+    def pubmsg(self, message):
+        self.bot.on_pubmsg(
+                None,
+                Event(
+                    'pubmsg',
+                    NickMask('user!ident@host'),
+                    '#test',
+                    [message]
+                )
+        )
+
+    def test_multiple_prefixes(self):
+        self.pubmsg('.title a')
+        self.pubmsg('!title b')
+
+        self.assertEqual(self.calls, [('title', 'a'), ('title', 'b')])
+
+    def test_abbreviation(self):
+        self.pubmsg('!tit http://example.com')
+
+        self.assertEqual(self.calls, [('title', 'http://example.com')])
+
+    def test_ambiguous_abbreviation_lists_candidates(self):
+        self.pubmsg('.ti')
+
+        self.bot.connection.privmsg.assert_called_with(
+                '#test',
+                'user: Did you mean: time, title?'
+        )
+
+    def test_address_prefix_follows_nick_change(self):
+        self.pubmsg('TestBot, title a')
+        self.bot.connection.get_nickname = lambda: 'NewNick'
+        self.pubmsg('TestBot: title b')
+        self.pubmsg('NewNick: title c')
+
+        self.assertEqual(self.calls, [('title', 'a'), ('title', 'c')])
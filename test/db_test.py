@@ -0,0 +1,166 @@
+import concurrent.futures
+import configparser
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from bavi.db import Database
+
+def insert(conn, value):
+    conn.execute('INSERT INTO t (value) VALUES (?)', (value,))
+    return value
+
+def fail(conn):
+    conn.execute('INSERT INTO t (value) VALUES (?)', ('failed',))
+    raise ValueError('no')
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'bavi.db')
+        self.db = Database(self.path, commit_interval=0.05)
+        self.addCleanup(self.db.close)
+        self.db.execute_write('CREATE TABLE t (value TEXT)')
+
+    def values(self):
+        return sorted(v for v, in self.db.execute('SELECT value FROM t'))
+
+    def test_pragmas(self):
+        mode, = self.db.execute('PRAGMA journal_mode').fetchone()
+        synchronous, = self.db.execute('PRAGMA synchronous').fetchone()
+
+        self.assertEqual(mode, 'wal')
+        # NORMAL
+        self.assertEqual(synchronous, 1)
+
+    def test_from_config(self):
+        config = configparser.ConfigParser()
+        config.read_dict({ 'sqlite3': {
+            'Filename': self.path,
+            'Synchronous': 'FULL',
+            'CommitInterval': '0'
+        }})
+
+        db = Database.from_config(config)
+        self.addCleanup(db.close)
+
+        self.assertEqual(db.filename, self.path)
+        self.assertEqual(db.commit_interval, 0)
+        synchronous, = db.execute('PRAGMA synchronous').fetchone()
+        self.assertEqual(synchronous, 2)
+
+    def test_connection_per_thread(self):
+        connections = []
+        thread = threading.Thread(
+                target=lambda: connections.append(self.db.connection())
+        )
+        thread.start()
+        thread.join()
+
+        assert self.db.connection() is self.db.connection()
+        assert connections[0] is not self.db.connection()
+
+    def test_write_returns_after_commit(self):
+        self.assertEqual(self.db.write(insert, 'a'), 'a')
+
+        # Visible to a separate connection, so it has been committed
+        conn = sqlite3.connect(self.path)
+        self.addCleanup(conn.close)
+        self.assertEqual(conn.execute('SELECT value FROM t').fetchall(),
+                [('a',)])
+
+    def test_writes_are_committed_together(self):
+        commits = self.db.commits
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(
+                lambda i: self.db.write(insert, str(i)),
+                range(40)
+            ))
+
+        self.assertEqual(results, [str(i) for i in range(40)])
+        self.assertEqual(len(self.values()), 40)
+        self.assertLess(self.db.commits - commits, 40)
+
+    def test_failed_write_is_rolled_back_alone(self):
+        a = self.db.submit(insert, 'a')
+        failed = self.db.submit(fail)
+        b = self.db.submit(insert, 'b')
+
+        self.assertEqual(a.result(), 'a')
+        self.assertEqual(b.result(), 'b')
+        with self.assertRaises(ValueError):
+            failed.result()
+        self.assertEqual(self.values(), ['a', 'b'])
+
+    def test_nested_write_joins_transaction(self):
+        def outer(conn):
+            insert(conn, 'outer')
+            return self.db.write(insert, 'inner')
+
+        self.assertEqual(self.db.write(outer), 'inner')
+        self.assertEqual(self.values(), ['inner', 'outer'])
+
+    def test_close_commits_pending_writes(self):
+        futures = [self.db.submit(insert, str(i)) for i in range(10)]
+
+        self.db.close()
+
+        assert all(future.done() for future in futures)
+        conn = sqlite3.connect(self.path)
+        self.addCleanup(conn.close)
+        count, = conn.execute('SELECT COUNT(*) FROM t').fetchone()
+        self.assertEqual(count, 10)
+
+        with self.assertRaises(RuntimeError):
+            self.db.submit(insert, 'late')
+
+    def test_flush(self):
+        future = self.db.submit(insert, 'a')
+
+        self.db.flush()
+
+        assert future.done()
+
+class MemoryDatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = Database(':memory:')
+        self.addCleanup(self.db.close)
+        self.db.execute_write('CREATE TABLE t (value TEXT)')
+
+    def test_threads_share_the_database(self):
+        thread = threading.Thread(target=lambda: self.db.write(insert, 'a'))
+        thread.start()
+        thread.join()
+
+        self.assertEqual(self.db.execute('SELECT value FROM t').fetchall(),
+                [('a',)])
+        assert self.db.connect() is self.db.connection()
+
+    def test_exclusive_keeps_writes_out_of_transaction(self):
+        conn = self.db.connect()
+        thread = threading.Thread(target=lambda: self.db.write(insert, 'a'))
+
+        with self.db.exclusive():
+            conn.execute('BEGIN IMMEDIATE')
+            thread.start()
+            thread.join(0.1)
+            # Waits for the transaction instead of joining it
+            assert thread.is_alive()
+            conn.rollback()
+
+        thread.join(5)
+        self.assertEqual(self.db.execute('SELECT value FROM t').fetchall(),
+                [('a',)])
+
+    def test_failed_write_is_rolled_back(self):
+        with self.assertRaises(ValueError):
+            self.db.write(fail)
+
+        self.assertEqual(self.db.execute('SELECT value FROM t').fetchall(),
+                [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+import asyncio
+import time
+import unittest
+
+import bavi.bot
+from ircd import BotThread, ScriptedClient, ServerThread, bot_config
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError('Timed out waiting for condition')
+        time.sleep(0.01)
+
+def is_privmsg(text):
+    return lambda prefix, command, params: \
+            command == 'PRIVMSG' and params[1] == text
+
+class EndToEndTestCase(unittest.TestCase):
+    '''
+    Runs a real Bot against the local IRC server in test/ircd.py
+    '''
+
+    def setUp(self):
+        self.ircd = ServerThread(flood_burst=10, flood_rate=10).start()
+        self.addCleanup(self.ircd.stop)
+
+    def start_bot(self, **sections):
+        sections.setdefault('reconnect', { 'MinInterval': '0.1' })
+        bot = bavi.bot.Bot(bot_config(self.ircd.port, **sections))
+
+        def spam(bot, source, target, message, **kwargs):
+            for i in range(int(message)):
+                bot.say(target, 'line {}'.format(i))
+
+        bot.add_command('echo', lambda bot, source, target, message, **kw:
+                bot.say(target, message))
+        bot.add_command('spam', spam)
+        bot.init_irc()
+        self.addCleanup(BotThread(bot).start().stop)
+        self.wait_for_join()
+        return bot
+
+    def wait_for_join(self):
+        wait_for(lambda: 'TestBot' in self.ircd.call(
+            lambda: self.ircd.server.members('#test')
+        ))
+
+    def client(self, nick='user'):
+        client = ScriptedClient(nick, port=self.ircd.port)
+        self.ircd.call(client.connect())
+        self.ircd.call(client.join('#test'))
+        self.addCleanup(lambda: self.ircd.call(client.close()))
+        return client
+
+    def test_command_round_trip(self):
+        self.start_bot()
+        client = self.client()
+
+        client.privmsg('#test', '.echo hello')
+        prefix, command, params = self.ircd.call(
+                client.expect(is_privmsg('hello'))
+        )
+
+        assert prefix.startswith('TestBot!')
+        assert params[0] == '#test'
+
+    def test_outbound_queue_avoids_excess_flood(self):
+        self.start_bot(outbound={ 'Rate': '8', 'Burst': '4' })
+        client = self.client()
+
+        client.privmsg('#test', '.spam 12')
+        self.ircd.call(client.expect(is_privmsg('line 11')))
+
+        assert self.ircd.server.stats['flood_kills'] == 0
+
+    def test_unthrottled_output_is_killed(self):
+        self.start_bot(outbound={ 'Rate': '1000', 'Burst': '1000' })
+        client = self.client()
+
+        client.privmsg('#test', '.spam 12')
+        self.ircd.call(client.expect(
+            lambda prefix, command, params: command == 'QUIT' and
+                    prefix.startswith('TestBot!') and
+                    'Excess Flood' in params[0]
+        ))
+
+        assert self.ircd.server.stats['flood_kills'] == 1
+
+    def test_reconnect_after_kill(self):
+        self.start_bot()
+        client = self.client()
+
+        assert self.ircd.call(lambda: self.ircd.server.kill('TestBot'))
+        self.ircd.call(client.expect(
+            lambda prefix, command, params: command == 'JOIN' and
+                    prefix.startswith('TestBot!')
+        ))
+
+        client.privmsg('#test', '.echo back')
+        self.ircd.call(client.expect(is_privmsg('back')))
+        assert self.ircd.server.stats['connections'] == 3
+
+    def test_reconnect_restores_runtime_channels(self):
+        bot = self.start_bot()
+        bot.call_from_thread(lambda: bot.join('#extra', '#more'))
+        members = lambda channel: self.ircd.call(
+                lambda: self.ircd.server.members(channel)
+        )
+        wait_for(lambda: 'TestBot' in members('#more'))
+
+        assert self.ircd.call(lambda: self.ircd.server.kill('TestBot'))
+        wait_for(lambda: 'TestBot' not in members('#extra'))
+        wait_for(lambda: all(
+            'TestBot' in members(channel)
+            for channel in ['#test', '#extra', '#more']
+        ))
+
+    def test_compact_channel_state(self):
+        early = self.client('early')
+        bot = self.start_bot(irc={ 'ChannelState': 'compact' })
+        self.client('late')
+        wait_for(lambda: bot.channels['#test'].has_user('late'))
+
+        self.assertEqual(
+                sorted(bot.channels['#test'].users()),
+                ['TestBot', 'early', 'late']
+        )
+
+        self.ircd.call(early.close())
+        wait_for(lambda: not bot.channels['#test'].has_user('early'))
+        assert 'early' not in bot.channels.nicks
+
+    def test_lag(self):
+        self.start_bot()
+        client = self.client()
+        self.ircd.server.lag = 0.2
+
+        start = time.monotonic()
+        client.privmsg('#test', '.echo slow')
+        self.ircd.call(client.expect(is_privmsg('slow')))
+
+        # Delayed once on the way to the bot and once on the way back
+        assert time.monotonic() - start >= 0.4
+
+    def test_ping(self):
+        client = self.client()
+
+        client.send('PING :abc')
+        prefix, command, params = self.ircd.call(client.expect(
+            lambda prefix, command, params: command == 'PONG'
+        ))
+
+        assert params[-1] == 'abc'
+
+    def test_fan_out(self):
+        first = self.client('first')
+        second = self.client('second')
+
+        first.privmsg('#test', 'hi all')
+        prefix, command, params = self.ircd.call(
+                second.expect(is_privmsg('hi all'))
+        )
+
+        assert prefix.startswith('first!')
+        with self.assertRaises(asyncio.TimeoutError):
+            self.ircd.call(first.expect(is_privmsg('hi all'), timeout=0.1))
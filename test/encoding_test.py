@@ -0,0 +1,88 @@
+import unittest
+from unittest.mock import MagicMock
+
+import bavi.bot
+from bavi.encoding import LineEncoder, sanitize, split_utf8
+
+class Dummy:
+    pass
+
+class SplitTestCase(unittest.TestCase):
+    def test_short_message_is_not_split(self):
+        self.assertEqual(split_utf8(b'hello', 10), [b'hello'])
+
+    def test_prefers_word_breaks(self):
+        self.assertEqual(
+                split_utf8(b'hello there world', 12),
+                [b'hello there', b'world']
+        )
+
+    def test_splits_long_words(self):
+        self.assertEqual(
+                split_utf8(b'abcdefghij', 4),
+                [b'abcd', b'efgh', b'ij']
+        )
+
+    def test_never_splits_multibyte_characters(self):
+        data = 'ééé'.encode('utf-8')
+        chunks = split_utf8(data, 3)
+
+        self.assertEqual(chunks, [b'\xc3\xa9', b'\xc3\xa9', b'\xc3\xa9'])
+        for chunk in chunks:
+            chunk.decode('utf-8')
+
+    def test_sanitize(self):
+        self.assertEqual(sanitize('a\rb\nc\0d'), 'abcd')
+
+class LineEncoderTestCase(unittest.TestCase):
+    def test_budget_uses_real_prefix(self):
+        encoder = LineEncoder()
+        encoder.set_source('Bot!bot@example.com')
+
+        # ":Bot!bot@example.com PRIVMSG #test :" + "\r\n"
+        self.assertEqual(encoder.budget('#test'), 512 - 38)
+
+    def test_budget_is_recomputed_when_source_changes(self):
+        encoder = LineEncoder()
+        encoder.set_source('Bot!bot@example.com')
+        before = encoder.budget('#test')
+
+        encoder.set_source('Bot!bot@a.much.longer.example.com')
+        self.assertEqual(encoder.budget('#test'), before - 14)
+
+    def test_unknown_host_is_conservative(self):
+        encoder = LineEncoder('Bot')
+        self.assertLess(
+                encoder.budget('#test'),
+                512 - len(':Bot!u@h PRIVMSG #test :\r\n')
+        )
+
+    def test_every_line_fits(self):
+        encoder = LineEncoder()
+        encoder.set_source('Bot!bot@example.com')
+        message = 'wörd ' * 200
+
+        lines = encoder.encode('#test', message)
+        self.assertGreater(len(lines), 1)
+        for text, size in lines:
+            self.assertEqual(len(text.encode('utf-8')), size)
+            self.assertLessEqual(
+                    len(':Bot!bot@example.com PRIVMSG #test :{}\r\n'
+                        .format(text).encode('utf-8')),
+                    512
+            )
+
+class BotSplitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.bot = bavi.bot.Bot(None)
+        self.bot.connection = Dummy()
+        self.bot.connection.get_nickname = lambda: 'TestBot'
+        self.bot.connection.privmsg = MagicMock()
+        self.bot.channels = { '#test' }
+
+    def test_say_splits_long_messages(self):
+        self.bot.say('#test', 'x' * 1000)
+
+        lines = [c[0][1] for c in self.bot.connection.privmsg.call_args_list]
+        self.assertGreater(len(lines), 1)
+        self.assertEqual(''.join(lines), 'x' * 1000)
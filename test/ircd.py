@@ -0,0 +1,774 @@
+'''
+Minimal asyncio IRC server for end-to-end and load tests.
+
+It speaks enough of RFC 1459 for the bot and scripted clients to register,
+JOIN, exchange PRIVMSG/NOTICE (fanned out to channel members) and answer
+PINGs, and it can misbehave on demand: delay everything it sends (`lag`),
+kill clients that send faster than a token bucket allows (`flood_burst`
+and `flood_rate`, like an ircd's "Excess Flood") and drop connections
+(kill() and disconnect_all()).
+
+The server runs on its own event loop thread (ServerThread) so blocking
+bots can be driven against it from ordinary unittest code.  Run this file
+directly for a load test, e.g.
+
+    python3 test/ircd.py --clients 2000 --senders 200 --duration 10
+'''
+
+import argparse
+import asyncio
+import collections
+import configparser
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import irc.strings
+
+log = logging.getLogger('bavi.test.ircd')
+
+SERVER_NAME = 'irc.test'
+
+# Nicks per RPL_NAMREPLY line
+NAMES_PER_LINE = 40
+
+def parse_line(line):
+    '''
+    Split an IRC line into (prefix, command, params)
+    '''
+
+    prefix = None
+    if line.startswith(':'):
+        prefix, _, line = line[1:].partition(' ')
+
+    line, sep, trailing = line.partition(' :')
+    params = line.split()
+    command = params.pop(0).upper() if params else ''
+    if sep:
+        params.append(trailing)
+
+    return prefix, command, params
+
+class Client:
+    '''
+    One connection to the server
+    '''
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.nick = None
+        self.user = None
+        peer = writer.get_extra_info('peername')
+        self.host = peer[0] if peer else 'localhost'
+        self.registered = False
+        self.channels = set()
+        self.closed = False
+        self.lines = 0
+        self._tokens = server.flood_burst
+        self._last = time.monotonic()
+
+    @property
+    def prefix(self):
+        return '{}!{}@{}'.format(self.nick, self.user, self.host)
+
+    def send(self, line):
+        if self.closed:
+            return
+
+        data = (line + '\r\n').encode('utf-8', 'replace')
+        if self.server.lag > 0:
+            asyncio.get_event_loop().call_later(
+                    self.server.lag,
+                    self._write,
+                    data
+            )
+        else:
+            self._write(data)
+
+    def _write(self, data):
+        if not self.closed and not self.writer.is_closing():
+            self.writer.write(data)
+            self.server.stats['lines_out'] += 1
+
+    def numeric(self, code, *params):
+        params = list(params)
+        params[-1] = ':' + params[-1]
+        self.send(':{} {} {} {}'.format(
+            SERVER_NAME,
+            code,
+            self.nick or '*',
+            ' '.join(params)
+        ))
+
+    def flooding(self):
+        '''
+        Take a token for a received line; True if there was none left
+        '''
+
+        if self.server.flood_burst is None:
+            return False
+
+        now = time.monotonic()
+        self._tokens = min(
+                self.server.flood_burst,
+                self._tokens + (now - self._last) * self.server.flood_rate
+        )
+        self._last = now
+        if self._tokens < 1:
+            return True
+
+        self._tokens -= 1
+        return False
+
+class IRCServer:
+    '''
+    The server itself.  All methods must be called on its event loop; use
+    ServerThread.call() from other threads.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0, lag=0.0, flood_burst=None,
+            flood_rate=1.0, record=False):
+        self.host = host
+        self.port = port
+        self.lag = lag
+        self.flood_burst = flood_burst
+        self.flood_rate = flood_rate
+        self.clients = {}
+        self.channels = {}
+        self.stats = collections.Counter()
+        # (time, nick, line) for every line received, if record is set
+        self.history = [] if record else None
+        self._server = None
+        self._connections = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+                self._handle,
+                self.host,
+                self.port
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        log.info('Listening on %s:%d', self.host, self.port)
+
+    async def stop(self):
+        self.disconnect_all('Server shutting down')
+        self._server.close()
+        await self._server.wait_closed()
+
+    def kill(self, nick, reason='Killed'):
+        '''
+        Close a client's connection, as an operator KILL or a ping timeout
+        would.  Returns False if nobody has that nick.
+        '''
+
+        client = self.clients.get(irc.strings.lower(nick))
+        if client is None:
+            return False
+
+        self._close(client, reason)
+        return True
+
+    def disconnect_all(self, reason='Connection reset'):
+        for client in list(self._connections):
+            self._close(client, reason)
+
+    def members(self, channel):
+        return set(
+            client.nick
+            for client in self.channels.get(irc.strings.lower(channel), ())
+        )
+
+    async def _handle(self, reader, writer):
+        client = Client(self, reader, writer)
+        self._connections.add(client)
+        self.stats['connections'] += 1
+
+        try:
+            while not client.closed:
+                data = await reader.readline()
+                if not data:
+                    break
+
+                line = data.decode('utf-8', 'replace').rstrip('\r\n')
+                if not line:
+                    continue
+
+                client.lines += 1
+                self.stats['lines_in'] += 1
+                if self.history is not None:
+                    self.history.append((time.monotonic(), client.nick, line))
+
+                if client.flooding():
+                    self.stats['flood_kills'] += 1
+                    self._close(client, 'Excess Flood')
+                    break
+
+                self._dispatch(client, *parse_line(line))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._close(client, 'Connection closed')
+
+    def _close(self, client, reason):
+        if client.closed:
+            return
+
+        self._quit(client, reason)
+        client._write('ERROR :Closing Link: {} ({})\r\n'.format(
+            client.host,
+            reason
+        ).encode('utf-8'))
+        client.closed = True
+        client.writer.close()
+        self._connections.discard(client)
+
+    def _quit(self, client, reason):
+        peers = set()
+        for channel in client.channels:
+            members = self.channels[channel]
+            members.discard(client)
+            peers.update(members)
+            if not members:
+                del self.channels[channel]
+        client.channels.clear()
+
+        for peer in peers:
+            peer.send(':{} QUIT :{}'.format(client.prefix, reason))
+
+        if client.nick is not None:
+            key = irc.strings.lower(client.nick)
+            if self.clients.get(key) is client:
+                del self.clients[key]
+
+    def _dispatch(self, client, prefix, command, params):
+        handler = getattr(self, '_on_' + command.lower(), None)
+        if handler is None:
+            client.numeric('421', command, 'Unknown command')
+            return
+
+        if not client.registered and command not in {
+                'NICK', 'USER', 'PASS', 'PING', 'PONG', 'QUIT', 'CAP'}:
+            client.numeric('451', 'You have not registered')
+            return
+
+        handler(client, params)
+
+    def _on_cap(self, client, params):
+        pass
+
+    def _on_pass(self, client, params):
+        pass
+
+    def _on_nick(self, client, params):
+        if not params or not params[0]:
+            client.numeric('431', 'No nickname given')
+            return
+
+        nick = params[0]
+        key = irc.strings.lower(nick)
+        owner = self.clients.get(key)
+        if owner is not None and owner is not client:
+            client.numeric('433', nick, 'Nickname is already in use')
+            return
+
+        if client.nick is not None:
+            del self.clients[irc.strings.lower(client.nick)]
+        self.clients[key] = client
+
+        if client.registered:
+            line = ':{} NICK :{}'.format(client.prefix, nick)
+            peers = set([client])
+            for channel in client.channels:
+                peers.update(self.channels[channel])
+            for peer in peers:
+                peer.send(line)
+
+        client.nick = nick
+        self._try_register(client)
+
+    def _on_user(self, client, params):
+        if len(params) < 4:
+            client.numeric('461', 'USER', 'Not enough parameters')
+            return
+
+        client.user = params[0]
+        self._try_register(client)
+
+    def _try_register(self, client):
+        if client.registered or client.nick is None or client.user is None:
+            return
+
+        client.registered = True
+        client.numeric('001', 'Welcome to the test network ' + client.prefix)
+        client.numeric('002', 'Your host is ' + SERVER_NAME)
+        client.numeric('003', 'This server was created for testing')
+        client.send(':{} 004 {} {} bavi-ircd o o'.format(
+            SERVER_NAME,
+            client.nick,
+            SERVER_NAME
+        ))
+        client.numeric(
+                '005',
+                'CHANTYPES=# PREFIX=(ov)@+ CASEMAPPING=rfc1459 NETWORK=Test',
+                'are supported by this server'
+        )
+        client.numeric('422', 'MOTD File is missing')
+
+    def _on_ping(self, client, params):
+        client.send(':{0} PONG {0} :{1}'.format(
+            SERVER_NAME,
+            params[0] if params else ''
+        ))
+
+    def _on_pong(self, client, params):
+        pass
+
+    def _on_quit(self, client, params):
+        self._close(client, 'Quit: ' + (params[0] if params else ''))
+
+    def _on_join(self, client, params):
+        if not params:
+            client.numeric('461', 'JOIN', 'Not enough parameters')
+            return
+
+        if params[0] == '0':
+            for channel in list(client.channels):
+                self._part(client, channel, '')
+            return
+
+        for name in params[0].split(','):
+            if not name.startswith('#'):
+                client.numeric('403', name, 'No such channel')
+                continue
+
+            key = irc.strings.lower(name)
+            if key in client.channels:
+                continue
+
+            members = self.channels.setdefault(key, set())
+            members.add(client)
+            client.channels.add(key)
+
+            line = ':{} JOIN {}'.format(client.prefix, name)
+            for member in members:
+                member.send(line)
+
+            nicks = sorted(member.nick for member in members)
+            for i in range(0, len(nicks), NAMES_PER_LINE):
+                client.numeric(
+                        '353',
+                        '=',
+                        name,
+                        ' '.join(nicks[i:i + NAMES_PER_LINE])
+                )
+            client.numeric('366', name, 'End of /NAMES list.')
+
+    def _on_part(self, client, params):
+        if not params:
+            client.numeric('461', 'PART', 'Not enough parameters')
+            return
+
+        reason = params[1] if len(params) > 1 else ''
+        for name in params[0].split(','):
+            if irc.strings.lower(name) not in client.channels:
+                client.numeric('442', name, "You're not on that channel")
+                continue
+            self._part(client, irc.strings.lower(name), reason)
+
+    def _part(self, client, channel, reason):
+        members = self.channels[channel]
+        line = ':{} PART {} :{}'.format(client.prefix, channel, reason)
+        for member in members:
+            member.send(line)
+
+        members.discard(client)
+        client.channels.discard(channel)
+        if not members:
+            del self.channels[channel]
+
+    def _on_privmsg(self, client, params, command='PRIVMSG'):
+        if len(params) < 2 or not params[1]:
+            client.numeric('412', 'No text to send')
+            return
+
+        target, text = params[0], params[1]
+        line = ':{} {} {} :{}'.format(client.prefix, command, target, text)
+        key = irc.strings.lower(target)
+
+        if target.startswith('#'):
+            if key not in client.channels:
+                client.numeric('404', target, 'Cannot send to channel')
+                return
+            self.stats['channel_messages'] += 1
+            for member in self.channels[key]:
+                if member is not client:
+                    member.send(line)
+        else:
+            recipient = self.clients.get(key)
+            if recipient is None:
+                client.numeric('401', target, 'No such nick/channel')
+                return
+            self.stats['private_messages'] += 1
+            recipient.send(line)
+
+    def _on_notice(self, client, params):
+        self._on_privmsg(client, params, command='NOTICE')
+
+    def _on_mode(self, client, params):
+        if not params:
+            client.numeric('461', 'MODE', 'Not enough parameters')
+        elif params[0].startswith('#'):
+            client.send(':{} 324 {} {} +'.format(
+                SERVER_NAME,
+                client.nick,
+                params[0]
+            ))
+        else:
+            client.send(':{} 221 {} +'.format(SERVER_NAME, client.nick))
+
+    def _on_who(self, client, params):
+        client.numeric('315', params[0] if params else '*', 'End of /WHO list.')
+
+    def _on_topic(self, client, params):
+        if params:
+            client.numeric('331', params[0], 'No topic is set')
+
+class ServerThread:
+    '''
+    Runs an IRCServer on an event loop in a background thread
+    '''
+
+    def __init__(self, server=None, **kwargs):
+        self.server = server or IRCServer(**kwargs)
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+                target=self.loop.run_forever,
+                name='ircd',
+                daemon=True
+        )
+
+    @property
+    def port(self):
+        return self.server.port
+
+    def start(self):
+        self._thread.start()
+        self.call(self.server.start())
+        return self
+
+    def call(self, work, timeout=10):
+        '''
+        Run a coroutine or plain function on the server's loop and return
+        its result
+        '''
+
+        if asyncio.iscoroutine(work):
+            future = asyncio.run_coroutine_threadsafe(work, self.loop)
+            return future.result(timeout)
+
+        async def wrapper():
+            return work()
+
+        return self.call(wrapper(), timeout)
+
+    def stop(self):
+        self.call(self.server.stop())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+class ScriptedClient:
+    '''
+    An asyncio IRC client for driving the server (and any bot connected to
+    it) from tests.
+
+    Received lines are queued for expect(), unless on_line is given, in
+    which case it is called with (timestamp, prefix, command, params) for
+    each line instead.  PINGs are answered automatically.
+    '''
+
+    def __init__(self, nick, host='127.0.0.1', port=6667, on_line=None):
+        self.nick = nick
+        self.host = host
+        self.port = port
+        self.on_line = on_line
+        self.lines = asyncio.Queue()
+        self.closed = asyncio.Event()
+        self._reader = None
+        self._writer = None
+        self._task = None
+
+    async def connect(self, timeout=10):
+        self._reader, self._writer = await asyncio.open_connection(
+                self.host,
+                self.port
+        )
+        self._task = asyncio.ensure_future(self._read())
+        self.send('NICK ' + self.nick)
+        self.send('USER {} 0 * :Scripted client'.format(self.nick))
+        if self.on_line is None:
+            await self.expect(lambda p, c, params: c == '001', timeout)
+
+    def send(self, line):
+        self._writer.write((line + '\r\n').encode('utf-8'))
+
+    async def join(self, channel, timeout=10):
+        self.send('JOIN ' + channel)
+        if self.on_line is None:
+            await self.expect(
+                    lambda p, c, params: c == '366' and params[1] == channel,
+                    timeout
+            )
+
+    def privmsg(self, target, text):
+        self.send('PRIVMSG {} :{}'.format(target, text))
+
+    async def _read(self):
+        try:
+            while True:
+                data = await self._reader.readline()
+                if not data:
+                    break
+
+                now = time.monotonic()
+                prefix, command, params = parse_line(
+                        data.decode('utf-8', 'replace').rstrip('\r\n')
+                )
+                if command == 'PING':
+                    self.send('PONG :' + (params[0] if params else ''))
+                elif self.on_line is not None:
+                    self.on_line(now, prefix, command, params)
+                else:
+                    self.lines.put_nowait((prefix, command, params))
+        except ConnectionError:
+            pass
+        finally:
+            self.closed.set()
+
+    async def expect(self, predicate, timeout=10):
+        '''
+        Discard lines until one satisfies predicate(prefix, command, params)
+        and return it.  Raises asyncio.TimeoutError.
+        '''
+
+        async def wait():
+            while True:
+                line = await self.lines.get()
+                if predicate(*line):
+                    return line
+
+        return await asyncio.wait_for(wait(), timeout)
+
+    async def close(self):
+        if self._writer is None:
+            return
+
+        if not self._writer.is_closing():
+            self.send('QUIT :bye')
+            self._writer.close()
+        try:
+            await asyncio.wait_for(self.closed.wait(), 5)
+        finally:
+            self._task.cancel()
+
+class BotThread:
+    '''
+    Runs a blocking bavi Bot, already set up with init_irc(), on a thread.
+    Unlike Bot.start() it can be stopped.
+    '''
+
+    def __init__(self, bot, timeout=0.02):
+        self.bot = bot
+        self._timeout = timeout
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+                target=self._run,
+                name='bot',
+                daemon=True
+        )
+
+    def _run(self):
+        self.bot._connect()
+        while not self._stop.is_set():
+            self.bot.reactor.process_once(self._timeout)
+        self.bot.connection.disconnect('Stopping')
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+def bot_config(port, nick='TestBot', channels='#test', **sections):
+    '''
+    ConfigParser for a Bot connecting to the local server.  Extra keyword
+    arguments are whole config sections, e.g. outbound={'Rate': '10'}.
+    '''
+
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'irc': {
+            'ServerHost': '127.0.0.1',
+            'ServerPort': str(port),
+            'SSL': 'False',
+            'Nickname': nick,
+            'Channels': channels
+        },
+        'sqlite3': { 'Filename': ':memory:' }
+    })
+    config.read_dict(sections)
+    return config
+
+async def load_test(port, clients, senders, duration, rate, channels):
+    '''
+    Connect `clients` scripted clients spread over `channels` channels and
+    have `senders` of them send ".echo" commands at `rate` lines per second
+    each for `duration` seconds.  Returns statistics about the replies.
+    '''
+
+    sent = {}
+    latencies = []
+    last_reply = [0]
+    names = ['#load{}'.format(i) for i in range(channels)]
+    counter = itertools.count()
+
+    def on_line(now, prefix, command, params):
+        if command != 'PRIVMSG' or not params[1].startswith('echo '):
+            return
+        started = sent.pop(params[1][5:], None)
+        if started is not None:
+            latencies.append(now - started)
+            last_reply[0] = now
+
+    pool = []
+    for i in range(clients):
+        client = ScriptedClient(
+                'load{}'.format(i),
+                port=port,
+                on_line=on_line if i < senders else (lambda *args: None)
+        )
+        pool.append(client)
+
+    for start in range(0, clients, 100):
+        batch = pool[start:start + 100]
+        await asyncio.gather(*(client.connect() for client in batch))
+        for i, client in enumerate(batch, start):
+            client.send('JOIN ' + names[i % channels])
+
+    # Give the server a moment to process registrations and joins
+    await asyncio.sleep(1)
+
+    async def send(client, channel):
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            token = str(next(counter))
+            sent[token] = time.monotonic()
+            client.privmsg(channel, '.echo ' + token)
+            await asyncio.sleep(1 / rate)
+
+    started = time.monotonic()
+    await asyncio.gather(*(
+        send(client, names[i % channels])
+        for i, client in enumerate(pool[:senders])
+    ))
+    # Wait for stragglers
+    await asyncio.sleep(2)
+    elapsed = max(last_reply[0], started + duration) - started
+
+    await asyncio.gather(*(client.close() for client in pool))
+
+    latencies.sort()
+    def percentile(q):
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    return {
+        'clients': clients,
+        'senders': senders,
+        'sent': len(latencies) + len(sent),
+        'replies': len(latencies),
+        'lost': len(sent),
+        'replies_per_second': len(latencies) / elapsed,
+        'latency_p50_seconds': percentile(0.5),
+        'latency_p99_seconds': percentile(0.99)
+    }
+
+def main(argv=None):
+    # Run from a checkout: make the bavi package importable
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)
+    )))
+    import bavi.bot
+
+    parser = argparse.ArgumentParser(
+            description='End-to-end load test against a local IRC server'
+    )
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--senders', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=1.0,
+            help='lines per second from each sender')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--channels', type=int, default=10)
+    parser.add_argument('--lag', type=float, default=0.0)
+    parser.add_argument('--threads', type=int, default=0,
+            help='bot worker threads')
+    parser.add_argument('--output', help='write results as JSON')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    ircd = ServerThread(lag=args.lag).start()
+    config = bot_config(
+            ircd.port,
+            channels=','.join(
+                '#load{}'.format(i) for i in range(args.channels)
+            ),
+            outbound={ 'Rate': '1000000', 'Burst': '1000000',
+                'MaxQueue': '1000000' },
+            workers={ 'Threads': str(args.threads) }
+    )
+    bot = bavi.bot.Bot(config)
+    bot.add_command(
+            'echo',
+            lambda bot, source, target, message, **kwargs:
+                bot.say(target, 'echo ' + message)
+    )
+    bot.init_irc()
+    runner = BotThread(bot).start()
+
+    try:
+        deadline = time.monotonic() + 10
+        while len(ircd.call(lambda: ircd.server.channels)) < args.channels:
+            if time.monotonic() > deadline:
+                raise RuntimeError('Bot did not join its channels')
+            time.sleep(0.1)
+
+        results = ircd.call(load_test(
+            ircd.port,
+            args.clients,
+            args.senders,
+            args.duration,
+            args.rate,
+            args.channels
+        ), timeout=None)
+    finally:
+        runner.stop()
+        ircd.stop()
+
+    results['server'] = dict(ircd.server.stats)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import sys
+import threading
+import unittest
+
+from bavi.lazy import LazyModule, lazy_import
+
+class LazyModuleTestCase(unittest.TestCase):
+    def setUp(self):
+        # A small stdlib module that nothing else in the tests imports
+        self.saved = sys.modules.pop('colorsys', None)
+
+    def tearDown(self):
+        if self.saved is not None:
+            sys.modules['colorsys'] = self.saved
+
+    def test_import_is_deferred_until_first_use(self):
+        colorsys = lazy_import('colorsys')
+
+        assert isinstance(colorsys, LazyModule)
+        assert 'colorsys' not in sys.modules
+
+        self.assertEqual(colorsys.rgb_to_hsv(1, 0, 0), (0, 1, 1))
+        assert 'colorsys' in sys.modules
+        assert 'rgb_to_hsv' in vars(colorsys)
+
+    def test_loaded_module_is_returned_as_is(self):
+        import colorsys
+        assert lazy_import('colorsys') is colorsys
+
+    def test_dunder_lookups_do_not_import(self):
+        colorsys = lazy_import('colorsys')
+
+        assert not hasattr(colorsys, '__path__')
+        assert 'not loaded' in repr(colorsys)
+        assert 'colorsys' not in sys.modules
+
+    def test_missing_module_fails_on_use(self):
+        missing = lazy_import('bavi_no_such_module')
+
+        with self.assertRaises(ImportError):
+            missing.anything
+
+    def test_concurrent_first_use(self):
+        colorsys = lazy_import('colorsys')
+        results = []
+        barrier = threading.Barrier(4)
+
+        def use():
+            barrier.wait()
+            results.append(colorsys.hsv_to_rgb(0, 0, 1))
+
+        threads = [threading.Thread(target=use) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [(1, 1, 1)] * 4)
@@ -0,0 +1,129 @@
+import os
+import re
+import tempfile
+import unittest
+
+from bavi.manifest import ModuleCache, ModuleSpec, describe, discover_modules
+from bavi.matcher import required_literal
+
+def handler(*args, **kwargs):
+    pass
+
+def other(*args, **kwargs):
+    pass
+
+class DiscoverModulesTestCase(unittest.TestCase):
+    def test_builtin_modules(self):
+        specs = { spec.name: spec for spec in discover_modules() }
+
+        for name in ['admin', 'history', 'random', 'tz', 'url']:
+            self.assertEqual(specs[name].import_name, 'bavi.modules.' + name)
+            assert os.path.isfile(specs[name].path)
+        assert '__init__' not in specs
+
+class DescribeTestCase(unittest.TestCase):
+    def test_commands_and_matchers(self):
+        regex = re.compile(r'https?://\S+')
+        entry = describe([
+            ('add_command', ('choose', handler), {
+                'aliases': ['pick'],
+                'max_concurrency': None,
+                'deadline': 5
+            }),
+            ('add_matcher', (regex, other), {
+                'priority': 'low',
+                'max_concurrency': 2,
+                'deadline': None
+            }),
+            ('add_command', ('again', other), {
+                'aliases': [],
+                'max_concurrency': None,
+                'deadline': None
+            }),
+        ], required_literal)
+
+        self.assertEqual(entry['commands'][0], {
+            'name': 'choose',
+            'aliases': ['pick'],
+            'handler': 0,
+            'max_concurrency': None,
+            'deadline': 5
+        })
+        self.assertEqual(entry['matchers'][0]['pattern'], regex.pattern)
+        self.assertEqual(entry['matchers'][0]['literal'], 'http')
+        self.assertEqual(entry['matchers'][0]['handler'], 1)
+        self.assertEqual(entry['commands'][1]['handler'], 1)
+
+    def test_listeners_are_not_cached(self):
+        self.assertIsNone(describe([
+            ('add_command', ('seen', handler), {
+                'aliases': [],
+                'max_concurrency': None,
+                'deadline': None
+            }),
+            ('add_listener', (other,), {}),
+        ], required_literal))
+
+    def test_nothing_registered_is_not_cached(self):
+        self.assertIsNone(describe([], required_literal))
+
+class ModuleCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.module = os.path.join(self.dir.name, 'mod.py')
+        with open(self.module, 'w') as f:
+            f.write('def init(bot): pass\n')
+        self.spec = ModuleSpec('mod', 'mod', self.module)
+        self.path = os.path.join(self.dir.name, 'cache', 'modules.json')
+        self.registrations = [
+            ('add_command', ('cmd', handler), {
+                'aliases': [],
+                'max_concurrency': None,
+                'deadline': None
+            }),
+        ]
+
+    def test_round_trip(self):
+        cache = ModuleCache(self.path)
+        cache.update(self.spec, self.registrations, required_literal)
+        cache.save()
+
+        loaded = ModuleCache(self.path)
+        loaded.load()
+        entry = loaded.get(self.spec)
+        self.assertEqual(entry['commands'][0]['name'], 'cmd')
+
+    def test_changed_file_invalidates_entry(self):
+        cache = ModuleCache(self.path)
+        cache.update(self.spec, self.registrations, required_literal)
+        assert cache.get(self.spec) is not None
+
+        st = os.stat(self.module)
+        os.utime(self.module, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertIsNone(cache.get(self.spec))
+
+    def test_other_version_is_ignored(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('{"version": 0, "modules": {"mod": {}}}')
+
+        cache = ModuleCache(self.path)
+        cache.load()
+        self.assertIsNone(cache.get(self.spec))
+
+    def test_corrupt_cache_is_ignored(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('{not json')
+
+        cache = ModuleCache(self.path)
+        with self.assertLogs('bavi.manifest', 'WARNING'):
+            cache.load()
+        self.assertIsNone(cache.get(self.spec))
+
+    def test_retain_drops_missing_modules(self):
+        cache = ModuleCache(self.path)
+        cache.update(self.spec, self.registrations, required_literal)
+        cache.retain(set())
+        self.assertIsNone(cache.get(self.spec))
@@ -0,0 +1,113 @@
+import re
+import unittest
+
+from bavi.matcher import MatcherEngine, required_literal
+import bavi.modules.url as url_module
+
+class RequiredLiteralTestCase(unittest.TestCase):
+    def test_url_patterns_require_http(self):
+        self.assertEqual(
+                required_literal(url_module.compiled_url_regex),
+                'http'
+        )
+        self.assertEqual(
+                required_literal(url_module.compiled_ip_regex),
+                'http'
+        )
+
+    def test_longest_literal_is_chosen(self):
+        self.assertEqual(
+                required_literal(re.compile(r'ab?cdef[0-9]+gh')),
+                'cdef'
+        )
+
+    def test_repeated_literal_counts(self):
+        self.assertEqual(
+                required_literal(re.compile(r'x*(?:wxyz)+')),
+                'wxyz'
+        )
+
+    def test_optional_and_alternate_have_no_literal(self):
+        self.assertIsNone(required_literal(re.compile(r'(abc)?')))
+        self.assertIsNone(required_literal(re.compile(r'abc|def')))
+
+    def test_ignorecase_has_no_literal(self):
+        self.assertIsNone(required_literal(re.compile(r'(?i)abc')))
+        self.assertEqual(required_literal(re.compile(r'(?i:abc)de')), 'de')
+
+class MatcherEngineTestCase(unittest.TestCase):
+    def test_first_match_wins_in_priority_order(self):
+        engine = MatcherEngine()
+        engine.add(re.compile(r'late'), 'low')
+        engine.add(re.compile(r'zzz'), 'high', priority='high')
+
+        regex, handler, match = engine.match('late zzz')
+        self.assertEqual(handler, 'high')
+
+    def test_miss_returns_none(self):
+        engine = MatcherEngine()
+        engine.add(re.compile(r'matchme:([0-9]+)'), 'handler')
+
+        self.assertIsNone(engine.match('nothing to see here'))
+        self.assertIsNone(engine.match('matchme:abc'))
+
+    def test_unfiltered_matchers_still_run(self):
+        engine = MatcherEngine()
+        engine.add(re.compile(r'matchme:([0-9]+)'), 'literal')
+        engine.add(re.compile(r'(?i)HELLO'), 'ignorecase')
+
+        regex, handler, match = engine.match('oh hello there')
+        self.assertEqual(handler, 'ignorecase')
+
+    def test_regex_not_run_when_literal_absent(self):
+        engine = MatcherEngine()
+        calls = []
+
+        class Spy:
+            pattern = 'matchme'
+            flags = 0
+
+            def search(self, message):
+                calls.append(message)
+                return None
+
+        engine.add(re.compile(r'matchme'), 'handler')
+        engine._matchers[0] = (Spy(), 'handler')
+        engine.match('plain chatter')
+
+        self.assertEqual(calls, [])
+
+    def test_add_invalidates_compiled_state(self):
+        engine = MatcherEngine()
+        engine.add(re.compile(r'abc'), 'first')
+        self.assertIsNone(engine.match('xyz'))
+
+        engine.add(re.compile(r'xyz'), 'second')
+        regex, handler, match = engine.match('xyz')
+        self.assertEqual(handler, 'second')
+
+    def test_remove(self):
+        engine = MatcherEngine()
+        regex = re.compile(r'abc')
+        engine.add(regex, 'first')
+        self.assertIsNotNone(engine.match('abc'))
+
+        engine.remove(regex, 'first')
+        self.assertIsNone(engine.match('abc'))
+        self.assertEqual(len(engine), 0)
+
+        with self.assertRaises(ValueError):
+            engine.remove(regex, 'first')
+
+    def test_remove_and_add_at_key(self):
+        engine = MatcherEngine()
+        first = re.compile(r'a')
+        engine.add(first, 'first')
+        engine.add(re.compile(r'b'), 'second', priority='medium')
+        engine.add(re.compile(r'c'), 'third')
+
+        key = engine.remove(first, 'first')
+        engine.add(re.compile(r'a'), 'again', key=key)
+
+        self.assertEqual([handler for regex, handler in engine],
+                ['second', 'again', 'third'])
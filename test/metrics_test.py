@@ -0,0 +1,147 @@
+import threading
+import unittest
+import urllib.request
+from unittest.mock import MagicMock
+
+from irc.client import Event, NickMask
+
+import bavi.bot
+from bavi.metrics import Histogram, Metrics, MetricsServer, RateCounter
+
+class Dummy:
+    pass
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class HistogramTestCase(unittest.TestCase):
+    def test_quantiles(self):
+        histogram = Histogram(buckets=(1, 2, 3))
+        for value in [0.5] * 50 + [1.5] * 49 + [2.5]:
+            histogram.observe(value)
+
+        self.assertEqual(histogram.quantile(0.5), 1)
+        self.assertEqual(histogram.quantile(0.99), 2)
+        self.assertEqual(histogram.quantile(1), 3)
+        self.assertEqual(histogram.count, 100)
+
+    def test_empty(self):
+        self.assertIsNone(Histogram().quantile(0.5))
+
+class RateCounterTestCase(unittest.TestCase):
+    def test_rate_is_averaged_over_window(self):
+        clock = FakeClock()
+        counter = RateCounter(window=10, clock=clock)
+        counter.add(20)
+        clock.now = 5
+        counter.add(10)
+
+        self.assertEqual(counter.rate(), 3.0)
+
+        clock.now = 12
+        self.assertEqual(counter.rate(), 1.0)
+
+        clock.now = 100
+        self.assertEqual(counter.rate(), 0.0)
+        self.assertEqual(counter.total, 30)
+
+class MetricsTestCase(unittest.TestCase):
+    def test_render_while_handlers_are_added(self):
+        metrics = Metrics()
+        done = threading.Event()
+
+        def add():
+            for i in range(2000):
+                metrics.handler('command:{}'.format(i))
+                metrics.add_gauge('gauge', { 'n': str(i) }, lambda: 0)
+            done.set()
+
+        thread = threading.Thread(target=add)
+        thread.start()
+        try:
+            while not done.is_set():
+                metrics.render_prometheus()
+                metrics.summary()
+        finally:
+            thread.join()
+
+        labels = [label for label, stats in metrics.handler_stats()]
+        self.assertEqual(labels, sorted(metrics.handlers))
+
+class BotMetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.bot = bavi.bot.Bot(None)
+        self.bot.connection = Dummy()
+        self.bot.connection.get_nickname = lambda: 'TestBot'
+        self.bot.connection.privmsg = MagicMock()
+        self.bot.channels = { '#test' }
+
+    def pubmsg(self, message, source='user!ident@host'):
+        self.bot.on_pubmsg(
+                None,
+                Event('pubmsg', NickMask(source), '#test', [message])
+        )
+
+    def test_handler_calls_and_errors_are_counted(self):
+        def handler(bot, source, target, message, **kwargs):
+            if message:
+                raise ValueError('bad')
+
+        self.bot.add_command('example', handler)
+        self.pubmsg('.example')
+        self.pubmsg('.example fail')
+        self.pubmsg('just chatting')
+
+        stats = self.bot.metrics.handlers['command:example']
+        self.assertEqual(stats.calls, 2)
+        self.assertEqual(stats.errors, 1)
+        self.assertEqual(stats.latency.count, 2)
+        self.assertEqual(self.bot.metrics.messages.total, 3)
+        self.assertEqual(self.bot.metrics.matcher_misses, 1)
+
+    def test_failing_coroutine_is_timed_once(self):
+        async def handler(bot, source, target, message, **kwargs):
+            raise ValueError('bad')
+
+        self.bot.add_command('example', handler)
+        self.pubmsg('.example')
+
+        stats = self.bot.metrics.handlers['command:example']
+        self.assertEqual(stats.calls, 1)
+        self.assertEqual(stats.errors, 1)
+        self.assertEqual(stats.latency.count, 1)
+
+    def test_prometheus_output(self):
+        self.bot.add_command('example', lambda *args, **kwargs: None)
+        self.pubmsg('.example')
+
+        text = self.bot.metrics.render_prometheus()
+        self.assertIn('bavi_messages_total 1', text)
+        self.assertIn(
+                'bavi_handler_calls_total{handler="command:example"} 1',
+                text
+        )
+        self.assertIn(
+                'bavi_handler_latency_seconds_bucket'
+                '{handler="command:example",le="+Inf"} 1',
+                text
+        )
+        self.assertIn('bavi_outbound_queue_depth{network="irc"} 0', text)
+        self.assertIn('# TYPE bavi_outbound_dropped_total counter', text)
+
+class MetricsServerTestCase(unittest.TestCase):
+    def test_serves_metrics(self):
+        server = MetricsServer(Metrics(), port=0)
+        server.start()
+        try:
+            url = 'http://{}:{}/metrics'.format(*server.address)
+            with urllib.request.urlopen(url) as response:
+                body = response.read().decode('utf-8')
+        finally:
+            server.stop()
+
+        self.assertIn('bavi_messages_total 0', body)
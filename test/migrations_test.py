@@ -0,0 +1,87 @@
+import sqlite3
+import unittest
+
+from bavi.db import Database
+from bavi.migrations import MigrationError, migrate
+
+def create_a(conn):
+    conn.execute('CREATE TABLE a (x INTEGER)')
+
+def fail(conn):
+    raise ValueError('no')
+
+class MigrateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = Database(':memory:')
+        self.addCleanup(self.db.close)
+
+    def tables(self):
+        return sorted(name for name, in self.db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        ))
+
+    def version(self, module):
+        if 'schema_versions' not in self.tables():
+            return 0
+        row = self.db.execute(
+                'SELECT version FROM schema_versions WHERE module = ?',
+                (module,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def test_applies_migrations_in_order(self):
+        migrations = [create_a, 'ALTER TABLE a ADD COLUMN y TEXT']
+
+        self.assertEqual(self.db.migrate('mod', migrations), 2)
+
+        self.assertEqual(self.tables(), ['a', 'schema_versions'])
+        self.db.execute_write('INSERT INTO a (x, y) VALUES (1, ?)', ('b',))
+        self.assertEqual(self.version('mod'), 2)
+
+    def test_only_new_migrations_run(self):
+        self.db.migrate('mod', [create_a])
+        self.db.execute_write('INSERT INTO a (x) VALUES (1)')
+
+        self.assertEqual(self.db.migrate('mod', [create_a]), 1)
+        self.assertEqual(self.db.migrate('mod', [
+            create_a,
+            'ALTER TABLE a ADD COLUMN y TEXT'
+        ]), 2)
+
+        self.assertEqual(self.db.execute('SELECT x, y FROM a').fetchall(),
+                [(1, None)])
+
+    def test_versions_are_per_module(self):
+        self.db.migrate('one', [create_a])
+        self.db.migrate('two', ['CREATE TABLE b (x)', 'CREATE TABLE c (x)'])
+
+        self.assertEqual(self.version('one'), 1)
+        self.assertEqual(self.version('two'), 2)
+
+    def test_failed_migration_rolls_back_all(self):
+        with self.assertRaises(ValueError):
+            self.db.migrate('mod', [create_a, fail])
+
+        self.assertNotIn('a', self.tables())
+        self.assertEqual(self.version('mod'), 0)
+
+    def test_newer_schema_is_refused(self):
+        self.db.migrate('mod', [create_a, 'CREATE TABLE b (x)'])
+
+        with self.assertRaises(MigrationError):
+            self.db.migrate('mod', [create_a])
+
+    def test_migrate_in_caller_transaction(self):
+        conn = sqlite3.connect(':memory:')
+        self.addCleanup(conn.close)
+
+        conn.execute('BEGIN')
+        migrate(conn, 'mod', [create_a])
+        conn.rollback()
+
+        self.assertEqual(conn.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE name = 'a'"
+        ).fetchone(), (0,))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,394 @@
+import configparser
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+from unittest.mock import MagicMock
+
+from irc.client import Event, NickMask
+
+import bavi.bot
+from bavi.db import Database
+import bavi.manifest as manifest
+import bavi.module_loader as module_loader
+import bavi.modules.random as random_module
+import bavi.modules.url as url_module
+
+class ModuleLoaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.bot = bavi.bot.Bot(None)
+        self.bot.connection = MagicMock()
+        self.bot.connection.get_nickname.return_value = 'TestBot'
+        self.bot.reply_to = MagicMock()
+        self.bot.say = MagicMock()
+        self.registry = self.bot._registry
+        module_loader.load_module(self.bot, 'random.py')
+        module_loader.load_module(self.bot, 'url.py')
+
+        # Reloading replaces modules in sys.modules; put the originals back
+        for module in [random_module, url_module]:
+            self.addCleanup(module_loader._install, module.__name__, module)
+
+    def pubmsg(self, message):
+        self.bot.on_pubmsg(
+                None,
+                Event('pubmsg', NickMask('user!ident@host'), '#test',
+                    [message])
+        )
+
+    def test_registrations_are_owned_by_module(self):
+        self.assertEqual(self.registry.modules, ['random', 'url'])
+
+        self.registry.unregister('random')
+
+        self.assertEqual(self.registry.modules, ['url'])
+        assert 'choose' not in self.registry.commands
+        assert 'pick' not in self.registry.commands
+        assert 'title' in self.registry.commands
+
+    def test_unregister_and_restore(self):
+        matchers = len(self.registry.matchers)
+        removed = self.registry.unregister('url')
+
+        assert 'title' not in self.registry.commands
+        self.assertEqual(len(self.registry.matchers), matchers - 2)
+
+        self.registry.restore('url', removed)
+
+        assert 'title' in self.registry.commands
+        self.assertEqual(len(self.registry.matchers), matchers)
+        self.assertEqual(self.registry.modules, ['random', 'url'])
+
+    def test_reload_swaps_handlers(self):
+        old = self.registry.commands['choose']
+
+        module_loader.reload_module(self.bot, 'random')
+
+        new = self.registry.commands['choose']
+        assert new is not old
+        mod = sys.modules['bavi.modules.random']
+        assert mod is not random_module
+        assert new is mod.choose_command
+        assert bavi.modules.random is mod
+        assert self.registry.commands['pick'] is new
+
+        self.pubmsg('.choose a, a')
+        self.bot.reply_to.assert_called_with(
+                NickMask('user!ident@host'),
+                '#test',
+                'Your choices: a, a, I chose: a.'
+        )
+
+    def test_failed_reload_keeps_old_handlers(self):
+        old = self.registry.commands['choose']
+
+        def init(bot):
+            bot.add_command('broken', lambda *args, **kwargs: None)
+            raise RuntimeError('init failed')
+
+        broken = types.SimpleNamespace(init=init)
+        with mock.patch.object(module_loader, '_import_fresh',
+                return_value=broken):
+            with self.assertRaises(RuntimeError):
+                module_loader.reload_module(self.bot, 'random')
+
+        assert self.registry.commands['choose'] is old
+        assert 'broken' not in self.registry.commands
+        assert sys.modules['bavi.modules.random'] is random_module
+        self.assertEqual(self.registry.modules, ['random', 'url'])
+
+    def matcher_handlers(self):
+        return [handler for regex, handler in self.registry.matchers]
+
+    def test_reload_keeps_matcher_order(self):
+        later = MagicMock(__name__='later')
+        with self.registry.loading('later'):
+            self.bot.add_matcher(re.compile(r'https?://'), later)
+
+        module_loader.reload_module(self.bot, 'url')
+
+        title = sys.modules['bavi.modules.url'].title_command
+        self.assertEqual(self.matcher_handlers(), [title, title, later])
+
+    def test_failed_reload_keeps_matcher_order(self):
+        later = MagicMock(__name__='later')
+        with self.registry.loading('later'):
+            self.bot.add_matcher(re.compile(r'https?://'), later)
+
+        def init(bot):
+            bot.add_matcher(re.compile(r'broken'), MagicMock())
+            raise RuntimeError('init failed')
+
+        broken = types.SimpleNamespace(init=init)
+        with mock.patch.object(module_loader, '_import_fresh',
+                return_value=broken):
+            with self.assertRaises(RuntimeError):
+                module_loader.reload_module(self.bot, 'url')
+
+        title = url_module.title_command
+        self.assertEqual(self.matcher_handlers(), [title, title, later])
+
+    def test_reload_runs_old_shutdown_hooks(self):
+        hook = MagicMock()
+        with self.registry.loading('random'):
+            self.bot.add_shutdown_hook(hook)
+
+        module_loader.reload_module(self.bot, 'random')
+
+        hook.assert_called_once_with()
+        self.assertNotIn(hook, self.registry.shutdown_hooks)
+
+    def test_reload_keeps_old_globals(self):
+        flights = url_module._flights
+        flights['in-flight'] = object()
+
+        module_loader.reload_module(self.bot, 'url')
+
+        # A handler still running with the old code finds its state intact
+        assert url_module._flights is flights
+        self.assertIn('in-flight', url_module._flights)
+        self.assertEqual(sys.modules['bavi.modules.url']._flights, {})
+        del flights['in-flight']
+
+    def test_unload(self):
+        hook = MagicMock()
+        with self.registry.loading('url'):
+            self.bot.add_shutdown_hook(hook)
+
+        module_loader.unload_module(self.bot, 'url')
+
+        hook.assert_called_once_with()
+        assert 'title' not in self.registry.commands
+        self.assertEqual(len(self.registry.matchers), 0)
+        self.pubmsg('http://example.com')
+        self.bot.say.assert_not_called()
+
+        with self.assertRaises(KeyError):
+            module_loader.unload_module(self.bot, 'url')
+
+    def test_reload_loads_unloaded_module(self):
+        module_loader.unload_module(self.bot, 'url')
+        module_loader.reload_module(self.bot, 'url')
+
+        mod = sys.modules['bavi.modules.url']
+        assert self.registry.commands['title'] is mod.title_command
+
+    def test_unknown_module(self):
+        for name in ['nonexistent', '__init__', '../bot', 'os.path']:
+            with self.assertRaises(KeyError):
+                module_loader.reload_module(self.bot, name)
+
+    def test_load_module_returns_timings(self):
+        registry = self.bot._registry
+        registry.unregister('random')
+
+        import_time, init_time = module_loader.load_module(
+                self.bot,
+                'random.py'
+        )
+
+        assert import_time >= 0 and init_time >= 0
+        assert 'choose' in registry.commands
+
+    def test_heavy_dependencies_are_imported_lazily(self):
+        # Some versions of irc import pytz themselves (through tempora), so
+        # only count what the modules import
+        code = (
+            'import sys, bavi.bot\n'
+            'before = set(sys.modules)\n'
+            'import bavi.modules.url, bavi.modules.tz\n'
+            'print(sorted({"requests", "bs4", "pytz"} &'
+            ' (set(sys.modules) - before)))'
+        )
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+        output = subprocess.check_output(
+                [sys.executable, '-c', code],
+                cwd=root
+        )
+
+        self.assertEqual(output.strip(), b'[]')
+
+class ModuleCacheLoadingTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = os.path.join(directory.name, 'modules.json')
+
+        specs = [
+            spec for spec in manifest.discover_modules()
+            if spec.name in { 'random', 'url' }
+        ]
+        patcher = mock.patch(
+                'bavi.module_loader.discover_modules',
+                return_value=specs
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_bot(self):
+        config = configparser.ConfigParser()
+        config.read_dict({ 'modules': { 'Cache': self.cache } })
+        bot = bavi.bot.Bot(config)
+        bot.connection = MagicMock()
+        bot.connection.get_nickname.return_value = 'TestBot'
+        bot.reply_to = MagicMock()
+        bot.say = MagicMock()
+        return bot
+
+    def pubmsg(self, bot, message):
+        bot.on_pubmsg(
+                None,
+                Event('pubmsg', NickMask('user!ident@host'), '#test',
+                    [message])
+        )
+
+    def test_first_run_writes_cache(self):
+        bot = self.make_bot()
+        module_loader.load_modules(bot)
+
+        assert bot._registry.commands['choose'] is \
+                random_module.choose_command
+        with open(self.cache) as f:
+            data = json.load(f)
+        self.assertEqual(sorted(data['modules']), ['random', 'url'])
+        self.assertEqual(
+                data['modules']['random']['commands'][0]['aliases'],
+                ['pick']
+        )
+
+    def test_cached_modules_are_stubbed_until_used(self):
+        module_loader.load_modules(self.make_bot())
+
+        bot = self.make_bot()
+        timings = module_loader.load_modules(bot)
+        registry = bot._registry
+
+        self.assertEqual(timings['random'][0], 0.0)
+        stub = registry.commands['choose']
+        assert isinstance(stub, module_loader.ModuleStub)
+        assert registry.commands['pick'] is stub
+        self.assertEqual(registry.modules, ['random', 'url'])
+
+        # An abbreviation resolves to the real command once loaded
+        self.pubmsg(bot, '.cho a, a')
+
+        assert registry.commands['choose'] is random_module.choose_command
+        bot.reply_to.assert_called_with(
+                NickMask('user!ident@host'),
+                '#test',
+                'Your choices: a, a, I chose: a.'
+        )
+        assert isinstance(registry.commands['title'],
+                module_loader.ModuleStub)
+
+    def test_matcher_stub_loads_module(self):
+        module_loader.load_modules(self.make_bot())
+        bot = self.make_bot()
+        module_loader.load_modules(bot)
+
+        with mock.patch('bavi.modules.url.get_http_title',
+                return_value='Example'):
+            self.pubmsg(bot, 'see http://example.com')
+
+        bot.say.assert_called_with('#test', '[ Example ] - example.com')
+        assert bot._registry.commands['title'] is url_module.title_command
+        self.assertEqual(len(bot._registry.matchers), 2)
+
+    def test_cached_module_is_loaded_to_migrate_schema(self):
+        specs = [spec for spec in manifest.discover_modules()
+                if spec.name == 'tz']
+
+        def make_bot(db):
+            bot = self.make_bot()
+            bot.db = db
+            return bot
+
+        with mock.patch('bavi.module_loader.discover_modules',
+                return_value=specs):
+            db = Database(':memory:')
+            self.addCleanup(db.close)
+            module_loader.load_modules(make_bot(db))
+
+            # Same database: up to date, so the module can wait
+            bot = make_bot(db)
+            module_loader.load_modules(bot)
+            assert isinstance(bot._registry.commands['time'],
+                    module_loader.ModuleStub)
+
+            # New database: loaded at startup so its migrations run
+            db = Database(':memory:')
+            self.addCleanup(db.close)
+            bot = make_bot(db)
+            module_loader.load_modules(bot)
+            assert not isinstance(bot._registry.commands['time'],
+                    module_loader.ModuleStub)
+            self.assertEqual(db.execute('SELECT COUNT(*) FROM tz_info')
+                    .fetchone(), (0,))
+
+    def test_matcher_order_does_not_depend_on_cache(self):
+        # A module discovered before url, with a matcher for the same links
+        directory = os.path.dirname(self.cache)
+        with open(os.path.join(directory, 'bavi_early.py'), 'w') as f:
+            f.write(
+                'import re\n'
+                'def early(bot, source, target, message, **kwargs):\n'
+                '    bot.say(target, "early")\n'
+                'def init(bot):\n'
+                '    bot.add_matcher(re.compile(r"https?://"), early)\n'
+            )
+        sys.path.insert(0, directory)
+        self.addCleanup(sys.path.remove, directory)
+        self.addCleanup(sys.modules.pop, 'bavi_early', None)
+
+        early = manifest.ModuleSpec('early', 'bavi_early',
+                os.path.join(directory, 'bavi_early.py'))
+        url = [spec for spec in module_loader.discover_modules()
+                if spec.name == 'url']
+
+        def names(bot):
+            return [handler.__name__
+                    for regex, handler in bot._registry.matchers]
+
+        with mock.patch('bavi.module_loader.discover_modules',
+                return_value=[early] + url):
+            module_loader.load_modules(self.make_bot())
+
+            with open(self.cache) as f:
+                data = json.load(f)
+            data['modules']['early']['stamp'] = [0, 0]
+            with open(self.cache, 'w') as f:
+                json.dump(data, f)
+
+            # url is cached and early is not
+            bot = self.make_bot()
+            module_loader.load_modules(bot)
+            self.assertEqual(names(bot), ['early', 'url#0', 'url#0'])
+
+            # Loading url swaps its stubs in place
+            regex, stub = list(bot._registry.matchers)[1]
+            stub.load()
+            self.assertEqual(names(bot),
+                    ['early', 'title_command', 'title_command'])
+
+    def test_changed_module_is_loaded_again(self):
+        module_loader.load_modules(self.make_bot())
+
+        with open(self.cache) as f:
+            data = json.load(f)
+        data['modules']['random']['stamp'] = [0, 0]
+        with open(self.cache, 'w') as f:
+            json.dump(data, f)
+
+        bot = self.make_bot()
+        module_loader.load_modules(bot)
+
+        assert bot._registry.commands['choose'] is \
+                random_module.choose_command
+        assert isinstance(bot._registry.commands['title'],
+                module_loader.ModuleStub)
@@ -0,0 +1,122 @@
+import configparser
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from irc.client import Event, NickMask
+
+import bavi.bot
+import bavi.module_loader as module_loader
+import bavi.modules.admin as admin_module
+import bavi.modules.random as random_module
+
+class AdminModuleTestCase(unittest.TestCase):
+    def setUp(self):
+        config = configparser.ConfigParser()
+        config.read_dict({ 'bavi': { 'Admins': 'admin!*@*' } })
+        self.bot = bavi.bot.Bot(config)
+        with self.bot._registry.loading('admin'):
+            admin_module.init(self.bot)
+        self.bot.say = MagicMock()
+        self.bot.reply_to = MagicMock()
+
+    def pubmsg(self, message, source):
+        self.bot.on_pubmsg(
+                None,
+                Event('pubmsg', NickMask(source), '#test', [message])
+        )
+
+    def test_stats_requires_admin(self):
+        self.pubmsg('.stats', 'user!ident@host')
+
+        self.bot.reply_to.assert_called_with(
+                NickMask('user!ident@host'),
+                '#test',
+                "You aren't allowed to do that."
+        )
+        self.bot.say.assert_not_called()
+
+    def test_stats_for_admin(self):
+        self.pubmsg('.stats', 'Admin!ident@host')
+
+        response = self.bot.say.call_args[0][1]
+        assert response.startswith('1 msgs')
+
+    def test_profile_requires_admin(self):
+        self.pubmsg('.profile start', 'user!ident@host')
+
+        assert not self.bot.profiler.running
+        self.bot.reply_to.assert_called_with(
+                NickMask('user!ident@host'),
+                '#test',
+                "You aren't allowed to do that."
+        )
+
+    def test_profile_start_stop(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.bot.config.read_dict({
+                'profiler': { 'Directory': directory }
+            })
+
+            self.pubmsg('.profile start', 'admin!ident@host')
+            assert self.bot.profiler.running
+            self.pubmsg('.profile stop', 'admin!ident@host')
+            assert not self.bot.profiler.running
+
+            response = self.bot.reply_to.call_args[0][2]
+            assert response.startswith('Profile written to ' + directory)
+            assert os.listdir(directory)
+
+    def test_reload_requires_admin(self):
+        self.pubmsg('.reload random', 'user!ident@host')
+        self.bot._run_callbacks()
+
+        self.bot.reply_to.assert_called_with(
+                NickMask('user!ident@host'),
+                '#test',
+                "You aren't allowed to do that."
+        )
+
+    def test_reload_and_unload(self):
+        module_loader.load_module(self.bot, 'random.py')
+        self.addCleanup(module_loader._install, random_module.__name__,
+                random_module)
+        old = self.bot._registry.commands['choose']
+
+        self.pubmsg('.reload random', 'admin!ident@host')
+        # The swap waits for the connection's thread
+        assert self.bot._registry.commands['choose'] is old
+        self.bot._run_callbacks()
+
+        assert self.bot._registry.commands['choose'] is not old
+        self.bot.reply_to.assert_called_with(
+                NickMask('admin!ident@host'),
+                '#test',
+                'Reloaded random.'
+        )
+
+        self.pubmsg('.unload random', 'admin!ident@host')
+        self.bot._run_callbacks()
+
+        assert 'choose' not in self.bot._registry.commands
+        self.bot.reply_to.assert_called_with(
+                NickMask('admin!ident@host'),
+                '#test',
+                'Unloaded random.'
+        )
+
+    def test_reload_unknown_module(self):
+        self.pubmsg('.reload nope', 'admin!ident@host')
+
+        self.bot.reply_to.assert_called_with(
+                NickMask('admin!ident@host'),
+                '#test',
+                'No module named "nope".'
+        )
+
+    def test_unload_admin_is_refused(self):
+        self.pubmsg('.unload admin', 'admin!ident@host')
+        self.bot._run_callbacks()
+
+        assert 'reload' in self.bot._registry.commands
@@ -0,0 +1,195 @@
+import configparser
+import sqlite3
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from irc.client import Event, NickMask
+
+import bavi.bot
+from bavi.db import Database
+import bavi.modules.history as history_module
+from bavi.modules.history import HistoryStore, fts_query, format_ago
+
+class HistoryStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:', check_same_thread=False)
+        self.now = 1000000.0
+        self.store = HistoryStore(
+                lambda: self.db,
+                retention_days=1,
+                clock=lambda: self.now
+        )
+        self.store.start()
+
+    def tearDown(self):
+        self.store.close()
+
+    def ask(self, method, *args):
+        done = threading.Event()
+        result = []
+
+        def callback(value):
+            result.append(value)
+            done.set()
+
+        def errback(e):
+            result.append(e)
+            done.set()
+
+        method(*args, callback, errback)
+        assert done.wait(5)
+        return result[0]
+
+    def test_seen_and_last(self):
+        self.store.record('net', '#a', 'Alice', 'first')
+        self.now += 10
+        self.store.record('net', '#b', 'alice', 'second')
+        self.store.record('other', '#a', 'alice', 'elsewhere')
+
+        assert self.ask(self.store.seen, 'net', 'ALICE') == \
+                (self.now, '#b', 'alice', 'second')
+        assert self.ask(self.store.last, 'net', '#A', 'alice') == \
+                (self.now - 10, 'Alice', 'first')
+        assert self.ask(self.store.seen, 'net', 'bob') is None
+
+    def test_grep(self):
+        for i in range(5):
+            self.store.record('net', '#a', 'alice', 'hello world {}'.format(i))
+        self.store.record('net', '#a', 'bob', 'goodbye world')
+        self.store.record('net', '#b', 'carol', 'hello world elsewhere')
+
+        rows = self.ask(self.store.grep, 'net', '#a', 'hello WORLD')
+        assert [message for ts, nick, message in rows] == [
+            'hello world 4',
+            'hello world 3',
+            'hello world 2'
+        ]
+
+        rows = self.ask(self.store.grep, 'net', '#a', '"goodbye" OR')
+        assert rows == []
+
+    def test_prune(self):
+        self.store.record('net', '#a', 'alice', 'old line')
+        self.now += 2 * 86400
+        self.store.record('net', '#a', 'alice', 'new line')
+
+        # The first query flushes both lines; pruning runs once idle
+        assert self.ask(self.store.seen, 'net', 'alice') is not None
+        deadline = time.monotonic() + 5
+        while self.store.pruned == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        assert self.store.pruned == 1
+        assert self.ask(self.store.grep, 'net', '#a', 'line') == [
+            (self.now, 'alice', 'new line')
+        ]
+
+    def test_query_errors(self):
+        def fail(db):
+            raise ValueError('nope')
+
+        result = self.ask(lambda callback, errback:
+                self.store.query(fail, (), callback, errback))
+        assert isinstance(result, ValueError)
+
+class SharedDatabaseTestCase(unittest.TestCase):
+    def test_waits_for_writes_on_shared_connection(self):
+        db = Database(':memory:')
+        self.addCleanup(db.close)
+        db.execute_write('CREATE TABLE t (value TEXT)')
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_write(conn):
+            conn.execute("INSERT INTO t (value) VALUES ('a')")
+            started.set()
+            release.wait(5)
+
+        writer = threading.Thread(target=lambda: db.write(slow_write))
+        writer.start()
+        assert started.wait(5)
+
+        store = HistoryStore(db.connect, exclusive=db.exclusive)
+        store.start()
+        store.record('net', '#test', 'nick', 'hello')
+        release.set()
+        writer.join(5)
+        store.close()
+
+        self.assertEqual(db.execute('SELECT value FROM t').fetchall(),
+                [('a',)])
+        self.assertEqual(db.execute('SELECT message FROM history').fetchall(),
+                [('hello',)])
+
+class HistoryHelpersTestCase(unittest.TestCase):
+    def test_fts_query(self):
+        assert fts_query('a "b" OR') == '"a" """b""" "OR"'
+        assert fts_query('   ') == ''
+
+    def test_format_ago(self):
+        assert format_ago(5) == 'just now'
+        assert format_ago(125) == '2m ago'
+        assert format_ago(3 * 3600 + 120) == '3h 2m ago'
+        assert format_ago(2 * 86400 + 3600) == '2d 1h ago'
+
+class HistoryModuleTestCase(unittest.TestCase):
+    def setUp(self):
+        config = configparser.ConfigParser()
+        config.read_dict({ 'sqlite3': { 'Filename': ':memory:' } })
+        self.bot = bavi.bot.Bot(config)
+        self.bot.init_db()
+        history_module.init(self.bot)
+        self.bot.connection = MagicMock()
+        self.bot.connection.get_nickname.return_value = 'TestBot'
+        self.bot.channels = { '#test' }
+        self.bot.say = MagicMock()
+        self.bot.reply_to = MagicMock()
+
+    def tearDown(self):
+        self.bot.shutdown()
+
+    def pubmsg(self, message, source='user!ident@host', target='#test'):
+        self.bot.on_pubmsg(
+                None,
+                Event('pubmsg', NickMask(source), target, [message])
+        )
+
+    def wait_for_reply(self, mock):
+        deadline = time.monotonic() + 5
+        while not mock.called:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+            self.bot._run_callbacks()
+        return mock.call_args[0][-1]
+
+    def test_seen(self):
+        self.pubmsg('hello there', 'Alice!a@host')
+        self.pubmsg('.seen alice')
+
+        assert self.wait_for_reply(self.bot.reply_to) == \
+                'Alice was last seen here just now: hello there'
+
+    def test_seen_hides_other_channels(self):
+        self.pubmsg('hello there', 'Alice!a@host')
+        self.pubmsg('a secret', 'Alice!a@host', '#Secret')
+        self.pubmsg('.seen alice')
+
+        assert self.wait_for_reply(self.bot.reply_to) == \
+                'Alice was last seen just now.'
+
+    def test_commands_are_not_recorded(self):
+        self.pubmsg('.seen alice', 'Alice!a@host')
+        self.pubmsg('.seen alice')
+
+        assert self.wait_for_reply(self.bot.reply_to) == \
+                "I haven't seen alice."
+
+    def test_grep(self):
+        self.pubmsg('the quick brown fox', 'Alice!a@host')
+        self.pubmsg('.grep brown fox')
+
+        assert self.wait_for_reply(self.bot.say).endswith(
+                '<Alice> the quick brown fox'
+        )
@@ -1,16 +1,18 @@
-import sqlite3
 import unittest
+from unittest import mock
 from unittest.mock import MagicMock
 
 from irc.client import Event, NickMask
 
 import bavi.bot
+from bavi.db import Database
+from bavi.writebehind import QueueFull
 import bavi.modules.tz as tz_module
 
 class TzModuleTestCase(unittest.TestCase):
     def setUp(self):
         self.bot = bavi.bot.Bot(None)
-        self.bot.db = sqlite3.connect(':memory:')
+        self.bot.db = Database(':memory:')
         tz_module.init(self.bot)
         self.bot.say = MagicMock()
         self.bot.reply_to = MagicMock()
@@ -31,8 +33,8 @@ class TzModuleTestCase(unittest.TestCase):
                 'Your timezone has been set to America/Chicago'
         )
 
-        c = self.bot.db.cursor()
-        c.execute('SELECT tz FROM tz_info WHERE nick = ?', ('test',))
+        c = self.bot.db.execute('SELECT tz FROM tz_info WHERE nick = ?',
+                ('test',))
 
         tz, = next(c)
         assert tz == 'America/Chicago'
@@ -51,8 +53,8 @@ class TzModuleTestCase(unittest.TestCase):
                 'Your timezone has been set to America/New_York'
         )
 
-        c = self.bot.db.cursor()
-        c.execute('SELECT tz FROM tz_info WHERE nick = ?', ('test',))
+        c = self.bot.db.execute('SELECT tz FROM tz_info WHERE nick = ?',
+                ('test',))
 
         tz, = next(c)
         assert tz == 'America/New_York'
@@ -73,8 +75,8 @@ class TzModuleTestCase(unittest.TestCase):
                 "I don't know about that timezone"
         )
 
-        c = self.bot.db.cursor()
-        c.execute('SELECT tz FROM tz_info WHERE nick = ?', ('test',))
+        c = self.bot.db.execute('SELECT tz FROM tz_info WHERE nick = ?',
+                ('test',))
 
         assert len(list(c)) == 0
 
@@ -94,8 +96,8 @@ class TzModuleTestCase(unittest.TestCase):
                 'Give me a timezone, for example .settz America/Los_Angeles'
         )
 
-        c = self.bot.db.cursor()
-        c.execute('SELECT tz FROM tz_info WHERE nick = ?', ('test',))
+        c = self.bot.db.execute('SELECT tz FROM tz_info WHERE nick = ?',
+                ('test',))
 
         assert len(list(c)) == 0
 
@@ -229,3 +231,95 @@ class TzModuleTestCase(unittest.TestCase):
                 '#test',
                 "I don't know about that timezone."
         )
+
+    def test_settz_when_queue_full(self):
+        writes = self.bot.db.write_behind('tz')
+        with mock.patch.object(writes, 'put', side_effect=QueueFull()):
+            self.bot.on_pubmsg(
+                    None,
+                    Event(
+                        'pubmsg',
+                        NickMask('test!user@example.com'),
+                        '#test',
+                        ['.settz America/Chicago']
+                    )
+            )
+
+        self.bot.reply_to.assert_called_with(
+                NickMask('test!user@example.com'),
+                '#test',
+                "I'm too busy to save that right now, try again later"
+        )
+
+
+    def test_store_keeps_created_at(self):
+        self.bot.db.execute_write('''
+                INSERT INTO tz_info (nick, tz, created_at, updated_at)
+                VALUES ('test', 'UTC', '2020-01-01 00:00:00',
+                        '2020-01-01 00:00:00')
+        ''')
+
+        self.bot.db.write(tz_module._store_tz, 'test', 'America/Chicago')
+
+        row = self.bot.db.execute(
+                'SELECT tz, created_at, updated_at FROM tz_info'
+        ).fetchone()
+        self.assertEqual(row[:2], ('America/Chicago', '2020-01-01 00:00:00'))
+        self.assertGreater(row[2], '2020-01-01 00:00:00')
+
+class TzMigrationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.bot = bavi.bot.Bot(None)
+        self.bot.db = Database(':memory:')
+        self.addCleanup(self.bot.db.close)
+
+    def test_migrates_audit_triggers(self):
+        # The schema from before migrations, with its AFTER triggers
+        self.bot.db.execute_write('''
+                CREATE TABLE tz_info (
+                    nick TEXT,
+                    tz TEXT,
+                    created_at DATETIME,
+                    updated_at DATETIME,
+                    PRIMARY KEY (nick)
+                )
+        ''')
+        self.bot.db.execute_write('''
+                CREATE TRIGGER tz_info_insert_aud
+                AFTER INSERT ON tz_info FOR EACH ROW
+                BEGIN
+                    UPDATE tz_info
+                       SET created_at = DATETIME(),
+                           updated_at = DATETIME()
+                     WHERE nick = NEW.nick;
+                END
+        ''')
+        self.bot.db.execute_write('''
+                INSERT INTO tz_info (nick, tz) VALUES ('test', 'UTC')
+        ''')
+        self.bot.db.execute_write('''
+                UPDATE tz_info SET created_at = '2020-01-01 00:00:00'
+        ''')
+
+        tz_module.init(self.bot)
+
+        triggers = self.bot.db.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+        ).fetchall()
+        self.assertEqual(triggers, [])
+        row = self.bot.db.execute(
+                'SELECT nick, tz, created_at FROM tz_info'
+        ).fetchone()
+        self.assertEqual(row, ('test', 'UTC', '2020-01-01 00:00:00'))
+        self.assertEqual(tz_module.tz_for_nick(self.bot, 'Test').zone, 'UTC')
+
+    def test_migrations_run_once(self):
+        tz_module.init(self.bot)
+        tz_module._store_tz(self.bot.db.connect(), 'test', 'UTC')
+
+        self.assertEqual(self.bot.db.migrate('tz', tz_module.MIGRATIONS), 1)
+
+        self.assertEqual(tz_module.tz_for_nick(self.bot, 'test').zone, 'UTC')
+
+if __name__ == '__main__':
+    unittest.main()
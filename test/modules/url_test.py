@@ -1,9 +1,12 @@
+import threading
+import time
 import unittest
 import mock
 from unittest.mock import MagicMock
 from unittest.mock import Mock
 import chardet
 
+import requests
 from requests.models import Response
 
 from irc.client import Event, NickMask
@@ -193,3 +196,122 @@ class URLModuleTestCase(unittest.TestCase):
                     mock.call('#test', '[ second webpage ] - second.web.io')
                 ],
                 any_order=False)
+
+    def test_normalize_url(self):
+        normalize = url_module.normalize_url
+
+        self.assertEqual(normalize('HTTP://Example.COM'),
+                         'http://example.com/')
+        self.assertEqual(normalize('https://example.com:443/a#top'),
+                         'https://example.com/a')
+        self.assertEqual(normalize('http://example.com:8080/a?b=1'),
+                         'http://example.com:8080/a?b=1')
+        self.assertNotEqual(normalize('http://example.com/A'),
+                            normalize('http://example.com/a'))
+
+    def test_concurrent_fetches_are_coalesced(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow_get(url):
+            calls.append(url)
+            started.set()
+            release.wait(5)
+            return 'shared title'
+
+        results = []
+
+        def fetch(url):
+            results.append(url_module.fetch_title(url))
+
+        with mock.patch('bavi.modules.url.get_http_title',
+                        side_effect=slow_get):
+            leader = threading.Thread(
+                target=fetch, args=('http://example.com/page',))
+            leader.start()
+            started.wait(5)
+
+            followers = [
+                threading.Thread(target=fetch, args=(url,))
+                for url in ['http://EXAMPLE.com/page',
+                            'http://example.com:80/page#comments']
+            ]
+            for thread in followers:
+                thread.start()
+
+            # Let the followers block on the leader's fetch
+            time.sleep(0.1)
+            release.set()
+
+            for thread in [leader] + followers:
+                thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['shared title'] * 3)
+        self.assertEqual(url_module._flights, {})
+
+    def test_waiters_share_the_exception(self):
+        started = threading.Event()
+        release = threading.Event()
+        errors = []
+
+        def failing_get(url):
+            started.set()
+            release.wait(5)
+            raise requests.exceptions.Timeout()
+
+        def fetch():
+            try:
+                url_module.fetch_title('http://example.com')
+            except requests.exceptions.Timeout as e:
+                errors.append(e)
+
+        with mock.patch('bavi.modules.url.get_http_title',
+                        side_effect=failing_get) as get:
+            threads = [threading.Thread(target=fetch) for i in range(3)]
+            threads[0].start()
+            started.wait(5)
+            for thread in threads[1:]:
+                thread.start()
+            time.sleep(0.1)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(len(errors), 3)
+
+    def test_waiter_gives_up_on_stuck_leader(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def get(url):
+            if threading.current_thread() is not threading.main_thread():
+                # The leader never finishes
+                release.wait(5)
+            return 'direct title'
+
+        with mock.patch('bavi.modules.url.get_http_title',
+                        side_effect=get) as get_title, \
+                mock.patch('bavi.modules.url.FLIGHT_TIMEOUT', 0.05):
+            leader = threading.Thread(
+                target=url_module.fetch_title, args=('http://example.com',))
+            leader.start()
+            while get_title.call_count == 0:
+                time.sleep(0.001)
+
+            self.assertEqual(url_module.fetch_title('http://example.com'),
+                             'direct title')
+            self.assertEqual(get_title.call_count, 2)
+
+            release.set()
+            leader.join(5)
+
+    def test_sequential_fetches_are_not_cached(self):
+        with mock.patch('bavi.modules.url.get_http_title',
+                        side_effect=['first', 'second']):
+            self.assertEqual(url_module.fetch_title('http://example.com'),
+                             'first')
+            self.assertEqual(url_module.fetch_title('http://example.com'),
+                             'second')
@@ -0,0 +1,79 @@
+import configparser
+import unittest
+from unittest.mock import MagicMock
+
+from irc.client import Event, NickMask
+
+from bavi.network import BotGroup, irc_sections
+
+class Dummy:
+    pass
+
+def make_config(data):
+    config = configparser.ConfigParser()
+    config.read_dict(data)
+    return config
+
+class IrcSectionsTestCase(unittest.TestCase):
+    def test_named_sections(self):
+        config = make_config({
+            'irc:one': { 'Nickname': 'a' },
+            'irc:two': { 'Nickname': 'b' },
+            'sqlite3': { 'Filename': ':memory:' }
+        })
+
+        self.assertEqual(irc_sections(config), ['irc:one', 'irc:two'])
+
+    def test_plain_irc_section(self):
+        config = make_config({ 'irc': { 'Nickname': 'a' } })
+
+        self.assertEqual(irc_sections(config), ['irc'])
+
+    def test_no_sections(self):
+        self.assertEqual(irc_sections(make_config({})), [])
+
+class BotGroupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.group = BotGroup(make_config({
+            'irc:one': { 'Nickname': 'BotOne' },
+            'irc:two': { 'Nickname': 'BotTwo' },
+            'sqlite3': { 'Filename': ':memory:' }
+        }))
+
+        for bot in self.group.bots:
+            bot.connection = Dummy()
+            bot.connection.get_nickname = lambda: 'TestBot'
+            bot.connection.privmsg = MagicMock()
+            bot.channels = { '#test' }
+
+    def test_bots_share_registry(self):
+        def handler(bot, source, target, message, **kwargs):
+            bot.say(target, 'This is an example')
+
+        one, two = self.group.bots
+        self.group.primary.add_command('example', handler)
+
+        two.on_pubmsg(
+                None,
+                Event(
+                    'pubmsg',
+                    NickMask('user!ident@host'),
+                    '#test',
+                    ['.example']
+                )
+        )
+
+        one.connection.privmsg.assert_not_called()
+        two.connection.privmsg.assert_called_with(
+                '#test',
+                'This is an example'
+        )
+
+    def test_bots_share_database(self):
+        self.group.init_db()
+
+        one, two = self.group.bots
+        self.assertIs(one.db, two.db)
+
+    def test_requires_irc_section(self):
+        self.assertRaises(ValueError, BotGroup, make_config({}))
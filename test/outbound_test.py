@@ -0,0 +1,174 @@
+import unittest
+
+import irc.client
+
+from bavi.outbound import (
+        OutboundQueue,
+        TokenBucket,
+        PRIORITY_COMMAND,
+        PRIORITY_MATCHER
+)
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TokenBucketTestCase(unittest.TestCase):
+    def test_burst_then_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=1, burst=2, clock=clock)
+
+        self.assertTrue(bucket.take())
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+
+        clock.now += 1
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+
+class OutboundQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.sent = []
+
+    def make_queue(self, **kwargs):
+        return OutboundQueue(
+                lambda target, line: self.sent.append((target, line)),
+                clock=self.clock,
+                **kwargs
+        )
+
+    def test_sends_within_burst_immediately(self):
+        queue = self.make_queue(burst=2)
+        queue.enqueue('#a', 'one')
+        queue.flush()
+
+        self.assertEqual(self.sent, [('#a', 'one')])
+        self.assertEqual(queue.depth, 0)
+
+    def test_paces_after_burst(self):
+        queue = self.make_queue(rate=1, burst=1)
+        for line in ['one', 'two', 'three']:
+            queue.enqueue('#a', line)
+        queue.flush()
+
+        self.assertEqual(self.sent, [('#a', 'one')])
+        self.assertEqual(queue.depth, 2)
+
+        self.clock.now += 1
+        queue.flush()
+        self.assertEqual(self.sent, [('#a', 'one'), ('#a', 'two')])
+
+    def test_round_robin_across_targets(self):
+        queue = self.make_queue(rate=1, burst=4)
+        for line in ['a1', 'a2', 'a3']:
+            queue.enqueue('#a', line, PRIORITY_MATCHER)
+        queue.enqueue('#b', 'b1', PRIORITY_MATCHER)
+        queue.flush()
+
+        self.assertEqual(
+                [line for target, line in self.sent],
+                ['a1', 'b1', 'a2', 'a3']
+        )
+
+    def test_commands_before_matchers(self):
+        queue = self.make_queue(rate=1, burst=2)
+        queue.enqueue('#a', 'title', PRIORITY_MATCHER)
+        queue.enqueue('#b', 'reply', PRIORITY_COMMAND)
+        queue.flush()
+
+        self.assertEqual(self.sent, [('#b', 'reply'), ('#a', 'title')])
+
+    def test_aggregate_merges_short_lines(self):
+        queue = self.make_queue(
+                burst=1,
+                aggregate=True,
+                budget=lambda target: 12
+        )
+        for line in ['one', 'two', 'three']:
+            queue.enqueue('#a', line)
+        queue.flush()
+
+        self.assertEqual(self.sent, [('#a', 'one | two')])
+        self.assertEqual(queue.merged, 1)
+        self.assertEqual(queue.depth, 1)
+
+    def test_aggregate_counts_bytes(self):
+        queue = self.make_queue(
+                burst=1,
+                aggregate=True,
+                budget=lambda target: 12
+        )
+        for line in ['\u00e9\u00e9\u00e9', 'two']:
+            queue.enqueue('#a', line)
+        queue.flush()
+
+        # 6 + 3 + 3 bytes fits, but 6 characters would be counted as 12
+        self.assertEqual(self.sent, [('#a', '\u00e9\u00e9\u00e9 | two')])
+
+    def test_drops_when_target_full(self):
+        queue = self.make_queue(rate=1, burst=1, max_per_target=2)
+        self.assertTrue(queue.enqueue('#a', 'one'))
+        self.assertTrue(queue.enqueue('#a', 'two'))
+        self.assertFalse(queue.enqueue('#a', 'three'))
+
+        self.assertEqual(queue.stats()['dropped'], 1)
+        self.assertEqual(queue.stats()['depth'], 2)
+
+    def test_clear_counts_dropped(self):
+        queue = self.make_queue(rate=1, burst=0)
+        queue.enqueue('#a', 'one')
+        queue.enqueue('#b', 'two')
+        queue.clear()
+
+        self.assertEqual(queue.depth, 0)
+        self.assertEqual(queue.dropped, 2)
+
+    def test_control_lines_go_first_and_share_the_bucket(self):
+        queue = self.make_queue(rate=1, burst=2)
+        queue.enqueue('#a', 'hello')
+        queue.enqueue_control(lambda: self.sent.append((None, 'JOIN #b')))
+        queue.enqueue_control(lambda: self.sent.append((None, 'JOIN #c')))
+
+        queue.flush()
+        self.assertEqual(self.sent, [(None, 'JOIN #b'), (None, 'JOIN #c')])
+
+        self.clock.now += 1
+        queue.flush()
+        self.assertEqual(self.sent[-1], ('#a', 'hello'))
+
+    def test_clear_drops_control_lines(self):
+        queue = self.make_queue(rate=1, burst=0)
+        queue.enqueue_control(lambda: self.sent.append((None, 'JOIN #b')))
+        queue.clear()
+
+        self.clock.now += 10
+        queue.flush()
+        self.assertEqual(self.sent, [])
+
+    def test_disconnected_send_pauses(self):
+        def send(target, line):
+            if not connected:
+                raise irc.client.ServerNotConnectedError('Not connected.')
+            self.sent.append((target, line))
+
+        connected = False
+        queue = OutboundQueue(send, clock=self.clock, burst=5)
+        queue.enqueue('#a', 'one')
+        queue.enqueue('#a', 'two')
+
+        queue.flush()
+        self.assertTrue(queue.paused)
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(queue.depth, 1)
+
+        connected = True
+        queue.flush()
+        self.assertEqual(self.sent, [])
+
+        queue.resume()
+        self.assertEqual(self.sent, [('#a', 'two')])
+        self.assertEqual(queue.sent, 1)
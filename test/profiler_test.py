@@ -0,0 +1,121 @@
+import collections
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from bavi.profiler import SamplingProfiler, enter_handler, leave_handler
+
+class SamplingProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.profiler = SamplingProfiler(interval=0.001)
+
+    def busy_handler(self, stop):
+        token = enter_handler('command:busy')
+        try:
+            while not stop.is_set():
+                sum(range(100))
+        finally:
+            leave_handler(token)
+
+    def profile_busy_handler(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=self.busy_handler, args=(stop,))
+        thread.start()
+        try:
+            self.profiler.start()
+            time.sleep(0.05)
+            return self.profiler.stop()
+        finally:
+            stop.set()
+            thread.join()
+
+    def test_samples_attributed_to_handler(self):
+        samples = self.profile_busy_handler()
+
+        handler = [
+            stack for stack in samples if stack[0] == 'command:busy'
+        ]
+        assert handler
+        assert any('busy_handler' in stack[-1] for stack in handler)
+
+    def test_leave_handler_restores_outer_label(self):
+        outer = enter_handler('outer')
+        inner = enter_handler('inner')
+        leave_handler(inner)
+
+        from bavi.profiler import _running
+        assert _running[threading.get_ident()] == 'outer'
+
+        leave_handler(outer)
+        assert threading.get_ident() not in _running
+
+    def test_start_twice(self):
+        self.profiler.start()
+        try:
+            with self.assertRaises(RuntimeError):
+                self.profiler.start()
+        finally:
+            self.profiler.stop()
+
+    def test_stop_when_stopped(self):
+        with self.assertRaises(RuntimeError):
+            self.profiler.stop()
+
+    def test_dump_collapsed(self):
+        samples = collections.Counter({
+            ('command:a', 'run (bot.py:1)', 'f;g (x.py:2)'): 3,
+            ('MainThread', 'main (bavi.py:1)'): 1
+        })
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.profiler.dump(samples, directory)
+            with open(path) as f:
+                lines = f.read().splitlines()
+
+        assert lines == [
+            'command:a;run (bot.py:1);f:g (x.py:2) 3',
+            'MainThread;main (bavi.py:1) 1'
+        ]
+
+    def test_dump_speedscope(self):
+        samples = collections.Counter({
+            ('command:a', 'run (bot.py:1)'): 2,
+            ('command:a', 'other (bot.py:9)'): 1
+        })
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = self.profiler.dump(samples, directory, 'speedscope')
+            with open(path) as f:
+                profile = json.load(f)
+
+        frames = [frame['name'] for frame in profile['shared']['frames']]
+        assert frames == ['command:a', 'run (bot.py:1)', 'other (bot.py:9)']
+        assert profile['profiles'][0]['samples'] == [[0, 1], [0, 2]]
+        assert profile['profiles'][0]['weights'] == [0.002, 0.001]
+
+    def test_dumps_do_not_overwrite(self):
+        samples = collections.Counter({ ('MainThread',): 1 })
+
+        with tempfile.TemporaryDirectory() as directory:
+            paths = set(
+                self.profiler.dump(samples, directory) for i in range(3)
+            )
+
+            self.assertEqual(len(paths), 3)
+            self.assertEqual(sorted(os.listdir(directory)),
+                    sorted(os.path.basename(path) for path in paths))
+
+    def test_dump_unknown_format(self):
+        with self.assertRaises(ValueError):
+            self.profiler.dump(collections.Counter(), '.', 'pstats')
+
+    def test_toggle(self):
+        with tempfile.TemporaryDirectory() as directory:
+            assert self.profiler.toggle(directory) is None
+            assert self.profiler.running
+            path = self.profiler.toggle(directory)
+            assert not self.profiler.running
+            assert os.path.dirname(path) == directory
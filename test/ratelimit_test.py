@@ -0,0 +1,192 @@
+import configparser
+import unittest
+from unittest.mock import MagicMock
+
+from irc.client import Event, NickMask
+
+import bavi.bot
+from bavi.ratelimit import (
+        DispatchLimiter,
+        SlidingWindowLimiter,
+        parse_budget
+)
+
+class Dummy:
+    pass
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def make_config(data):
+    config = configparser.ConfigParser()
+    config.read_dict(data)
+    return config
+
+class SlidingWindowLimiterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = SlidingWindowLimiter(2, 10, clock=self.clock)
+
+    def take(self, key):
+        if self.limiter.check(key):
+            self.limiter.hit(key)
+            return True
+        return False
+
+    def test_limit_within_window(self):
+        self.assertTrue(self.take('a'))
+        self.assertTrue(self.take('a'))
+        self.assertFalse(self.take('a'))
+        self.assertTrue(self.take('b'))
+
+    def test_previous_window_is_weighted(self):
+        self.take('a')
+        self.take('a')
+
+        # Half of the previous window still overlaps: 2 * 0.5 = 1 used
+        self.clock.now = 15
+        self.assertTrue(self.take('a'))
+        self.assertFalse(self.take('a'))
+
+        self.clock.now = 20
+        self.assertTrue(self.take('a'))
+
+    def test_idle_keys_are_swept(self):
+        self.take('a')
+        self.clock.now = 25
+        self.take('b')
+        self.limiter.sweep()
+
+        self.assertEqual(len(self.limiter), 1)
+
+    def test_parse_budget(self):
+        self.assertEqual(parse_budget('5/60'), (5, 60.0))
+        self.assertRaises(ValueError, parse_budget, 'five')
+        self.assertRaises(ValueError, parse_budget, '0/60')
+
+class DispatchLimiterTestCase(unittest.TestCase):
+    def test_handler_override(self):
+        limiter = DispatchLimiter(make_config({
+            'ratelimit': { 'PerHandler': '5/60' },
+            'ratelimit:handlers': { 'title_command': '1/60' }
+        }))
+
+        self.assertTrue(limiter.allow('nick', '#a', 'title_command'))
+        self.assertFalse(limiter.allow('nick', '#a', 'title_command'))
+        self.assertTrue(limiter.allow('other', '#a', 'title_command'))
+        self.assertTrue(limiter.allow('nick', '#a', 'choose_command'))
+
+    def test_rejected_call_is_not_counted(self):
+        limiter = DispatchLimiter(make_config({
+            'ratelimit': { 'PerNick': '2/60', 'PerChannel': '1/60' }
+        }))
+
+        self.assertTrue(limiter.allow('nick', '#a', 'h'))
+        self.assertFalse(limiter.allow('nick', '#a', 'h'))
+        self.assertTrue(limiter.allow('nick', '#b', 'h'))
+        self.assertEqual(limiter.rejected, 1)
+
+    def test_unconfigured_allows_everything(self):
+        limiter = DispatchLimiter(make_config({}))
+
+        for i in range(100):
+            self.assertTrue(limiter.allow('nick', '#a', 'h'))
+
+class BotRateLimitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.bot = bavi.bot.Bot(make_config({
+            'ratelimit': { 'PerNick': '1/60', 'Notice': 'True' }
+        }))
+        self.bot.connection = Dummy()
+        self.bot.connection.get_nickname = lambda: 'TestBot'
+        self.bot.connection.privmsg = MagicMock()
+        self.bot.connection.notice = MagicMock()
+        self.bot.channels = { '#test' }
+
+    def test_handler_not_called_when_limited(self):
+        handler = MagicMock(__name__='handler')
+        self.bot.add_command('example', handler)
+
+        for i in range(3):
+            self.bot.on_pubmsg(
+                    None,
+                    Event(
+                        'pubmsg',
+                        NickMask('user!ident@host'),
+                        '#test',
+                        ['.example']
+                    )
+            )
+
+        self.assertEqual(handler.call_count, 1)
+        self.bot.connection.notice.assert_called_once_with(
+                'user',
+                "You're doing that too often; try again later."
+        )
+
+    def pubmsg(self, message, source='user!ident@host'):
+        self.bot.on_pubmsg(
+                None,
+                Event('pubmsg', NickMask(source), '#test', [message])
+        )
+
+    def test_notice_is_paced(self):
+        self.bot.add_command('example', MagicMock(__name__='handler'))
+        self.bot._outbound._bucket._tokens = 0
+        self.pubmsg('.example')
+        self.pubmsg('.example')
+        self.bot.connection.notice.assert_not_called()
+
+        self.bot._outbound._bucket._tokens = 1
+        self.bot._outbound.flush()
+        self.bot.connection.notice.assert_called_once_with(
+                'user',
+                "You're doing that too often; try again later."
+        )
+
+    def test_unknown_commands_are_limited(self):
+        for i in range(3):
+            self.pubmsg('.nonexistent')
+
+        self.bot.connection.privmsg.assert_called_once_with(
+                '#test',
+                "user: I don't know about that command."
+        )
+
+class HandlerBudgetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.bot = bavi.bot.Bot(make_config({
+            'ratelimit': { 'PerHandler': '1/60' },
+            'ratelimit:handlers': { 'b.two': '2/60' }
+        }))
+        self.bot.connection = Dummy()
+        self.bot.connection.get_nickname = lambda: 'TestBot'
+        self.bot.connection.privmsg = MagicMock()
+        self.bot.channels = { '#test' }
+
+    def pubmsg(self, message):
+        self.bot.on_pubmsg(
+                None,
+                Event('pubmsg', NickMask('user!ident@host'), '#test',
+                    [message])
+        )
+
+    def test_budgets_are_per_module_and_command(self):
+        # Same function name in two modules
+        a = MagicMock(__name__='run')
+        b = MagicMock(__name__='run')
+        with self.bot._registry.loading('a'):
+            self.bot.add_command('one', a)
+        with self.bot._registry.loading('b'):
+            self.bot.add_command('two', b)
+
+        for i in range(3):
+            self.pubmsg('.one')
+            self.pubmsg('.two')
+
+        self.assertEqual(a.call_count, 1)
+        self.assertEqual(b.call_count, 2)
@@ -0,0 +1,183 @@
+import collections
+import configparser
+import unittest
+from unittest.mock import MagicMock
+
+from irc.client import Event, NickMask, ServerNotConnectedError
+
+import bavi.bot
+from bavi.reconnect import Backoff, BackoffReconnect, join_batch
+
+class BackoffTestCase(unittest.TestCase):
+    def test_bounds_grow_then_cap(self):
+        high = Backoff(min_interval=2, max_interval=30, rng=lambda: 1.0)
+        self.assertEqual(
+                [high.next() for i in range(6)],
+                [2, 4, 8, 16, 30, 30]
+        )
+
+        low = Backoff(min_interval=2, max_interval=30, rng=lambda: 0.0)
+        self.assertEqual([low.next() for i in range(3)], [2, 2, 2])
+
+    def test_jitter(self):
+        backoff = Backoff(min_interval=1, max_interval=100)
+        for i in range(5):
+            backoff.next()
+
+        delays = set(round(backoff.next(), 6) for i in range(20))
+        assert len(delays) > 1
+        assert all(1 <= delay <= 100 for delay in delays)
+
+    def test_reset(self):
+        backoff = Backoff(min_interval=2, max_interval=30, rng=lambda: 1.0)
+        backoff.next()
+        backoff.next()
+        backoff.reset()
+        self.assertEqual(backoff.next(), 2)
+
+class BackoffReconnectTestCase(unittest.TestCase):
+    def test_schedules_one_attempt_at_a_time(self):
+        bot = MagicMock()
+        bot.connection.is_connected.return_value = False
+        strategy = BackoffReconnect(
+                Backoff(min_interval=1, max_interval=8, rng=lambda: 1.0)
+        )
+
+        strategy.run(bot)
+        strategy.run(bot)
+        bot.reactor.scheduler.execute_after.assert_called_once_with(
+                1,
+                strategy.check
+        )
+
+        strategy.check()
+        bot.jump_server.assert_called_once_with()
+        bot.reactor.scheduler.execute_after.assert_called_with(
+                2,
+                strategy.check
+        )
+
+    def test_no_attempt_when_connected(self):
+        bot = MagicMock()
+        bot.connection.is_connected.return_value = True
+        strategy = BackoffReconnect(Backoff())
+
+        strategy.run(bot)
+        strategy.check()
+
+        bot.jump_server.assert_not_called()
+
+class JoinBatchTestCase(unittest.TestCase):
+    def test_max_targets(self):
+        channels = collections.deque(['#a', '#b', '#c'])
+
+        self.assertEqual(join_batch(channels, 2), '#a,#b')
+        self.assertEqual(join_batch(channels, 2), '#c')
+        self.assertEqual(len(channels), 0)
+
+    def test_line_length(self):
+        channels = collections.deque(
+                '#' + str(i) * 10 for i in range(10)
+        )
+
+        # "JOIN " + 11 bytes, then 12 bytes per additional channel
+        self.assertEqual(join_batch(channels, None, max_bytes=40), '#' +
+                '0' * 10 + ',#' + '1' * 10 + ',#' + '2' * 10)
+        self.assertEqual(len(channels), 7)
+
+    def test_long_channel_is_sent_alone(self):
+        channels = collections.deque(['#' + 'x' * 600, '#b'])
+
+        self.assertEqual(join_batch(channels), '#' + 'x' * 600)
+        self.assertEqual(join_batch(channels), '#b')
+
+class ChannelTrackingTestCase(unittest.TestCase):
+    def setUp(self):
+        config = configparser.ConfigParser()
+        config.read_dict({
+            'irc': { 'Channels': '#one, #two' },
+            'reconnect': { 'JoinBatch': '2' },
+            'outbound': { 'Rate': '1', 'Burst': '1' }
+        })
+        self.bot = bavi.bot.Bot(config)
+        self.bot.connection = MagicMock()
+        self.bot.connection.get_nickname.return_value = 'TestBot'
+        self.bot.connection.features.targmax = {}
+        self.conn = self.bot.connection
+
+    def event(self, kind, nick, target, arguments=[]):
+        return Event(kind, NickMask(nick + '!ident@host'), target, arguments)
+
+    def joined(self):
+        return [call[0][0] for call in self.conn.join.call_args_list]
+
+    def test_tracks_runtime_joins_and_parts(self):
+        bot = self.bot
+        bot.on_join(self.conn, self.event('join', 'TestBot', '#Three'))
+        bot.on_join(self.conn, self.event('join', 'someone', '#four'))
+        bot.on_part(self.conn, self.event('part', 'TestBot', '#ONE'))
+        bot.on_kick(self.conn, self.event('kick', 'op', '#two',
+            ['TestBot', 'bye']))
+
+        self.assertEqual(bot.joined_channels, ['#Three'])
+
+    def test_welcome_joins_in_paced_batches(self):
+        bot = self.bot
+        bot.on_join(self.conn, self.event('join', 'TestBot', '#three'))
+
+        bot.on_welcome(self.conn, self.event('welcome', 'server', 'TestBot'))
+        bot._outbound.flush()
+        self.assertEqual(self.joined(), ['#one,#two'])
+
+        # The second line waits for the token bucket
+        bot._outbound.flush()
+        self.assertEqual(self.joined(), ['#one,#two'])
+
+        bot._outbound._bucket._tokens = 1
+        bot._outbound.flush()
+        self.assertEqual(self.joined(), ['#one,#two', '#three'])
+
+    def test_server_targmax_wins(self):
+        self.conn.features.targmax = { 'JOIN': None }
+        self.bot.join('#a', '#b', '#c')
+        self.bot._outbound.flush()
+
+        self.assertEqual(self.joined(), ['#a,#b,#c'])
+
+    def test_disconnect_drops_pending_joins(self):
+        bot = self.bot
+        bot.on_welcome(self.conn, self.event('welcome', 'server', 'TestBot'))
+        bot.on_disconnect(self.conn, self.event('disconnect', 'server', ''))
+        bot._outbound._bucket._tokens = 5
+        bot._outbound.flush()
+
+        self.assertEqual(self.joined(), [])
+        self.assertEqual(bot.joined_channels, ['#one', '#two'])
+
+    def test_lost_connection_holds_lines_until_welcome(self):
+        bot = self.bot
+        self.conn.privmsg.side_effect = ServerNotConnectedError()
+        bot._outbound._bucket._tokens = 5
+        bot._privmsg('#one', 'lost', None)
+        bot._privmsg('#one', 'held', None)
+
+        bot.on_disconnect(self.conn, self.event('disconnect', 'server', ''))
+        bot._privmsg('#one', 'later', None)
+        self.conn.privmsg.side_effect = None
+        bot._outbound._bucket._tokens = 5
+        bot._outbound.flush()
+        self.conn.privmsg.assert_called_once_with('#one', 'lost')
+
+        bot.on_welcome(self.conn, self.event('welcome', 'server', 'TestBot'))
+        self.assertEqual(self.conn.privmsg.call_args[0], ('#one', 'later'))
+
+    def test_part_is_paced(self):
+        bot = self.bot
+        bot._outbound._bucket._tokens = 0
+        bot.part('#one', '#two')
+        bot._outbound.flush()
+        self.conn.part.assert_not_called()
+
+        bot._outbound._bucket._tokens = 1
+        bot._outbound.flush()
+        self.conn.part.assert_called_once_with(('#one', '#two'))
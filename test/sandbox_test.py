@@ -0,0 +1,218 @@
+import configparser
+import os
+import sys
+import tempfile
+import textwrap
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from irc.client import Event, NickMask
+
+import bavi.bot
+import bavi.module_loader as module_loader
+from bavi.manifest import ModuleSpec
+from bavi.sandbox import SandboxCrashed, SandboxTimeout
+
+MODULE = textwrap.dedent('''
+    import os
+    import re
+    import time
+
+    def init(bot):
+        bot.add_command('echo', echo_command, aliases=['e'])
+        bot.add_command('pid', pid_command)
+        bot.add_command('crash', crash_command)
+        bot.add_command('spin', spin_command)
+        bot.add_command('fail', fail_command)
+        bot.add_matcher(re.compile(r'\\bping (\\w+)'), ping_matcher)
+
+    def echo_command(bot, source, target, message, **kwargs):
+        bot.reply_to(source, target, message)
+
+    def pid_command(bot, source, target, message, **kwargs):
+        bot.say(target, str(os.getpid()))
+
+    def crash_command(bot, source, target, message, **kwargs):
+        os._exit(1)
+
+    def spin_command(bot, source, target, message, **kwargs):
+        time.sleep(10)
+
+    def fail_command(bot, source, target, message, **kwargs):
+        raise KeyError(message)
+
+    def ping_matcher(bot, source, target, message, match=None, **kwargs):
+        bot.say(target, 'pong ' + match.group(1))
+''')
+
+class SandboxTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        with open(os.path.join(cls.tmp.name, 'sandboxed_fixture.py'),
+                'w') as f:
+            f.write(MODULE)
+        sys.path.insert(0, cls.tmp.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        sys.path.remove(cls.tmp.name)
+        cls.tmp.cleanup()
+
+    def setUp(self):
+        config = configparser.ConfigParser()
+        config.read_dict({
+            'sandbox': {
+                'Modules': 'fixture',
+                'Processes': '1',
+                'Timeout': '2'
+            },
+            'workers': { 'Threads': '2' }
+        })
+        self.bot = bavi.bot.Bot(config)
+        self.addCleanup(self.bot._pool.shutdown)
+        self.bot.connection = MagicMock()
+        self.bot.connection.get_nickname.return_value = 'TestBot'
+        self.bot.reply_to = MagicMock()
+        self.bot.say = MagicMock()
+
+        self.spec = ModuleSpec(
+                'fixture',
+                'sandboxed_fixture',
+                os.path.join(self.tmp.name, 'sandboxed_fixture.py')
+        )
+        module_loader.load_sandbox(self.bot, [self.spec])
+        self.sandbox = self.bot._registry.sandbox
+        self.addCleanup(self.sandbox.stop)
+
+    def pubmsg(self, message):
+        self.bot.on_pubmsg(
+                None,
+                Event('pubmsg', NickMask('user!ident@host'), '#test',
+                    [message])
+        )
+
+    def wait_for_call(self, mock):
+        deadline = time.monotonic() + 10
+        while not mock.called:
+            assert time.monotonic() < deadline, 'No reply'
+            time.sleep(0.01)
+
+    def call(self, command, message=''):
+        _, handler = self.bot._registry.commands.resolve(command)
+        handler(self.bot, NickMask('user!ident@host'), '#test', message)
+
+    def wait_for_worker(self):
+        deadline = time.monotonic() + 30
+        while self.sandbox._idle.empty():
+            assert time.monotonic() < deadline, 'No worker was restarted'
+            time.sleep(0.05)
+
+    def test_registers_module_without_importing_it(self):
+        self.assertEqual(self.bot._registry.modules, ['fixture'])
+        assert 'sandboxed_fixture' not in sys.modules
+
+        _, handler = self.bot._registry.commands.resolve('e')
+        self.assertEqual(handler.__name__, 'echo_command')
+
+    def test_command_output_is_relayed(self):
+        self.pubmsg('.echo hello')
+
+        self.wait_for_call(self.bot.reply_to)
+        self.bot.reply_to.assert_called_once_with(
+                NickMask('user!ident@host'),
+                '#test',
+                'hello'
+        )
+
+    def test_matcher_gets_match(self):
+        self.pubmsg('ping pong')
+
+        self.wait_for_call(self.bot.say)
+        self.bot.say.assert_called_once_with('#test', 'pong pong')
+
+    def test_handler_exception_keeps_its_name(self):
+        with self.assertRaises(Exception) as cm:
+            self.call('fail', 'oops')
+
+        self.assertEqual(type(cm.exception).__name__, 'KeyError')
+        self.assertEqual(self.sandbox.restarts, 0)
+
+    def test_crashed_worker_is_replaced(self):
+        self.call('pid')
+        pid = self.bot.say.call_args[0][1]
+
+        with self.assertRaises(SandboxCrashed):
+            self.call('crash')
+        self.assertEqual(self.sandbox.crashes, 1)
+
+        self.wait_for_worker()
+        self.bot.say.reset_mock()
+        self.call('pid')
+        self.assertNotEqual(self.bot.say.call_args[0][1], pid)
+
+    def test_slow_handler_is_killed(self):
+        start = time.monotonic()
+        with self.assertRaises(SandboxTimeout):
+            self.call('spin')
+        self.assertLess(time.monotonic() - start, 5)
+
+        self.wait_for_worker()
+        self.call('echo', 'still here')
+        self.bot.reply_to.assert_called_with(
+                NickMask('user!ident@host'),
+                '#test',
+                'still here'
+        )
+
+    def test_restart_replaces_handlers(self):
+        old = self.sandbox
+        module_loader.load_sandbox(self.bot, [self.spec])
+        self.sandbox = self.bot._registry.sandbox
+        self.addCleanup(self.sandbox.stop)
+
+        self.assertIsNot(self.sandbox, old)
+        self.assertFalse(any(worker.alive for worker in old._workers))
+        self.pubmsg('.echo again')
+        self.wait_for_call(self.bot.reply_to)
+        self.bot.reply_to.assert_called_once()
+
+    def test_stop_lets_running_calls_finish(self):
+        worker, = self.sandbox._workers
+        relay = self.sandbox._relay
+
+        def stop_then_relay(*args):
+            self.sandbox.stop()
+            return relay(*args)
+
+        self.sandbox._relay = stop_then_relay
+        self.call('echo', 'finished')
+
+        self.bot.reply_to.assert_called_once_with(
+                NickMask('user!ident@host'),
+                '#test',
+                'finished'
+        )
+        self.assertFalse(worker.alive)
+
+    def test_requires_workers(self):
+        config = configparser.ConfigParser()
+        config.read_dict({ 'sandbox': { 'Modules': 'fixture' } })
+        bot = bavi.bot.Bot(config)
+
+        with self.assertLogs('bavi.module_loader', 'ERROR'):
+            module_loader.load_sandbox(bot, [self.spec])
+
+        self.assertIsNone(bot._registry.sandbox)
+        self.assertEqual(bot._registry.modules, [])
+
+    def test_shutdown_stops_workers(self):
+        workers = list(self.sandbox._workers)
+
+        self.bot.shutdown()
+
+        self.assertFalse(any(worker.alive for worker in workers))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+
+import bavi.bot
+from bavi.startup import StartupReport
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+class StartupReportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.report = StartupReport(clock=self.clock)
+
+    def advance(self, seconds):
+        self.clock.now += seconds
+
+    def test_phases(self):
+        self.advance(0.2)
+        self.report.mark('import')
+        self.advance(0.05)
+        self.report.mark('modules')
+
+        self.assertEqual(
+                [phase for phase, seconds in self.report.phases],
+                ['import', 'modules']
+        )
+        self.assertAlmostEqual(self.report.total, 0.25)
+        self.assertEqual(
+                self.report.format(),
+                'Started in 250ms: import 200ms, modules 50ms'
+        )
+
+    def test_slowest_modules_are_listed(self):
+        self.report.add_modules({
+            'a': (0.001, 0.001),
+            'b': (0.010, 0.002),
+            'c': (0.0, 0.005),
+            'd': (0.0, 0.0),
+        })
+        self.advance(0.018)
+        self.report.mark('modules')
+
+        self.assertEqual(
+                self.report.format(),
+                'Started in 18ms: modules 18ms (b 12ms, c 5ms, a 2ms)'
+        )
+
+    def test_connect_waits_for_every_bot(self):
+        first = bavi.bot.Bot(None)
+        second = bavi.bot.Bot(None, shared=first)
+        self.report.mark('setup')
+        self.report.wait_for_connect([first, second])
+
+        self.advance(0.1)
+        for fn in first._connect_hooks:
+            fn(first)
+        assert not self.report.done
+
+        self.advance(0.2)
+        with self.assertLogs('bavi.startup', 'INFO') as logs:
+            for fn in second._connect_hooks:
+                fn(second)
+
+        assert self.report.done
+        self.assertEqual(self.report.phases[-1][0], 'connect')
+        self.assertAlmostEqual(self.report.phases[-1][1], 0.3)
+        assert 'connect 300ms' in logs.output[0]
+
+        # A reconnect later does not add to the report
+        for fn in first._connect_hooks:
+            fn(first)
+        self.assertEqual(len(self.report.phases), 2)
@@ -0,0 +1,223 @@
+import asyncio
+import threading
+import time
+import unittest
+from unittest import mock
+from unittest.mock import MagicMock
+
+from irc.client import Event, NickMask
+
+import bavi.bot
+from bavi.watchdog import HandlerTimeout, Watchdog
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError('Timed out waiting for condition')
+        time.sleep(0.005)
+
+class WatchdogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.watchdog = Watchdog(strikes=2, window=60, disable_for=30)
+
+    def tearDown(self):
+        self.watchdog.stop()
+
+    def test_no_deadline(self):
+        assert self.watchdog.watch('label', None) is None
+        assert not self.watchdog.done(None)
+
+    def test_finishes_in_time(self):
+        call = self.watchdog.watch('label', 5)
+
+        assert not self.watchdog.done(call)
+        assert self.watchdog.overruns == 0
+
+    def test_interrupts_overrun(self):
+        overruns = []
+        result = []
+
+        def spin():
+            call = self.watchdog.watch('spin', 0.05, overruns.append)
+            try:
+                while True:
+                    pass
+            except HandlerTimeout:
+                result.append('interrupted')
+            finally:
+                result.append(self.watchdog.done(call))
+
+        thread = threading.Thread(target=spin)
+        thread.start()
+        thread.join(5)
+
+        assert result == ['interrupted', True]
+        wait_for(lambda: overruns)
+        assert overruns == [False]
+        assert self.watchdog.overruns == 1
+
+    def test_reports_without_interrupting(self):
+        overruns = []
+        result = []
+
+        def spin():
+            call = self.watchdog.watch('spin', 0.05, overruns.append,
+                    interrupt=False)
+            try:
+                while not overruns:
+                    pass
+                result.append('finished')
+            except HandlerTimeout:
+                result.append('interrupted')
+            finally:
+                result.append(self.watchdog.done(call))
+
+        thread = threading.Thread(target=spin)
+        thread.start()
+        thread.join(5)
+
+        assert result == ['finished', True]
+        assert self.watchdog.overruns == 1
+
+    def test_strikes_disable(self):
+        now = [100.0]
+        watchdog = Watchdog(
+                strikes=2,
+                window=60,
+                disable_for=30,
+                clock=lambda: now[0]
+        )
+
+        assert not watchdog.strike('label')
+        now[0] += 61
+        assert not watchdog.strike('label')
+        assert watchdog.disabled('label') == 0
+        assert watchdog.strike('label')
+        assert watchdog.disabled('label') == 30
+        assert watchdog.disabled_count() == 1
+
+        now[0] += 30
+        assert watchdog.disabled('label') == 0
+
+class BotWatchdogTestCase(unittest.TestCase):
+    def setUp(self):
+        config = bavi.bot.configparser.ConfigParser()
+        config.read_dict({ 'watchdog': { 'Deadline': '0.05', 'Strikes': '2' } })
+        self.bot = bavi.bot.Bot(config)
+        self.bot.connection = MagicMock()
+        self.bot.channels = { '#test' }
+        self.bot.say = MagicMock()
+        self.bot.reply_to = MagicMock()
+
+    def tearDown(self):
+        self.bot.shutdown()
+
+    def pubmsg(self, message):
+        self.bot.on_pubmsg(None, Event(
+            'pubmsg',
+            NickMask('user!ident@host'),
+            '#test',
+            [message]
+        ))
+
+    def test_inline_handler_is_not_interrupted(self):
+        def spin(bot, source, target, message, **kwargs):
+            # Runs on the connection's thread, so it is only reported
+            while bot._watchdog.overruns == 0:
+                pass
+            bot.say(target, 'finished')
+
+        self.bot.add_command('spin', spin)
+
+        self.pubmsg('.spin')
+
+        def said():
+            self.bot._run_callbacks()
+            return self.bot.say.call_count >= 2
+
+        wait_for(said)
+        self.assertEqual(self.bot.say.call_args_list, [
+            mock.call('#test', 'finished'),
+            mock.call('#test', 'Command "spin" timed out after 0.05s.')
+        ])
+
+    def test_per_handler_deadline(self):
+        def slow(bot, source, target, message, **kwargs):
+            time.sleep(0.1)
+            bot.say(target, 'done')
+
+        self.bot.add_command('slow', slow, deadline=1)
+
+        self.pubmsg('.slow')
+        self.bot.say.assert_called_once_with('#test', 'done')
+
+    def test_coroutine_timeout(self):
+        async def sleepy(bot, source, target, message, **kwargs):
+            await asyncio.sleep(5)
+
+        self.bot.add_command('sleepy', sleepy)
+
+        self.pubmsg('.sleepy')
+        self.bot.say.assert_called_once_with(
+                '#test',
+                'Command "sleepy" timed out after 0.05s.'
+        )
+        assert self.bot.metrics.handler('command:sleepy').timeouts == 1
+
+class BotWorkerWatchdogTestCase(unittest.TestCase):
+    def setUp(self):
+        config = bavi.bot.configparser.ConfigParser()
+        config.read_dict({
+            'watchdog': { 'Deadline': '0.05', 'Strikes': '2' },
+            'workers': { 'Threads': '1' }
+        })
+        self.bot = bavi.bot.Bot(config)
+        self.bot.connection = MagicMock()
+        self.bot.channels = { '#test' }
+        self.bot.say = MagicMock()
+        self.bot.reply_to = MagicMock()
+
+    def tearDown(self):
+        self.bot.shutdown()
+
+    def pubmsg(self, message):
+        self.bot.on_pubmsg(None, Event(
+            'pubmsg',
+            NickMask('user!ident@host'),
+            '#test',
+            [message]
+        ))
+
+    def wait_for_say(self, count):
+        def said():
+            self.bot._run_callbacks()
+            return self.bot.say.call_count >= count
+
+        wait_for(said)
+
+    def test_runaway_command(self):
+        def spin(bot, source, target, message, **kwargs):
+            while True:
+                pass
+
+        self.bot.add_command('spin', spin)
+
+        self.pubmsg('.spin')
+        self.wait_for_say(1)
+        self.bot.say.assert_called_once_with(
+                '#test',
+                'Command "spin" timed out after 0.05s.'
+        )
+
+        self.pubmsg('.spin')
+        self.wait_for_say(2)
+        assert self.bot.say.call_args[0][1].startswith(
+                'Command "spin" timed out after 0.05s. It is disabled for'
+        )
+        assert self.bot.metrics.handler('command:spin').timeouts == 2
+
+        self.pubmsg('.spin')
+        assert self.bot.reply_to.call_args[0][2] == \
+                'Command "spin" is disabled for another 15 minutes after ' \
+                'timing out repeatedly.'
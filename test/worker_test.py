@@ -0,0 +1,147 @@
+import configparser
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from irc.client import Event, NickMask
+
+import bavi.bot
+from bavi.worker import HandlerPool
+
+class Dummy:
+    pass
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError('Timed out waiting for worker jobs')
+        time.sleep(0.001)
+
+class HandlerPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pool = HandlerPool(threads=4, max_pending=4)
+        self.sent = []
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def job(self, message, gate=None):
+        def fn():
+            if gate is not None:
+                gate.wait(5)
+            self.pool.emit(lambda: self.sent.append(message))
+        return fn
+
+    def test_output_is_ordered_per_channel(self):
+        gate = threading.Event()
+        self.pool.submit('#a', 'slow', self.job('first', gate))
+        self.pool.submit('#a', 'fast', self.job('second'))
+        self.pool.submit('#b', 'fast', self.job('other'))
+
+        # Wait for the unblocked jobs, then drain
+        wait_for(lambda: self.pool.pending <= 1)
+        self.pool.drain()
+        self.assertEqual(self.sent, ['other'])
+
+        gate.set()
+        wait_for(lambda: self.pool.pending == 0)
+        self.pool.drain()
+        self.assertEqual(self.sent, ['other', 'first', 'second'])
+
+    def test_abandon_releases_channel(self):
+        gate = threading.Event()
+        jobs = []
+
+        def slow():
+            jobs.append(self.pool.current_job())
+            gate.wait(5)
+            self.pool.emit(lambda: self.sent.append('late'))
+
+        self.pool.submit('#a', 'slow', slow)
+        self.pool.submit('#a', 'fast', self.job('second'))
+        wait_for(lambda: jobs)
+
+        self.pool.drain()
+        assert self.sent == []
+
+        self.pool.abandon(jobs[0])
+        wait_for(lambda: self.pool.pending == 1)
+        self.pool.drain()
+        assert self.sent == ['second']
+
+        gate.set()
+        wait_for(lambda: self.pool.pending == 0)
+        self.pool.drain()
+        assert self.sent == ['second']
+
+    def test_per_handler_limit(self):
+        gate = threading.Event()
+        running = []
+
+        def fn():
+            running.append(1)
+            gate.wait(5)
+
+        self.pool.submit('#a', 'handler', fn, limit=1)
+        self.pool.submit('#b', 'handler', fn, limit=1)
+
+        wait_for(lambda: running)
+        self.assertEqual(len(running), 1)
+
+        gate.set()
+        wait_for(lambda: self.pool.pending == 0)
+        self.assertEqual(len(running), 2)
+
+    def test_rejects_when_full(self):
+        gate = threading.Event()
+        for i in range(4):
+            self.assertTrue(self.pool.submit('#a', i, self.job(i, gate)))
+
+        self.assertFalse(self.pool.submit('#a', 'extra', self.job('extra')))
+        gate.set()
+
+    def test_emit_outside_job_returns_false(self):
+        self.assertFalse(self.pool.emit(lambda: None))
+
+class BotWorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        config = configparser.ConfigParser()
+        config.read_dict({ 'workers': { 'Threads': '2' } })
+        self.bot = bavi.bot.Bot(config)
+        self.bot.connection = Dummy()
+        self.bot.connection.get_nickname = lambda: 'TestBot'
+        self.bot.connection.privmsg = MagicMock()
+        self.bot.channels = { '#test' }
+
+    def tearDown(self):
+        self.bot._pool.shutdown()
+
+    def test_command_runs_off_thread(self):
+        threads = []
+
+        def handler(bot, source, target, message, **kwargs):
+            threads.append(threading.current_thread())
+            bot.say(target, 'This is an example')
+
+        self.bot.add_command('example', handler)
+        self.bot.on_pubmsg(
+                None,
+                Event(
+                    'pubmsg',
+                    NickMask('user!ident@host'),
+                    '#test',
+                    ['.example']
+                )
+        )
+
+        wait_for(lambda: self.bot._pool.pending == 0)
+        self.bot.connection.privmsg.assert_not_called()
+        self.assertNotEqual(threads[0], threading.current_thread())
+
+        self.bot._pool.drain()
+        self.bot.connection.privmsg.assert_called_with(
+                '#test',
+                'This is an example'
+        )
@@ -0,0 +1,142 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from bavi.db import Database
+from bavi.metrics import Metrics
+from bavi.writebehind import QueueFull
+
+def store(conn, key, value):
+    conn.execute('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)',
+            (key, value))
+
+def fail(conn):
+    raise ValueError('no')
+
+class WriteBehindTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'bavi.db')
+        self.metrics = Metrics()
+        self.db = Database(
+                self.path,
+                commit_interval=0,
+                max_pending=3,
+                pending_timeout=0.1,
+                metrics=self.metrics
+        )
+        self.addCleanup(self.db.close)
+        self.db.execute_write(
+                'CREATE TABLE kv (key TEXT PRIMARY KEY, value TEXT)'
+        )
+        self.writes = self.db.write_behind('kv')
+
+        # Held by block() to keep writes pending
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def block(self):
+        started = threading.Event()
+
+        def wait(conn):
+            started.set()
+            self.release.wait(5)
+
+        self.db.submit(wait)
+        assert started.wait(5)
+
+    def load(self, key):
+        row = self.db.execute('SELECT value FROM kv WHERE key = ?',
+                (key,)).fetchone()
+        return row[0] if row else None
+
+    def test_same_queue_for_name(self):
+        assert self.db.write_behind('kv') is self.writes
+        assert self.db.write_behind('other') is not self.writes
+
+    def test_reads_see_pending_writes(self):
+        self.block()
+        self.writes.put('a', '1', store, 'a', '1')
+
+        self.assertEqual(self.writes.read('a', self.load, 'a'), '1')
+        self.assertIsNone(self.load('a'))
+        self.assertEqual(self.writes.pending, 1)
+
+        self.release.set()
+        assert self.writes.flush(5)
+        self.assertEqual(self.load('a'), '1')
+        self.assertEqual(self.writes.read('a', lambda: 'db'), 'db')
+        self.assertEqual(self.writes.written, 1)
+        self.assertEqual(self.writes.lag.count, 1)
+
+    def test_latest_pending_write_wins(self):
+        self.block()
+        self.writes.put('a', '1', store, 'a', '1')
+        self.writes.put('a', '2', store, 'a', '2')
+
+        self.assertEqual(self.writes.read('a', self.load, 'a'), '2')
+
+        self.release.set()
+        assert self.writes.flush(5)
+        self.assertEqual(self.load('a'), '2')
+
+    def test_backpressure(self):
+        self.block()
+        for i in range(3):
+            self.writes.put(str(i), str(i), store, str(i), str(i))
+
+        with self.assertRaises(QueueFull):
+            self.writes.put('x', 'x', store, 'x', 'x')
+        self.assertEqual(self.writes.rejected, 1)
+        self.assertEqual(self.writes.read('x', self.load, 'x'), None)
+
+        self.release.set()
+        assert self.writes.flush(5)
+        self.writes.put('x', 'x', store, 'x', 'x')
+
+    def test_failed_write_falls_back_to_database(self):
+        self.writes.put('a', '1', fail)
+
+        assert self.writes.flush(5)
+        self.assertEqual(self.writes.failed, 1)
+        self.assertIsNone(self.writes.read('a', self.load, 'a'))
+
+    def test_close_commits_pending_writes(self):
+        self.block()
+        for i in range(3):
+            self.writes.put(str(i), str(i), store, str(i), str(i))
+
+        self.release.set()
+        self.db.close()
+
+        self.assertEqual(self.writes.pending, 0)
+        conn = sqlite3.connect(self.path)
+        self.addCleanup(conn.close)
+        count, = conn.execute('SELECT COUNT(*) FROM kv').fetchone()
+        self.assertEqual(count, 3)
+
+    def test_metrics(self):
+        self.block()
+        self.writes.put('a', '1', store, 'a', '1')
+
+        gauges = dict(
+            (name, value)
+            for name, labels, value in self.metrics.gauges()
+            if labels == { 'queue': 'kv' }
+        )
+        self.assertEqual(gauges['db_write_behind_pending'], 1)
+        self.assertGreaterEqual(gauges['db_write_behind_oldest_seconds'], 0)
+
+        self.release.set()
+        assert self.writes.flush(5)
+        output = self.metrics.render_prometheus()
+        self.assertIn('# TYPE bavi_db_write_behind_lag_seconds histogram',
+                output)
+        self.assertIn('bavi_db_write_behind_lag_seconds_count{queue="kv"} 1',
+                output)
+
+if __name__ == '__main__':
+    unittest.main()